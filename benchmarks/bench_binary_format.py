@@ -0,0 +1,93 @@
+""" Compares the binary collection format with MathML in size and load time.
+
+    Each model is written both ways. Loading MathML parses every expression
+    with lxml and mml2sympy; the binary file is memory mapped, and a model is
+    decoded from the shared node table on first access. The unrolled models
+    write a discretisation as one equation per node, as older exports did.
+
+    python benchmarks/bench_binary_format.py [max N]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sympy
+
+import model
+import model_library
+
+
+def unrolled(m):
+    """ m with each ArrayEquation replaced by one equation per index. """
+    out = model.Model()
+    out.name = m.name + ' unrolled'
+    out.bounds = m.bounds
+    out.solution_variables = set(m.solution_variables)
+    out.parameters = set(m.parameters)
+    eqs = set()
+    for eq in m.eqs:
+        if isinstance(eq, model.ArrayEquation):
+            for k in range(int(eq.lower), int(eq.upper) + 1):
+                eqs.add((sympy.Eq(eq.index, k), eq.stencil.subs(eq.index, k)))
+        else:
+            eqs.add(eq)
+    out.eqs = eqs
+    return out
+
+
+def _best(function, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure(m, directory):
+    mathml = os.path.join(directory, 'model.xml')
+    binary = os.path.join(directory, 'model.ocmlb')
+    with open(mathml, 'wb') as f:
+        model.write_mathml(m, f)
+    model.write_binary(m, binary)
+
+    def load_mathml():
+        with model.CollectionLoader(mathml) as loader:
+            loader.main_models()
+
+    def open_binary():
+        model.load_binary(binary).close()
+
+    def load_binary():
+        with model.load_binary(binary) as loader:
+            loader.main_models()
+
+    return (os.path.getsize(mathml), os.path.getsize(binary), _best(load_mathml),
+            _best(open_binary), _best(load_binary))
+
+
+def main(max_n=1000):
+    cases = [('electrochemistry_model', model_library.electrochemistry_model())]
+    n = 10
+    while n <= max_n:
+        cases.append(('pde_model_disc[N={}]'.format(n), model_library.pde_model_disc(n, 1.0 / n)))
+        cases.append(('unrolled pde_model_disc[N={}]'.format(n),
+                      unrolled(model_library.pde_model_disc(n, 1.0 / n))))
+        n *= 10
+    print('{:<34}{:>12}{:>12}{:>7}{:>12}{:>12}{:>12}{:>9}'.format(
+        'model', 'MathML (B)', 'binary (B)', 'ratio', 'MathML (s)', 'open (s)',
+        'binary (s)', 'speedup'))
+    with tempfile.TemporaryDirectory() as directory:
+        for name, m in cases:
+            size_m, size_b, load_m, open_b, load_b = measure(m, directory)
+            print('{:<34}{:>12}{:>12}{:>7.1f}{:>12.4f}{:>12.5f}{:>12.4f}{:>9.1f}'.format(
+                name, size_m, size_b, size_m / size_b, load_m, open_b, load_b,
+                load_m / load_b))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,72 @@
+""" Compares the direct Content MathML emitter with the sympy print + parse
+    path it replaces, over every expression of the library models.
+
+    python benchmarks/bench_mathml_emitter.py [repeats]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import model_library
+import xml.etree.ElementTree as ET
+from model.emitter import ContentMathMLEmitter
+from model.emitter import sympy_to_mathml_printer
+
+
+def expressions(m):
+    out = [m.bounds] + list(m.parameters) + list(m.solution_variables)
+    for eq in m.eqs:
+        out += list(eq) if isinstance(eq, tuple) else [eq]
+    for i in m.includes:
+        out += [i.bounds] + list(i.eqs) + expressions(i.submodel)
+    return out
+
+
+def main(repeats=20):
+    models = {
+        'ode_model': model_library.ode_model(),
+        'ode_model_disc': model_library.ode_model_disc(0.1, 100),
+        'pde_model': model_library.pde_model(),
+        'pde_model_disc': model_library.pde_model_disc(100, 0.1),
+        'electrochemistry_model': model_library.electrochemistry_model(),
+    }
+    print('{:<24}{:>8}{:>14}{:>14}{:>14}{:>10}'.format(
+        'model', 'exprs', 'printer (ms)', 'cold (ms)', 'warm (ms)', 'speedup'))
+    for name, m in models.items():
+        exprs = expressions(m)
+        for e in exprs:
+            emitted = ContentMathMLEmitter()(e)
+            # the emitter marks integer symbols, the printer does not
+            for ci in emitted.iter('ci'):
+                ci.attrib.pop('type', None)
+            assert ET.tostring(sympy_to_mathml_printer(e)) == \
+                ET.tostring(emitted)
+
+        def printer():
+            for e in exprs:
+                sympy_to_mathml_printer(e)
+
+        def cold():
+            emitter = ContentMathMLEmitter()
+            for e in exprs:
+                emitter(e)
+
+        warm_emitter = ContentMathMLEmitter()
+
+        def warm():
+            for e in exprs:
+                warm_emitter(e)
+
+        t_printer = min(timeit.repeat(printer, number=1, repeat=repeats))
+        t_cold = min(timeit.repeat(cold, number=1, repeat=repeats))
+        t_warm = min(timeit.repeat(warm, number=1, repeat=repeats))
+        print('{:<24}{:>8}{:>14.3f}{:>14.3f}{:>14.3f}{:>9.1f}x'.format(
+            name, len(exprs), 1e3 * t_printer, 1e3 * t_cold, 1e3 * t_warm,
+            t_printer / t_cold))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,107 @@
+""" Compares Jacobian-free Newton-Krylov with Newton on the sparse Jacobian.
+
+    The steady pde_model_disc grids are solved by model.newton, which
+    assembles and factors the Jacobian, and by model.newton_krylov with each
+    kind of Jacobian-vector product and preconditioner. A nonlinear reaction
+    diffusion model, discretised by model.discretise, is then stepped by
+    model.implicit_euler.
+
+    python benchmarks/bench_newton_krylov.py [max N]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy
+import sympy
+
+import model
+import model_library
+
+
+def tolerance(n):
+    # the residuals scale with 1 / dx**2, and so must an absolute tolerance
+    return 1e-12 * n * n
+
+
+def reaction_diffusion():
+    x = sympy.Symbol('x')
+    t = sympy.Symbol('t')
+    L = sympy.Symbol('L')
+    c = sympy.Symbol('c')
+    m = model.Model()
+    m.name = 'reaction diffusion'
+    m.bounds = sympy.And(0 < x, x < L, t > 0)
+    m.solution_variables = {sympy.Function('c')(x, t)}
+    m.parameters = {L}
+    m.eqs = {
+        sympy.Eq(sympy.Derivative(c, t), sympy.Derivative(c, x, x) - c**2),
+        (sympy.Eq(x, 0), sympy.Eq(c, 1)),
+        (sympy.Eq(x, L), sympy.Eq(sympy.Derivative(c, x), 0)),
+        (sympy.Eq(t, 0), sympy.Eq(c, 0)),
+    }
+    return m
+
+
+def _run(function):
+    start = time.perf_counter()
+    try:
+        result = function()
+    except RuntimeError:
+        return None, time.perf_counter() - start
+    return result, time.perf_counter() - start
+
+
+def steady(n):
+    compiled = model.compile_model(model_library.pde_model_disc(n, 1.0 / n))
+    params = {'cl': 1.0, 'L': 1.0}
+    y0 = numpy.zeros(compiled.size)
+    (direct, _), seconds = _run(lambda: model.newton(compiled, y0, params,
+                                                     tol=tolerance(n)))
+    print('{:<34}{:>12.4f}'.format('newton (sparse LU)', seconds))
+    for jvp in ('symbolic', 'fd'):
+        for preconditioner in ('none', 'jacobi', 'tridiagonal'):
+            result, seconds = _run(lambda: model.newton_krylov(
+                compiled, y0, params, tol=tolerance(n), jvp=jvp, preconditioner=preconditioner))
+            name = 'newton_krylov {} {}'.format(jvp, preconditioner)
+            if result is None:
+                print('{:<34}{:>12.4f}  did not converge'.format(name, seconds))
+                continue
+            y, stats = result
+            print('{:<34}{:>12.4f}  {:>4} Newton {:>6} Krylov  error {:.1e}'.format(
+                name, seconds, stats.iterations, stats.linear_iterations,
+                numpy.abs(y - direct).max()))
+
+
+def transient(n, steps=20):
+    compiled = model.compile_model(
+        model.discretise(reaction_diffusion(), sympy.Symbol('x'), n))
+    times = numpy.linspace(0.0, 1.0, steps + 1)
+    for jvp in ('symbolic', 'fd'):
+        result, seconds = _run(lambda: model.implicit_euler(
+            compiled, times, {'L': 1.0}, tol=tolerance(n), jvp=jvp,
+            preconditioner='tridiagonal'))
+        name = 'implicit_euler {} tridiagonal'.format(jvp)
+        if result is None:
+            print('{:<34}{:>12.4f}  did not converge'.format(name, seconds))
+            continue
+        _, stats = result
+        print('{:<34}{:>12.4f}  {:>4} Newton {:>6} Krylov'.format(
+            name, seconds, stats.iterations, stats.linear_iterations))
+
+
+def main(max_n=100000):
+    n = 1000
+    while n <= max_n:
+        print('pde_model_disc[N={}]'.format(n))
+        steady(n)
+        print('reaction diffusion, N={}, 20 steps'.format(n))
+        transient(n)
+        n *= 10
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,54 @@
+""" Compares shared-memory parallel residual assembly with CompiledModel.residual.
+
+    pde_model_disc is compiled at each grid size and its residual evaluated
+    serially, then by model.parallel_residual with one shard per worker for
+    each worker count, timing the best of a few evaluations. The pool only
+    scales with the cores actually available.
+
+    python benchmarks/bench_parallel_residual.py [max N] [workers...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy
+
+import model
+import model_library
+
+PARAMS = {'cl': 1.0, 'L': 1.0}
+
+
+def _best(function, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(max_n=10**7, *workers):
+    workers = workers or sorted({1, 2, 4, os.cpu_count()})
+    print('{} cores'.format(os.cpu_count()))
+    print('{:<12}{:>10}{:>12}{:>10}'.format('N', 'workers', 'seconds', 'speedup'))
+    n = 10**5
+    while n <= max_n:
+        compiled = model.compile_model(model_library.pde_model_disc(n, 1.0 / n))
+        y = numpy.random.default_rng(0).random(compiled.size)
+        p = compiled.parameter_values(PARAMS)
+        serial = _best(lambda: compiled.evaluate(y, p))
+        print('{:<12}{:>10}{:>12.5f}{:>10}'.format(n, 'serial', serial, ''))
+        for w in workers:
+            with model.parallel_residual(compiled, w) as residual:
+                residual.evaluate(y, p)
+                seconds = _best(lambda: residual.evaluate(y, p))
+            print('{:<12}{:>10}{:>12.5f}{:>10.2f}'.format(n, w, seconds, serial / seconds))
+        n *= 10
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,247 @@
+""" Scaling benchmarks for the model library pipeline.
+
+    Every model_library constructor is run through each pipeline stage:
+
+        construct   build the sympy Model
+        to_mathml   model_to_mathml (in-memory ElementTree)
+        serialize   write_mathml to bytes
+        mml2sympy   parse every <apply> of the serialized collection back
+        compile     compile_model, where the model is compilable
+        evaluate    one residual evaluation, or a march for explicit models
+
+    recording the best wall time over --repeat runs and the peak traced
+    memory of one extra run. The process-wide caches of compiled kernels
+    and emitted MathML are cleared before every run, so that each one
+    measures the full work rather than cache hits. The discretised models
+    run for N = 10, 100, ... up to --max-n; the default of 10**6 takes about
+    half a minute on one core. Results are written as JSON, and compared
+    against a saved baseline when one is given:
+
+        python benchmarks/suite.py --output bench.json
+        python benchmarks/suite.py --baseline bench.json --max-n 100000
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy
+import sympy
+
+import model
+import model_library
+from derivative.ContentMathML import mml2sympy_iterparse
+from model import compiler
+from model import emitter
+
+
+class Skip(Exception):
+    pass
+
+
+def construct(case):
+    return {'model': case['make']()}
+
+
+def _clear_caches(m):
+    # serializers reuse the output for unchanged models; measure a full run
+    m.clear_caches()
+    for i in m.includes:
+        i.clear_caches()
+        _clear_caches(i.submodel)
+
+
+def to_mathml(state):
+    _clear_caches(state['model'])
+    model.model_to_mathml(state['model'])
+
+
+def serialize(state):
+    _clear_caches(state['model'])
+    out = io.BytesIO()
+    model.write_mathml(state['model'], out)
+    state['mathml'] = out.getvalue()
+    state['bytes'] = len(state['mathml'])
+
+
+def mml2sympy(state):
+    state['expressions'] = sum(
+        1 for _ in mml2sympy_iterparse(io.BytesIO(state['mathml'])))
+
+
+def compile_stage(state):
+    try:
+        state['compiled'] = model.compile_model(state['model'])
+    except model.CompileError as e:
+        raise Skip(str(e))
+
+
+def evaluate(state):
+    compiled = state.get('compiled')
+    if compiled is None:
+        raise Skip('not compiled')
+    params = {p: 1.0 for p in compiled.parameters}
+    if compiled.is_differential:
+        compiled.residual(compiled.initial_values(params), params)
+        return
+    try:
+        compiled.march(params)
+    except model.CompileError:
+        compiled.residual(numpy.ones(compiled.size), params)
+
+
+STAGES = [
+    ('to_mathml', to_mathml),
+    ('serialize', serialize),
+    ('mml2sympy', mml2sympy),
+    ('compile', compile_stage),
+    ('evaluate', evaluate),
+]
+
+
+def cases(max_n):
+    out = {
+        'ode_model': model_library.ode_model,
+        'pde_model': model_library.pde_model,
+        'electrochemistry_model': model_library.electrochemistry_model,
+    }
+    n = 10
+    while n <= max_n:
+        out['ode_model_disc[N={}]'.format(n)] = \
+            lambda n=n: model_library.ode_model_disc(0.01, n)
+        out['pde_model_disc[N={}]'.format(n)] = \
+            lambda n=n: model_library.pde_model_disc(n, 1.0 / n)
+        out['pde_model_mol[N={}]'.format(n)] = \
+            lambda n=n: model.discretise(model_library.pde_model(),
+                                         sympy.Symbol('x'), n)
+        n *= 10
+    return out
+
+
+def _clear_process_caches():
+    compiler._lambdify.cache_clear()
+    compiler._lambdify_scalar.cache_clear()
+    emitter.emitter.clear()
+
+
+def _measure(function, argument, repeat):
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        _clear_process_caches()
+        start = time.perf_counter()
+        result = function(argument)
+        best = min(best, time.perf_counter() - start)
+    _clear_process_caches()
+    tracemalloc.start()
+    try:
+        function(argument)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak, result
+
+
+def run_case(make, repeat):
+    results = {}
+    t, peak, state = _measure(lambda _: construct({'make': make}), None, repeat)
+    results['construct'] = {'time': t, 'peak_bytes': peak}
+    for name, stage in STAGES:
+        try:
+            t, peak, _ = _measure(stage, state, repeat)
+        except Skip as e:
+            results[name] = {'skipped': str(e)}
+            continue
+        results[name] = {'time': t, 'peak_bytes': peak}
+    results['serialize']['mathml_bytes'] = state.get('bytes')
+    return results
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': numpy.__version__,
+        'sympy': sympy.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare(results, baseline, threshold, min_time=0.0):
+    """ Returns (case, stage, metric, old, new) for every time or peak
+        memory that grew by more than threshold over baseline. Times below
+        min_time in both runs are treated as noise.
+    """
+    regressions = []
+    for case, stages in results.items():
+        for stage, r in stages.items():
+            old = baseline.get(case, {}).get(stage, {})
+            for metric in ('time', 'peak_bytes'):
+                if metric in r and old.get(metric):
+                    if metric == 'time' and max(r[metric], old[metric]) < min_time:
+                        continue
+                    if r[metric] > threshold * old[metric]:
+                        regressions.append((case, stage, metric, old[metric], r[metric]))
+    return regressions
+
+
+def print_table(results):
+    stages = ['construct'] + [s for s, _ in STAGES]
+    print('{:<30}'.format('case') + ''.join('{:>13}'.format(s) for s in stages))
+    for case, r in results.items():
+        row = '{:<30}'.format(case)
+        for s in stages:
+            if 'time' in r[s]:
+                row += '{:>11.2f}ms'.format(1e3 * r[s]['time'])
+            else:
+                row += '{:>13}'.format('-')
+        print(row)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--threshold', type=float, default=1.5,
+                        help='flag metrics that grew by more than this factor')
+    parser.add_argument('--min-time', type=float, default=0.005,
+                        help='ignore time changes when both runs are faster '
+                             'than this many seconds')
+    parser.add_argument('--max-n', type=float, default=1e6,
+                        help='largest N for the discretised models')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--filter', default='',
+                        help='only run cases whose name contains this')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, make in cases(int(args.max_n)).items():
+        if args.filter in name:
+            results[name] = run_case(make, args.repeat)
+    print_table(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold, args.min_time)
+        for case, stage, metric, old, new in regressions:
+            print('REGRESSION {} {} {}: {:.4g} -> {:.4g} ({:.2f}x)'.format(
+                case, stage, metric, old, new, new / old))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
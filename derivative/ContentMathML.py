@@ -1,5 +1,5 @@
-""" Implements the function mml2sympy, a parser of Content MathML into a
-	string with the internal representation of the input.
+""" Implements the function mml2sympy, a parser of Content MathML into the
+	equivalent sympy expression, built directly from the lxml tree.
 
 	mml2sympy depends on sympy and the lxml library.
 
@@ -11,23 +11,29 @@ from sympy import *
 from sympy import printing
 from lxml import etree
 import logging
+import os
 
 INDENT_STR = '  '
 
 logger = logging.getLogger(__name__)
 
 mml2sympy_dict_not_supported = {
-    # Not supporting calculus for now
-    # 'diff': r'Derivative',
+    # Not supporting integration for now
     # 'int': r'Integral',
-
-    # Never supporting relations
-    # 'eq': r'Equality',
-    # 'neq': r'Unequality',
-    # 'geq': r'GreaterThan',
-    # 'leq': r'LessThan',
-    # 'gt': r'StrictGreaterThan',
-    # 'lt': r'StrictLessThan',
+}
+mml2sympy_dict_relations = {
+    # relations and logic appear in the equations and domains written by
+    # model.model_to_mathml
+    'eq': r'Eq',
+    'neq': r'Ne',
+    'geq': r'Ge',
+    'leq': r'Le',
+    'gt': r'Gt',
+    'lt': r'Lt',
+    'and': r'And',
+    'or': r'Or',
+    'not': r'Not',
+    'xor': r'Xor',
 }
 mml2sympy_dict_trig = {
     'sin': r'sin',
@@ -80,119 +86,246 @@ mml2sympy_dict = {
 }
 mml2sympy_dict.update(mml2sympy_dict_trig)
 mml2sympy_dict.update(mml2sympy_dict_trig_inverse)
+mml2sympy_dict.update(mml2sympy_dict_relations)
+
+
+mml2sympy_constants = {
+    'pi': pi,
+    'exponentiale': E,
+    'infinity': oo,
+    'imaginaryi': I,
+    'true': true,
+    'false': false,
+}
+
+mml2sympy_functions = {tag: globals()[name] for tag, name in mml2sympy_dict.items()
+                       if tag not in mml2sympy_constants}
+
+
+def strip_namespaces(mmltree):
+    """ Drops the MathML namespace from every tag of mmltree in place. """
+    for element in mmltree.iter(etree.Element):
+        if element.tag[0] == '{':
+            element.tag = element.tag.split('}', 1)[1]
+    return mmltree
 
 
 def mml2sympy(expression_raw):
-    if expression_raw.find('<math') >= 0:
-        expression_inner_start = expression_raw.find('>', expression_raw.find('<math')) + 1
-    else:
-        expression_inner_start = 0
-    expression_inner_math_ml = expression_raw[expression_inner_start:].replace('</math>', '')
-    logger.info(f'Begin mml2sympy{f", Stripped <math> tag" if expression_inner_start > 0 else ""}, '
-                f'expression_inner_math_ml: {expression_inner_math_ml}')
-    sympyified = sympify(mml2sympy_worker(etree.XML(expression_inner_math_ml)))
-    logger.info(f'Completed mml2sympy, sympyified: {sympyified}')
+    if isinstance(expression_raw, str):
+        expression_raw = expression_raw.encode('utf-8')
+    mmltree = strip_namespaces(etree.XML(expression_raw))
+    stripped = mmltree.tag == 'math'
+    if stripped:
+        mmltree = mmltree[0]
+    verbose = logger.isEnabledFor(logging.INFO)
+    if verbose:
+        logger.info(f'Begin mml2sympy{f", Stripped <math> tag" if stripped else ""}, '
+                    f'expression_inner_math_ml: {etree.tostring(mmltree).decode()}')
+    sympyified = mml2sympy_worker(mmltree, '' if verbose else None)
+    if verbose:
+        logger.info(f'Completed mml2sympy, sympyified: {sympyified}')
     return sympyified
 
 
-def mml2sympy_worker(mmltree, log_indent='', nested_value=''):
-    sympyres = r""
-    # #######################
-    # ## Non-atomic elements
-
-    if mmltree.tag == "apply":
-        logger.info(f'{log_indent}Begin an apply block'
-                    f'{f", nested_value: {nested_value}" if nested_value else ""}')
-        # Handle 'minus' tag
-        if mmltree[0].tag == 'minus':
-            if len(mmltree) == 2:
-                logger.info(f'{log_indent}In the apply minus block - applying a sign')
-                sympyres += r"Mul(Integer(-1),"
-                sympyres += mml2sympy_worker(mmltree[1], log_indent + INDENT_STR)
-            else:
-                logger.info(f'{log_indent}In the apply minus block - subtracting')
-                sympyres += r"Add("
-                sympyres += mml2sympy_worker(mmltree[1], log_indent + INDENT_STR)
-                sympyres += r",Mul(Integer(-1),"
-                sympyres += mml2sympy_worker(mmltree[2], log_indent + INDENT_STR)
-                sympyres += r")"
-        # Handle 'divide' tag
-        elif mmltree[0].tag == 'divide':
-            logger.info(f'{log_indent}In the apply divide block')
-            sympyres += r"Mul("
-            sympyres += mml2sympy_worker(mmltree[1], log_indent + INDENT_STR)
-            sympyres += r",Pow("
-            sympyres += mml2sympy_worker(mmltree[2], log_indent + INDENT_STR)
-            sympyres += r",Integer(-1)"
-            sympyres += r")"
-        # Handle 'root' tag
-        elif mmltree[0].tag == 'root':
-            logger.info(f'{log_indent}In the apply root block')
-            sympyres += r"Pow("
-            if mmltree[1].tag == 'degree':
-                sympyres += mml2sympy_worker(mmltree[2], log_indent + INDENT_STR)
-                sympyres += r",Pow("
-                sympyres += mml2sympy_worker(mmltree[1][0], log_indent + INDENT_STR)
-                sympyres += r",Integer(-1))"
-            else:
-                sympyres += mml2sympy_worker(mmltree[1], log_indent + INDENT_STR)
-                sympyres += r",Rational(1,2)"
-        # End: handle 'root' tag
-        elif mmltree[0].tag == 'log' and mmltree[1].tag == 'logbase':
-            logger.info(f'{log_indent}In the apply for log with logbase block')
-            sympyres += r"log("
-            sympyres += mml2sympy_worker(mmltree[2], log_indent + INDENT_STR)
-            sympyres += r","
-            sympyres += mml2sympy_worker(mmltree[1][0], log_indent + INDENT_STR)
-        # End: handle 'log' w/ 'logbase' tag
-        elif mmltree[0].tag == 'power' and mmltree[1].tag in ('exponentiale', 'exp'):
-            logger.info(f'{log_indent}In the apply for exponentiale inside a power block')
-            sympyres += r"exp("
-            sympyres += mml2sympy_worker(mmltree[2], log_indent + INDENT_STR)
-        # End: handle exponentiale inside power tag
-        elif mmltree[0].tag == 'inverse' and mmltree[1].tag in mml2sympy_dict_trig:
-            logger.info(f'{log_indent}In the apply for an inverse {mmltree[1].tag} block')
-            sympyres += r"a"
-            sympyres += mml2sympy_dict_trig[mmltree[1].tag]
-            sympyres += r"("
-        # End: handle inverse trig tag
-        elif mmltree[0].tag == 'apply':
-            logger.info(f'{log_indent}In the apply for an immediate apply block. next branch: {mmltree[0][0]}')
-            sympyres += mml2sympy_worker(mmltree[0], log_indent + INDENT_STR,
-                                         nested_value=mml2sympy_worker(mmltree[1], log_indent + INDENT_STR))
-        # End: handle immediately nested apply tag
+def mml2sympy_leaf(mmltree):
+    """ Builds the sympy atom for a leaf element from its tag, type attribute
+        and text, without sympifying the text.
+    """
+    tag = mmltree.tag
+    content = (mmltree.text or '').strip()
+    if tag == 'cn':
+        content_type = mmltree.get('type')
+        if content_type == 'integer':
+            return Integer(content)
+        if content_type in ('real', 'double', 'e-notation'):
+            return Float(content, dps=15)
+        try:
+            return Integer(int(content))
+        except ValueError:
+            return Float(content, dps=15)
+    if tag == 'ci':
+        if mmltree.get('type') == 'integer':
+            return Symbol(content, integer=True)
+        return Symbol(content)
+    if tag in mml2sympy_constants and len(mmltree) == 0:
+        return mml2sympy_constants[tag]
+    # indexed objects are written by sympy's generic Basic printer
+    if tag == 'indexed':
+        base = mml2sympy_leaf(mmltree[0])
+        return base[tuple(mml2sympy_worker(index) for index in mmltree[1:])]
+    if tag == 'indexedbase':
+        return IndexedBase(mml2sympy_worker(mmltree[0]))
+    if tag == 'idx':
+        label, *limits = [mml2sympy_worker(branch) for branch in mmltree]
+        if isinstance(label, Symbol):
+            label = label.name
+        return Idx(label, *limits)
+    raise NotImplementedError(f'{tag} is not currently supported')
+
+
+def mml2sympy_head(mmltree, log_indent=None):
+    """ Returns a callable for the operator of an immediately nested apply,
+        e.g. <apply><inverse/><sin/></apply>.
+    """
+    if log_indent is not None:
+        logger.info(f'{log_indent}In the apply for an immediate apply block. next branch: {mmltree[0]}')
+    if mmltree[0].tag == 'inverse' and mmltree[1].tag in mml2sympy_dict_trig:
+        return globals()['a' + mml2sympy_dict_trig[mmltree[1].tag]]
+    if mmltree[0].tag == 'apply':
+        return mml2sympy_head(mmltree[0], log_indent)
+    if mmltree[0].tag in mml2sympy_functions:
+        head = mml2sympy_functions[mmltree[0].tag]
+        leading = [mml2sympy_worker(branch, log_indent) for branch in mmltree[1:]]
+        return lambda *args: head(*leading, *args)
+    raise NotImplementedError(f'{mmltree[0].tag} is not currently supported')
+
+
+def mml2sympy_worker(mmltree, log_indent=None):
+    """ Converts an lxml Content MathML element into a sympy object.
+
+        log_indent is the indentation of the INFO log messages, or None to
+        skip logging altogether.
+    """
+    if mmltree.tag != "apply":
+        if log_indent is not None:
+            logger.info(f'{log_indent}Begin a non-apply block: {mmltree.tag}')
+        return mml2sympy_leaf(mmltree)
+
+    inner = None if log_indent is None else log_indent + INDENT_STR
+    head = mmltree[0].tag
+    if log_indent is not None:
+        logger.info(f'{log_indent}Begin an apply block with tag: {head}')
+    # Handle 'minus' tag
+    if head == 'minus':
+        if len(mmltree) == 2:
+            sympyres = Mul(Integer(-1), mml2sympy_worker(mmltree[1], inner))
+        else:
+            sympyres = Add(mml2sympy_worker(mmltree[1], inner),
+                           Mul(Integer(-1), mml2sympy_worker(mmltree[2], inner)))
+    # Handle 'divide' tag
+    elif head == 'divide':
+        sympyres = Mul(mml2sympy_worker(mmltree[1], inner),
+                       Pow(mml2sympy_worker(mmltree[2], inner), Integer(-1)))
+    # Handle 'root' tag
+    elif head == 'root':
+        if mmltree[1].tag == 'degree':
+            sympyres = Pow(mml2sympy_worker(mmltree[2], inner),
+                           Pow(mml2sympy_worker(mmltree[1][0], inner), Integer(-1)))
         else:
-            logger.info(f'{log_indent}In the apply else block with tag: {mmltree[0].tag}')
-            if mmltree[0].tag in mml2sympy_dict:
-                sympyres += mml2sympy_dict[mmltree[0].tag]
-                sympyres += r"("
-                for branch in list(mmltree)[1:]:
-                    sympyres += mml2sympy_worker(branch, log_indent + INDENT_STR)
-                    if branch != list(mmltree)[-1]:
-                        sympyres += r","
+            sympyres = Pow(mml2sympy_worker(mmltree[1], inner), Rational(1, 2))
+    elif head == 'log' and mmltree[1].tag == 'logbase':
+        sympyres = log(mml2sympy_worker(mmltree[2], inner),
+                       mml2sympy_worker(mmltree[1][0], inner))
+    elif head == 'power' and mmltree[1].tag in ('exponentiale', 'exp'):
+        sympyres = exp(mml2sympy_worker(mmltree[2], inner))
+    # Handle an equation restricted to a domain, as a (domain, equation) tuple
+    elif head in mml2sympy_dict_relations and mmltree[1].tag == 'domainofapplication':
+        sympyres = (mml2sympy_worker(mmltree[1][0], inner),
+                    mml2sympy_functions[head](*[mml2sympy_worker(branch, inner)
+                                                for branch in mmltree[2:]]))
+    # Handle an equation over an index range, as an (index, lower, upper,
+    # equation) tuple
+    elif head in mml2sympy_dict_relations and mmltree[1].tag == 'bvar' \
+            and len(mmltree) > 3 and mmltree[2].tag == 'lowlimit' \
+            and mmltree[3].tag == 'uplimit':
+        sympyres = (mml2sympy_worker(mmltree[1][0], inner),
+                    mml2sympy_worker(mmltree[2][0], inner),
+                    mml2sympy_worker(mmltree[3][0], inner),
+                    mml2sympy_functions[head](*[mml2sympy_worker(branch, inner)
+                                                for branch in mmltree[4:]]))
+    elif head in ('diff', 'partialdiff'):
+        variables = []
+        for branch in mmltree[1]:
+            if branch.tag == 'degree':
+                variables[-1] = (variables[-1][0], mml2sympy_worker(branch[0], inner))
             else:
-                raise NotImplementedError(f'{mmltree[0].tag} is not currently supported')
-        sympyres += nested_value
-        if mmltree[0].tag != 'apply':
-            sympyres += r")"
-    # ###################
-    # ## Atomic elements
+                variables.append((mml2sympy_worker(branch, inner), 1))
+        sympyres = Derivative(mml2sympy_worker(mmltree[2], inner), *reversed(variables))
+    # Handle an immediately nested apply, e.g. an inverse function
+    elif head == 'apply':
+        function = mml2sympy_head(mmltree[0], inner)
+        sympyres = function(*[mml2sympy_worker(branch, inner) for branch in mmltree[1:]])
+    elif head in mml2sympy_functions:
+        sympyres = mml2sympy_functions[head](
+            *[mml2sympy_worker(branch, inner) for branch in mmltree[1:]])
+    elif head in mml2sympy_dict_not_supported or len(mmltree[0]):
+        raise NotImplementedError(f'{head} is not currently supported')
+    # any other empty head is an undefined function such as c(t)
     else:
-        logger.info(f'{log_indent}Begin a non-apply block: {mmltree.tag}')
-        content = mmltree.text
-        content_type = type(sympify(content))
-        # Handle integer content (.text method) in 'cn' tags
-        if (content_type == Integer) or (str(content_type) == "<class 'sympy.core.numbers.One'>"):
-            sympyres += r"Integer(" + (content or '') + r")"
-        # Handle float content (.text method) in 'cn' tags
-        elif content_type == Float:
-            sympyres += r"Float('" + (content or '') + r"', dps = 15)"
-        # Handle symbol
-        else:
-            sympyres += r"Symbol('" + (content or '') + r"')"
+        sympyres = Function(head)(*[mml2sympy_worker(branch, inner) for branch in mmltree[1:]])
+
+    if log_indent is not None:
+        logger.info(f'{log_indent}Completed block worker of tag {mmltree.tag}, sympyres: {sympyres}')
+    return sympyres
+
+
+def mml2sympy_roots(source, tags=('apply',)):
+    """ Iterates over the outermost elements of source (a file name or file
+        object) whose tag is in tags, in document order, using lxml iterparse.
+
+        Each element is valid until the next one is requested; after that it
+        and everything before it are freed, so memory stays bounded by the
+        largest single expression rather than the document.
+    """
+    depth = 0
+    for event, element in etree.iterparse(source, events=('start', 'end')):
+        tag = element.tag
+        if tag[0] == '{':
+            tag = tag.split('}', 1)[1]
+        if tag in tags:
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth == 0:
+                yield strip_namespaces(element)
+        if event == 'end' and depth == 0:
+            element.clear(keep_tail=True)
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+
+
+def _mml2sympy_chunk(chunk):
+    return [mml2sympy(expression) for expression in chunk]
+
+
+def mml2sympy_iterparse(source, tags=('apply',), processes=1, chunksize=256,
+                        max_pending=None):
+    """ Yields the sympy expression of every outermost element of source whose
+        tag is in tags (by default every top level <apply>), in document order.
+
+        With processes > 1 (or None for one per core) the elements are
+        serialized in chunks of chunksize and parsed in a process pool; at most
+        max_pending chunks (default 2 per process) are in flight at a time.
+    """
+    verbose = logger.isEnabledFor(logging.INFO)
+    if processes == 1:
+        for element in mml2sympy_roots(source, tags):
+            yield mml2sympy_worker(element, '' if verbose else None)
+        return
 
-    logger.info(f'{log_indent}Completed block worker of tag {mmltree.tag}, sympyres: {sympyres}')
-    return (sympyres)
+    from concurrent.futures import ProcessPoolExecutor
+    from collections import deque
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * processes
+    with ProcessPoolExecutor(processes) as executor:
+        pending = deque()
+        chunk = []
+        for element in mml2sympy_roots(source, tags):
+            chunk.append(etree.tostring(element))
+            if len(chunk) == chunksize:
+                pending.append(executor.submit(_mml2sympy_chunk, chunk))
+                chunk = []
+                while len(pending) >= max_pending:
+                    yield from pending.popleft().result()
+        if chunk:
+            pending.append(executor.submit(_mml2sympy_chunk, chunk))
+        while pending:
+            yield from pending.popleft().result()
 
 
 def main():
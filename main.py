@@ -1,21 +1,55 @@
+import cProfile
+import os
+import sys
 import model
 import model_library
-import xml.etree.ElementTree as ET
-from lxml import etree
+from model_library import convert
 
 def print_model(smodel):
     print('sympy model is:')
     print(smodel)
-    mmodel = model.model_to_mathml(smodel)
     print('mathml model is: ')
-    print(etree.tostring(etree.fromstring(ET.tostring(mmodel)),
-        pretty_print=True).decode('utf-8'))
+    model.write_mathml(smodel, sys.stdout, indent='  ')
+    print()
 
-print_model(model_library.ode_model())
-print_model(model_library.ode_model_disc(0.1, 100))
-print_model(model_library.pde_model())
-print_model(model_library.pde_model_disc(100, 0.1))
-print_model(model_library.electrochemistry_model())
+def construct(make, *args):
+    with model.timings.measure('construct'):
+        return make(*args)
 
+def print_library():
+    print_model(construct(model_library.ode_model))
+    print_model(construct(model_library.ode_model_disc, 0.1, 100))
+    print_model(construct(model_library.pde_model))
+    print_model(construct(model_library.pde_model_disc, 100, 0.1))
+    print_model(construct(model_library.electrochemistry_model))
 
+def main(targets, args):
+    if not targets:
+        print_library()
+        return 0
+    return convert.run(targets, args)
 
+if __name__ == '__main__':
+    parser = convert.build_parser(
+        'Converts model_library models to MathML files; with no targets, '
+        'prints the model library as sympy and MathML.')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='run under cProfile and write the profile to FILE '
+                             '(read it with python -m pstats FILE)')
+    parser.add_argument('--timings', metavar='FILE',
+                        help='write the time spent in each pipeline stage to FILE as JSON')
+    args = parser.parse_args()
+    targets = convert.read_targets(parser, args)
+
+    if args.timings:
+        model.timings.enable()
+    if args.profile:
+        profile = cProfile.Profile()
+        status = profile.runcall(main, targets, args)
+        profile.dump_stats(args.profile)
+    else:
+        status = main(targets, args)
+    if args.timings:
+        model.timings.dump(args.timings)
+        print(model.timings, file=sys.stderr)
+    sys.exit(status)
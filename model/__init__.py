@@ -3,3 +3,44 @@ from .model import Model
 from .model import Models
 from .model import Include
 from .model import Connection
+from .model import ArrayEquation
+from .compiler import compile_model
+from .compiler import CompiledModel
+from .compiler import CompileError
+from .jacobian import sparse_jacobian
+from .jacobian import SparseJacobian
+from .jacobian import newton
+from .krylov import newton_krylov
+from .krylov import NewtonKrylov
+from .krylov import implicit_euler
+from .writer import write_mathml
+from .writer import write_models_mathml
+from .writer import MathMLWriter
+from .emitter import emit_mathml
+from .cache import fingerprint
+from .cache import canonical_order
+from .cache import ModelCache
+from .loader import CollectionFormatError
+from .loader import CollectionLoader
+from .loader import load_collection
+from .sweep import sweep
+from .sweep import parameter_grid
+from .discretise import discretise
+from .flatten import flatten
+from .freeze import freeze
+from .integrate import integrate
+from .structure import decompose
+from .structure import Decomposition
+from .cosim import cosimulate
+from .cosim import Scheduler
+from .binary import write_binary
+from .binary import load_binary
+from .binary import BinaryLoader
+from .store import march_to_store
+from .store import integrate_to_store
+from .store import open_solution
+from .store import SolutionWriter
+from .parallel import parallel_residual
+from .parallel import ParallelResidual
+from .timing import timings
+from .timing import timed
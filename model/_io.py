@@ -0,0 +1,37 @@
+""" Atomic file writes.
+
+    atomic_open writes to a temporary file in the directory of the target
+    and renames it into place when the block ends without an error, so a
+    reader never sees a partial file; after an error the temporary file is
+    removed and the target left as it was.
+
+        with atomic_open('model.json', 'w') as f:
+            f.write(text)
+"""
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='wb'):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        # mkstemp creates the file readable by its owner only; give it the
+        # mode open() would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def atomic_write(path, data):
+    """ Replaces the file at path by data, str or bytes, atomically. """
+    with atomic_open(path, 'w' if isinstance(data, str) else 'wb') as f:
+        f.write(data)
@@ -0,0 +1,476 @@
+""" Compact binary format for Model collections.
+
+    A binary collection stores every expression of its models once, in one
+    node table shared by all of them: equal subexpressions (the same c[i - 1]
+    in a hundred stencils, the same parameter in every equation) are hash
+    consed into a single node, and symbol and function names are interned
+    in a string table. The model and include structure refers to nodes by
+    number. The file is laid out as
+
+        header      magic, version and the offset and length of each section
+        strings     u8 offsets, then the UTF-8 text of each string
+        nodes       one packed record (kind, child count, first child,
+                    payload) per node, children before their parents
+        children    the u4 node numbers of the children of every node
+        structure   JSON: the models, their includes and connections
+
+    BinaryLoader maps the file into memory and decodes a node, and the
+    nodes below it, only when a model that uses it is asked for. Models
+    round trip exactly, so converting MathML to binary and back writes the
+    same MathML, up to the order of the members of sets.
+
+        write_binary(m, 'library.ocmlb')            # a Model or Models
+        with BinaryLoader('library.ocmlb') as loader:
+            m = loader['domain']
+"""
+
+import json
+import mmap
+import struct
+
+import numpy
+import sympy
+
+from ._io import atomic_write
+from .model import ArrayEquation
+from .model import Connection
+from .model import Include
+from .model import Model
+from .model import Models
+
+MAGIC = b'OCMLDAG\0'
+VERSION = 2
+
+_header = struct.Struct('<8sII6Q')
+
+node_dtype = numpy.dtype([('kind', 'u1'), ('count', '<u4'), ('first', '<u4'),
+                          ('payload', '<i8')])
+
+# node kinds
+SYMBOL = 0       # payload: name; an optional child STR holds the assumptions
+INTEGER = 1      # payload: the value
+BIG_INTEGER = 2  # payload: the decimal text
+FLOAT = 3        # payload: the mpf tuple and precision, as text
+SINGLETON = 4    # payload: the name in sympy.S, such as Pi or true
+APPLY = 5        # payload: the class name; children: args
+FUNCTION = 6     # payload: the name of an undefined function; children: args
+STR = 7          # payload: the text of a Python string
+TUPLE = 8        # a Python tuple, such as a (domain, equation) pair
+ARRAY = 9        # an ArrayEquation; children: index, lower, upper, stencil
+PYTHON_INT = 10  # payload: the value of a Python int
+SYMPY_STR = 11   # payload: the text of a sympy Str
+
+_int64 = (-2 ** 63, 2 ** 63 - 1)
+
+
+class BinaryFormatError(ValueError):
+    pass
+
+
+class Encoder:
+    def __init__(self):
+        self.strings = []
+        self.string_ids = {}
+        self.nodes = []
+        self.children = []
+        self.node_ids = {}
+
+    def string(self, text):
+        if text not in self.string_ids:
+            self.string_ids[text] = len(self.strings)
+            self.strings.append(text)
+        return self.string_ids[text]
+
+    def _node(self, kind, payload=0, children=()):
+        key = (kind, payload, tuple(children))
+        if key not in self.node_ids:
+            self.node_ids[key] = len(self.nodes)
+            self.nodes.append((kind, len(children), len(self.children), payload))
+            self.children.extend(children)
+        return self.node_ids[key]
+
+    def _parts(self, e):
+        """ The kind, payload and child objects of e. """
+        if isinstance(e, ArrayEquation):
+            return ARRAY, 0, [e.index, e.lower, e.upper, e.stencil]
+        if isinstance(e, tuple):
+            return TUPLE, 0, list(e)
+        if isinstance(e, str):
+            return STR, self.string(e), []
+        if isinstance(e, bool) or not isinstance(e, (int, sympy.Basic)):
+            raise BinaryFormatError('cannot encode {!r}'.format(e))
+        if isinstance(e, int):
+            if not _int64[0] <= e <= _int64[1]:
+                raise BinaryFormatError('Python integer {} is too large'.format(e))
+            return PYTHON_INT, e, []
+        if isinstance(e, sympy.Symbol) and type(e) is sympy.Symbol:
+            assumptions = e._assumptions_orig
+            if assumptions:
+                text = ','.join('{}={}'.format(k, v) for k, v in sorted(assumptions.items()))
+                return SYMBOL, self.string(e.name), [text]
+            return SYMBOL, self.string(e.name), []
+        if isinstance(e, sympy.core.symbol.Str):
+            return SYMPY_STR, self.string(e.name), []
+        if type(e) in _singleton_names:
+            return SINGLETON, self.string(_singleton_names[type(e)]), []
+        if isinstance(e, sympy.Integer):
+            if _int64[0] <= e.p <= _int64[1]:
+                return INTEGER, int(e.p), []
+            return BIG_INTEGER, self.string(str(e.p)), []
+        if isinstance(e, sympy.Float):
+            sign, man, exp, bc = e._mpf_
+            return FLOAT, self.string('{},{:x},{},{},{}'.format(
+                sign, man, exp, bc, e._prec)), []
+        if isinstance(e, sympy.core.function.AppliedUndef):
+            return FUNCTION, self.string(e.func.__name__), list(e.args)
+        if isinstance(e, (sympy.Dummy, sympy.Wild)):
+            raise BinaryFormatError('cannot encode {} of type {}'.format(e, type(e).__name__))
+        cls = type(e)
+        if _class(cls.__name__) is not cls:
+            raise BinaryFormatError('cannot encode class {}'.format(cls.__name__))
+        if isinstance(e, sympy.Rational):
+            return APPLY, self.string('Rational'), [int(e.p), int(e.q)]
+        return APPLY, self.string(cls.__name__), list(e.args)
+
+    def encode(self, e):
+        """ Returns the node number of e, adding its nodes to the table. """
+        # iterative post-order: expressions can nest deeper than the
+        # recursion limit allows
+        memo = self._memo = getattr(self, '_memo', {})
+        key = (type(e), e)
+        if key in memo:
+            return memo[key]
+        stack = [(e, None)]
+        while stack:
+            item, parts = stack.pop()
+            key = (type(item), item)
+            if key in memo:
+                continue
+            if parts is None:
+                parts = self._parts(item)
+                stack.append((item, parts))
+                stack.extend((c, None) for c in reversed(parts[2])
+                             if (type(c), c) not in memo)
+                continue
+            kind, payload, children = parts
+            memo[key] = self._node(kind, payload,
+                                   [memo[(type(c), c)] for c in children])
+        return memo[(type(e), e)]
+
+    def _items(self, items):
+        return [self.encode(i) for i in items]
+
+    def model(self, m, numbers):
+        parameters = m.parameters
+        return {
+            'name': m.name,
+            'bounds': None if m.bounds is None else self.encode(m.bounds),
+            'solution_variables': self._items(m.solution_variables),
+            'parameters': self._items(parameters),
+            'parameters_type': _container_type(parameters),
+            'eqs': self._items(m.eqs),
+            'includes': [{
+                'submodel': numbers[id(i.submodel)],
+                'bounds': None if i.bounds is None else self.encode(i.bounds),
+                'eqs': self._items(i.eqs),
+                'mapping': [[str(k), str(v)] for k, v in i.mapping.items()],
+            } for i in m.includes],
+        }
+
+    def tables(self):
+        blob = b''.join(s.encode('utf-8') for s in self.strings)
+        offsets = numpy.zeros(len(self.strings) + 1, dtype='<u8')
+        numpy.cumsum([len(s.encode('utf-8')) for s in self.strings], out=offsets[1:])
+        nodes = numpy.array(self.nodes, dtype=node_dtype)
+        children = numpy.array(self.children, dtype='<u4')
+        return offsets.tobytes() + blob, nodes.tobytes(), children.tobytes()
+
+
+# the container of a model's parameters: a set, a list (ordered, as in
+# electrochemistry_model) or a dict, of which only the keys are stored
+_containers = {'set': set, 'list': list, 'dict': dict.fromkeys}
+
+
+def _container_type(items):
+    if isinstance(items, dict):
+        return 'dict'
+    if isinstance(items, (list, tuple)):
+        return 'list'
+    return 'set'
+
+
+def _submodels(m, out, numbers):
+    if id(m) in numbers:
+        return
+    for i in m.includes:
+        _submodels(i.submodel, out, numbers)
+    numbers[id(m)] = len(out)
+    out.append(m)
+
+
+def encode_binary(d):
+    """ Returns the binary form of Model or Models d as bytes. """
+    roots = d.models if isinstance(d, Models) else [d]
+    models = []
+    numbers = {}
+    for m in roots:
+        _submodels(m, models, numbers)
+    encoder = Encoder()
+    structure = {
+        'models': [encoder.model(m, numbers) for m in models],
+        'roots': [numbers[id(m)] for m in roots],
+        'collection': isinstance(d, Models),
+        'connections': [[[numbers[id(end[0])], encoder.encode(end[1])]
+                         for end in (c.origin, c.to)] for c in d.connections]
+        if isinstance(d, Models) else [],
+    }
+    strings, nodes, children = encoder.tables()
+    structure = json.dumps(structure, separators=(',', ':')).encode('utf-8')
+    sections = [strings, nodes, children, structure]
+    out = [b'', strings, nodes, children, structure]
+    offset = _header.size
+    header = []
+    for s in sections:
+        header.append(offset)
+        offset += len(s)
+    counts = (len(encoder.strings), len(encoder.nodes))
+    out[0] = _header.pack(MAGIC, VERSION, 0, counts[0], counts[1], *header)
+    return b''.join(out)
+
+
+def write_binary(d, path):
+    """ Writes Model or Models d to path in the binary format, atomically. """
+    data = encode_binary(d)
+    atomic_write(path, data)
+    return len(data)
+
+
+_singleton_names = {}
+_classes = {}
+
+
+def _class(name):
+    if not _classes:
+        def walk(cls):
+            for sub in cls.__subclasses__():
+                _classes.setdefault(sub.__name__, sub)
+                walk(sub)
+        for k, v in vars(sympy).items():
+            if isinstance(v, type) and issubclass(v, sympy.Basic):
+                _classes[k] = v
+        walk(sympy.Basic)
+    return _classes.get(name)
+
+
+def _init_singletons():
+    for name in dir(sympy.S):
+        if not name.startswith('_'):
+            value = getattr(sympy.S, name)
+            if isinstance(value, sympy.Basic):
+                _singleton_names.setdefault(type(value), name)
+
+
+_init_singletons()
+
+
+class BinaryLoader:
+    """ Maps model names to Models, decoding each on first access.
+
+        loader = BinaryLoader('library.ocmlb')
+        loader.names()          # from the structure only
+        m = loader['domain']    # decodes 'domain' and the models it includes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._buffer = b''
+        if len(self._buffer) < _header.size:
+            raise BinaryFormatError('{} is not a binary model collection'.format(path))
+        magic, version, _, nstrings, nnodes, strings, nodes, children, structure = \
+            _header.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            raise BinaryFormatError('{} is not a binary model collection'.format(path))
+        if version != VERSION:
+            raise BinaryFormatError('{} has unknown version {}'.format(path, version))
+        self._string_offsets = numpy.frombuffer(self._buffer, '<u8', nstrings + 1, strings)
+        self._string_base = strings + 8 * (nstrings + 1)
+        self._nodes = numpy.frombuffer(self._buffer, node_dtype, nnodes, nodes)
+        self._children = numpy.frombuffer(self._buffer, '<u4',
+                                          (structure - children) // 4, children)
+        self._structure = json.loads(bytes(self._buffer[structure:]).decode('utf-8'))
+        self._strings = {}
+        self._decoded = {}
+        self._models = {}
+        self.index = {}
+        for k, m in enumerate(self._structure['models']):
+            self.index.setdefault(m['name'], k)
+
+    def close(self):
+        # arrays viewing the map must go before it can be closed
+        self._string_offsets = self._nodes = self._children = None
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, name):
+        return self.model(name)
+
+    def names(self):
+        return list(self.index)
+
+    def loaded(self):
+        return [self._structure['models'][k]['name'] for k in self._models]
+
+    @property
+    def decoded(self):
+        """ The number of nodes decoded so far. """
+        return len(self._decoded)
+
+    def string(self, k):
+        if k not in self._strings:
+            start = self._string_base + int(self._string_offsets[k])
+            stop = self._string_base + int(self._string_offsets[k + 1])
+            self._strings[k] = bytes(self._buffer[start:stop]).decode('utf-8')
+        return self._strings[k]
+
+    def node(self, k):
+        """ Decodes node k and the nodes below it. """
+        if k in self._decoded:
+            return self._decoded[k]
+        stack = [k]
+        with sympy.evaluate(False):
+            while stack:
+                n = stack[-1]
+                if n in self._decoded:
+                    stack.pop()
+                    continue
+                kind, count, first, payload = self._nodes[n].tolist()
+                children = self._children[first:first + count].tolist()
+                missing = [c for c in children if c not in self._decoded]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                stack.pop()
+                self._decoded[n] = self._build(kind, payload,
+                                               [self._decoded[c] for c in children])
+        return self._decoded[k]
+
+    def _build(self, kind, payload, args):
+        if kind == SYMBOL:
+            assumptions = {}
+            if args:
+                for item in args[0].split(','):
+                    key, value = item.split('=')
+                    assumptions[key] = value == 'True'
+            return sympy.Symbol(self.string(payload), **assumptions)
+        if kind == INTEGER:
+            return sympy.Integer(payload)
+        if kind == BIG_INTEGER:
+            return sympy.Integer(int(self.string(payload)))
+        if kind == FLOAT:
+            sign, man, exp, bc, prec = self.string(payload).split(',')
+            return sympy.Float._new((int(sign), int(man, 16), int(exp), int(bc)), int(prec))
+        if kind == SINGLETON:
+            return getattr(sympy.S, self.string(payload))
+        if kind == APPLY:
+            name = self.string(payload)
+            if name == 'Rational':
+                return sympy.Rational(*args)
+            cls = _class(name)
+            if cls is None:
+                raise BinaryFormatError('unknown class {} in {}'.format(name, self.path))
+            return cls(*args)
+        if kind == FUNCTION:
+            return sympy.Function(self.string(payload))(*args)
+        if kind == STR:
+            return self.string(payload)
+        if kind == TUPLE:
+            return tuple(args)
+        if kind == ARRAY:
+            return ArrayEquation(*args)
+        if kind == PYTHON_INT:
+            return payload
+        if kind == SYMPY_STR:
+            return sympy.core.symbol.Str(self.string(payload))
+        raise BinaryFormatError('unknown node kind {} in {}'.format(kind, self.path))
+
+    def _nodes_of(self, items):
+        return [self.node(k) for k in items]
+
+    def model(self, name, number=None):
+        """ Returns the Model called name, or the number-th model stored. """
+        k = self.index[name] if number is None else number
+        if k in self._models:
+            return self._models[k]
+        s = self._structure['models'][k]
+        m = Model()
+        self._models[k] = m
+        m.name = s['name']
+        m.bounds = None if s['bounds'] is None else self.node(s['bounds'])
+        m.solution_variables = set(self._nodes_of(s['solution_variables']))
+        parameters = self._nodes_of(s['parameters'])
+        m.parameters = _containers[s['parameters_type']](parameters)
+        m.eqs = set(self._nodes_of(s['eqs']))
+        includes = set()
+        for i in s['includes']:
+            includes.add(Include(self.model(None, i['submodel']),
+                                 None if i['bounds'] is None else self.node(i['bounds']),
+                                 set(self._nodes_of(i['eqs'])), dict(i['mapping'])))
+        m.includes = includes
+        return m
+
+    def main_models(self):
+        return [self.model(None, k) for k in self._structure['roots']]
+
+    def models(self):
+        """ Rebuilds the Models, or the Model, that was written. """
+        if not self._structure['collection']:
+            return self.main_models()[0]
+        out = Models()
+        out.models = self.main_models()
+        out.connections = [Connection(*[(self.model(None, m), self.node(e))
+                                        for m, e in c])
+                           for c in self._structure['connections']]
+        return out
+
+
+def load_binary(path):
+    return BinaryLoader(path)
+
+
+def mathml_to_binary(source, path):
+    """ Converts the MathML collection file source to a binary file at path. """
+    from .loader import CollectionLoader
+    with CollectionLoader(source) as loader:
+        return write_binary(loader.contents(), path)
+
+
+def binary_to_mathml(source, stream, indent=None):
+    """ Writes the binary collection file source as MathML to stream. """
+    from .writer import write_mathml
+    from .writer import write_models_mathml
+    with BinaryLoader(source) as loader:
+        d = loader.models()
+        if isinstance(d, Models):
+            write_models_mathml(d, stream, indent)
+        else:
+            write_mathml(d, stream, indent)
@@ -0,0 +1,184 @@
+""" Content-addressed on-disk cache for serialized and compiled models.
+
+    A model's fingerprint is the SHA-256 of a canonical text form of its name,
+    bounds, solution variables, parameters, equations and (recursively) its
+    includes. Sets are put in a canonical order by sorting on sympy's srepr,
+    which, unlike iteration order, does not depend on the process hash seed.
+"""
+
+import hashlib
+import io
+import os
+import pickle
+
+import sympy
+
+from ._io import atomic_write
+from .compiler import compile_model
+from .model import ArrayEquation
+from .writer import write_mathml
+
+# part of the name of every cache entry; bump it whenever the serialized
+# MathML or the pickled CompiledModel, Branch or Update change, so that
+# entries written by an older version are never read back
+FORMAT = 2
+
+
+def canonical(e):
+    """ A process-independent text form of a model component. """
+    if isinstance(e, ArrayEquation):
+        return 'array({})'.format(', '.join(canonical(i) for i in (
+            e.index, e.lower, e.upper, e.stencil)))
+    if isinstance(e, tuple):
+        return '({})'.format(', '.join(canonical(i) for i in e))
+    if isinstance(e, (set, frozenset)):
+        return '{{{}}}'.format(', '.join(canonical_order(e)))
+    if isinstance(e, list):
+        return '[{}]'.format(', '.join(canonical(i) for i in e))
+    if isinstance(e, dict):
+        return '{{{}}}'.format(', '.join(sorted(
+            '{}: {}'.format(canonical(k), canonical(v)) for k, v in e.items())))
+    if isinstance(e, str):
+        return repr(e)
+    return sympy.srepr(e)
+
+
+def canonical_order(items):
+    """ Returns the canonical forms of items, sorted. """
+    return sorted(canonical(i) for i in items)
+
+
+def _model_text(m, out, seen):
+    out.write('model {!r}\n'.format(m.name))
+    out.write('bounds {}\n'.format(canonical(m.bounds)))
+    out.write('solution_variables {}\n'.format(canonical(set(m.solution_variables))))
+    # parameter order does not change the model, only dependencies between
+    # them, which are explicit in their equations
+    out.write('parameters {}\n'.format(canonical(set(m.parameters))))
+    out.write('eqs {}\n'.format(canonical(set(m.eqs))))
+    includes = []
+    for i in m.includes:
+        includes.append('include bounds {} eqs {} mapping {} submodel {}'.format(
+            canonical(i.bounds), canonical(set(i.eqs)), canonical(i.mapping),
+            _fingerprint(i.submodel, seen)))
+    out.write('includes {}\n'.format('\n'.join(sorted(includes))))
+
+
+def _fingerprint(m, seen):
+    key = id(m)
+    if key not in seen:
+        out = io.StringIO()
+        _model_text(m, out, seen)
+        seen[key] = hashlib.sha256(out.getvalue().encode('utf-8')).hexdigest()
+    return seen[key]
+
+
+def fingerprint(m):
+    """ Returns the hex SHA-256 fingerprint of Model m. """
+    return _fingerprint(m, {})
+
+
+def default_cache_directory():
+    return os.environ.get('OCML_CACHE_DIR', os.path.join(
+        os.path.expanduser('~'), '.cache', 'open_continuous_modelling_language'))
+
+
+class ModelCache:
+    """ Files keyed by (fingerprint, kind) under directory, evicted least
+        recently used first once their total size exceeds max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+        self.directory = directory or default_cache_directory()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = sum(os.path.getsize(p) for p, _ in self._entries())
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'bytes': self.size,
+                'max_bytes': self.max_bytes}
+
+    def path(self, key, kind):
+        return os.path.join(self.directory, key[:2],
+                            '{}.v{}.{}'.format(key, FORMAT, kind))
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for f in files:
+                if not f.startswith('.'):
+                    p = os.path.join(root, f)
+                    yield p, os.stat(p)
+
+    def get(self, key, kind):
+        """ Returns the cached bytes for (key, kind), or None. """
+        p = self.path(key, kind)
+        try:
+            with open(p, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # the modification time records the last use, for LRU eviction
+        os.utime(p)
+        self.hits += 1
+        return data
+
+    def put(self, key, kind, data):
+        p = self.path(key, kind)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        try:
+            replaced = os.path.getsize(p)
+        except FileNotFoundError:
+            replaced = 0
+        atomic_write(p, data)
+        self.size += len(data) - replaced
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+        self.size = sum(s.st_size for _, s in entries)
+        for p, s in entries:
+            if self.size <= self.max_bytes:
+                break
+            os.remove(p)
+            self.size -= s.st_size
+            self.evictions += 1
+
+    def clear(self):
+        for p, _ in list(self._entries()):
+            os.remove(p)
+        self.size = 0
+
+    def mathml(self, m, key=None):
+        """ Returns the serialized MathML collection for Model m as bytes. """
+        key = key or fingerprint(m)
+        data = self.get(key, 'xml')
+        if data is None:
+            out = io.BytesIO()
+            write_mathml(m, out)
+            data = out.getvalue()
+            self.put(key, 'xml', data)
+        return data
+
+    def compiled(self, m, key=None):
+        """ Returns the CompiledModel for Model m; the cached form keeps the
+            branch expressions and rebuilds the NumPy kernels from them.
+        """
+        key = key or fingerprint(m)
+        data = self.get(key, 'compiled')
+        if data is not None:
+            try:
+                return pickle.loads(data)
+            except Exception:
+                # unreadable, e.g. truncated or from an incompatible version:
+                # rebuild it
+                self.hits -= 1
+                self.misses += 1
+        compiled = compile_model(m)
+        self.put(key, 'compiled', pickle.dumps(compiled, pickle.HIGHEST_PROTOCOL))
+        return compiled
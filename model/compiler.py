@@ -0,0 +1,593 @@
+""" Compiles a Model into vectorized NumPy kernels.
+
+    Every equation (or guarded (domain, equation) tuple, such as an
+    ArrayEquation) of a model becomes a branch: one lambdified expression
+    that is evaluated over a contiguous range of rows in a single call, with
+    each c[i + k] reference replaced by a shifted slice of the flat state
+    vector. The residual of the compiled model is
+
+        M dy/dt = F(t, y, p)
+
+    where M is the diagonal `mass` vector, 1 for rows given by an equation for
+    Derivative(v, t) and 0 for algebraic rows. Purely discrete models, such as
+    those in model_library built on IndexedBase, have M = 0 and F(y) = 0.
+"""
+
+import collections
+import functools
+import numbers
+import numpy
+import sympy
+
+from runtime.evaluation import apply_updates
+from runtime.evaluation import batch_shape
+from runtime.evaluation import evaluate
+from runtime.evaluation import parameter_values
+
+from .timing import timed
+from .timing import timings
+
+
+class CompileError(ValueError):
+    pass
+
+
+class Variable:
+    def __init__(self, name, start, size, indexed):
+        self.name = name
+        self.start = start
+        self.size = size
+        self.indexed = indexed
+
+    def __repr__(self):
+        return 'Variable({!r}, start={}, size={})'.format(
+            self.name, self.start, self.size)
+
+
+class Branch:
+    def __init__(self, expr, first, last, rows, symbols, offsets, args, kernel,
+                 differential, arguments, cse=False):
+        self.expr = expr
+        self.first = first
+        self.last = last
+        self.rows = rows
+        self.symbols = symbols
+        self.offsets = offsets
+        self.args = args
+        self.kernel = kernel
+        self.differential = differential
+        self.arguments = arguments
+        self.cse = cse
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['kernel']
+        return state
+
+    def __setstate__(self, state):
+        self.cse = False
+        self.__dict__.update(state)
+        self.kernel = _lambdify(tuple(self.symbols) + self.arguments, self.expr,
+                                self.cse)
+
+
+class Update:
+    def __init__(self, branch, target, positions, kernel, lag, expr, variable,
+                 arguments, scalar_kernel):
+        self.branch = branch
+        self.target = target
+        self.positions = positions
+        self.kernel = kernel
+        self.lag = lag
+        self.expr = expr
+        self.variable = variable
+        self.arguments = arguments
+        self.scalar_kernel = scalar_kernel
+
+    @property
+    def first(self):
+        return self.branch.first
+
+    @property
+    def last(self):
+        return self.branch.last
+
+
+class CompiledModel:
+    def __init__(self, name, index, lower, upper, time, variables, parameters,
+                 defaults, branches, initial, arguments, cse=False):
+        self.name = name
+        self.index = index
+        self.lower = lower
+        self.upper = upper
+        self.time = time
+        self.variables = variables
+        self.parameters = parameters
+        self.defaults = defaults
+        self.branches = branches
+        self.initial = initial
+        self.arguments = arguments
+        self.cse = cse
+        self.size = sum(v.size for v in variables.values())
+        self.mass = numpy.zeros(self.size)
+        for b in branches:
+            if b.differential:
+                self.mass[b.rows] = 1.0
+        self._updates = None
+
+    def __getstate__(self):
+        # kernels are rebuilt from their expressions when unpickled
+        state = dict(self.__dict__)
+        state['initial'] = [(name, expr) for name, expr, _ in self.initial]
+        state['_updates'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.cse = False
+        self.__dict__.update(state)
+        self.initial = [(name, expr, _lambdify(self.arguments[1:], expr, self.cse))
+                        for name, expr in self.initial]
+
+    def __str__(self):
+        out = 'Compiled model "{}":\n'.format(self.name)
+        out = out + 'size: {}\n'.format(self.size)
+        out = out + 'parameters: {}\n'.format(', '.join(self.parameters))
+        for b in self.branches:
+            out = out + '[{}:{}] {}\n'.format(b.rows.start, b.rows.stop, b.expr)
+        return out
+
+    @property
+    def is_differential(self):
+        return bool(self.mass.any())
+
+    def parameter_values(self, params=None):
+        return parameter_values(self.parameters, self.defaults, params, CompileError)
+
+    def batch_shape(self, p):
+        return batch_shape(p)
+
+    def slice(self, name):
+        v = self.variables[name]
+        return slice(v.start, v.start + v.size)
+
+    def residual(self, y, params=None, t=0.0, out=None):
+        """ Evaluates F(t, y, p); leading dimensions of y are batch axes. """
+        y = numpy.asarray(y, dtype=float)
+        return self.evaluate(y, self.parameter_values(params), t, out)
+
+    def evaluate(self, y, p, t=0.0, out=None):
+        """ residual() for parameter values p already converted by
+            parameter_values, as used by solvers that call it repeatedly.
+        """
+        return evaluate(self.branches, self.size, y, p, t, out)
+
+    def initial_values(self, params=None, y0=None):
+        p = self.parameter_values(params)
+        if y0 is None:
+            y0 = numpy.zeros(self.batch_shape(p) + (self.size,))
+        for name, _, kernel in self.initial:
+            y0[..., self.slice(name)] = kernel(*p)
+        return y0
+
+    def step(self, y, start, stop, params=None, t=0.0):
+        """ Fills the unknowns at indices start..stop - 1 of y in place from
+            the ones before them; y may carry leading batch axes.
+        """
+        return apply_updates(y, self.updates(), start, stop,
+                             self.parameter_values(params), t)
+
+    @timed('solve')
+    def march(self, params=None, t=0.0, out=None):
+        """ Solves a lower-triangular discrete model by forward substitution,
+            evaluating each dependency-free block of indices in one call.
+        """
+        if out is None:
+            p = self.parameter_values(params)
+            out = numpy.zeros(self.batch_shape(p) + (self.size,))
+        return self.step(out, self.lower, self.upper + 1, params, t)
+
+    def updates(self):
+        if self._updates is None:
+            self._updates = _explicit_updates(self)
+        return self._updates
+
+
+@functools.lru_cache(maxsize=None)
+def _lambdify(args, expr, cse=False):
+    # with cse, repeated subexpressions are computed once per call
+    return sympy.lambdify(args, expr, modules='numpy', cse=cse)
+
+
+@functools.lru_cache(maxsize=None)
+def _lambdify_scalar(args, expr, cse=False):
+    return sympy.lambdify(args, expr, modules='math', cse=cse)
+
+
+def _ordered(items):
+    return sorted(items, key=str)
+
+
+def index_range(cond, index, lower=None, upper=None):
+    """ Returns the inclusive integer range (lower, upper) on which cond holds. """
+    if cond is None or cond is sympy.true:
+        return lower, upper
+    if isinstance(cond, sympy.And):
+        for arg in cond.args:
+            lower, upper = index_range(arg, index, lower, upper)
+        return lower, upper
+    if not isinstance(cond, sympy.core.relational.Relational):
+        raise CompileError('cannot use "{}" as an index domain'.format(cond))
+    if cond.lhs != index:
+        cond = cond.reversed
+    if cond.lhs != index or not cond.rhs.is_Integer:
+        raise CompileError('cannot use "{}" as an index domain'.format(cond))
+    v = int(cond.rhs)
+    if isinstance(cond, sympy.Eq):
+        a, b = v, v
+    elif isinstance(cond, sympy.Ge):
+        a, b = v, None
+    elif isinstance(cond, sympy.Gt):
+        a, b = v + 1, None
+    elif isinstance(cond, sympy.Le):
+        a, b = None, v
+    elif isinstance(cond, sympy.Lt):
+        a, b = None, v - 1
+    else:
+        raise CompileError('cannot use "{}" as an index domain'.format(cond))
+    if a is not None:
+        lower = a if lower is None else max(lower, a)
+    if b is not None:
+        upper = b if upper is None else min(upper, b)
+    return lower, upper
+
+
+def _name(s):
+    if isinstance(s, sympy.Indexed):
+        return str(s.base.label)
+    if isinstance(s, sympy.core.function.AppliedUndef):
+        return s.func.__name__
+    return str(s)
+
+
+def _placeholder(name, k, absolute=False):
+    if absolute:
+        return sympy.Symbol('{}__at{}'.format(name, k))
+    if k == 0:
+        return sympy.Symbol('{}__0'.format(name))
+    return sympy.Symbol('{}__{}{}'.format(name, 'm' if k < 0 else 'p', abs(k)))
+
+
+def parameter_definitions(parameters):
+    """ Splits Model.parameters into the declared symbols, definitions of
+        dependent parameters (resolved in terms of the others) and numeric
+        defaults.
+    """
+    declared = []
+    definitions = {}
+    defaults = {}
+    for p in parameters:
+        if isinstance(p, sympy.Eq):
+            lhs, rhs = p.args
+            declared.append(lhs)
+            if isinstance(rhs, (numbers.Number, sympy.Number)):
+                defaults[str(lhs)] = float(rhs)
+            else:
+                definitions[lhs] = rhs
+        else:
+            declared.append(p)
+    for _ in range(len(definitions)):
+        resolved = {k: v.xreplace(definitions) for k, v in definitions.items()}
+        if resolved == definitions:
+            break
+        definitions = resolved
+    return declared, definitions, defaults
+
+
+def _index_bounds(bounds, index):
+    # other relations of the bounds, such as t > 0, do not limit the index
+    if isinstance(bounds, sympy.And):
+        return sympy.And(*[r for r in bounds.args if index in r.free_symbols])
+    return bounds
+
+
+def _sized(domain, defaults):
+    # index ranges may be written in terms of parameters with integer
+    # defaults, such as ArrayEquation(i, 1, N - 1, ...) with Eq(N, 100)
+    if not isinstance(domain, sympy.Basic):
+        return domain
+    sizes = {s: int(defaults[str(s)]) for s in domain.free_symbols
+             if str(s) in defaults and float(defaults[str(s)]).is_integer()}
+    return domain.subs(sizes) if sizes else domain
+
+
+def _expand_parameters(expr, definitions, unknowns):
+    expr = expr.xreplace(definitions)
+
+    def evaluate(d):
+        if _name(d.expr) in unknowns:
+            return d
+        return d.doit()
+    return expr.replace(lambda e: isinstance(e, sympy.Derivative), evaluate)
+
+
+def _unknowns(m):
+    names = []
+    indexed = set()
+    index = None
+    for s in _ordered(m.solution_variables):
+        names.append(_name(s))
+        if isinstance(s, sympy.Indexed):
+            if len(s.indices) != 1:
+                raise CompileError('only one dimensional indexing is supported')
+            if index is not None and s.indices[0] != index:
+                raise CompileError('all indexed variables must share one index')
+            index = s.indices[0]
+            indexed.add(_name(s))
+    return names, indexed, index
+
+
+def _time_variable(eqs, unknowns):
+    for eq in eqs:
+        for d in eq.atoms(sympy.Derivative):
+            if _name(d.expr) in unknowns and len(d.variable_count) == 1 \
+                    and d.variable_count[0][1] == 1:
+                return d.variable_count[0][0]
+    return None
+
+
+@timed('compile')
+def compile_model(m, cse=False):
+    """ Compiles Model m into a CompiledModel of vectorized branch kernels.
+        With cse, each kernel evaluates its common subexpressions once.
+    """
+    names, indexed, index = _unknowns(m)
+    unknowns = set(names)
+    declared, definitions, defaults = parameter_definitions(m.parameters)
+
+    plain = []
+    guarded = []
+    for eq in _ordered(m.eqs):
+        if isinstance(eq, tuple):
+            guarded.append((_sized(eq[0], defaults),
+                            _expand_parameters(eq[1], definitions, unknowns)))
+        else:
+            plain.append(_expand_parameters(eq, definitions, unknowns))
+
+    time = _time_variable(plain + [g[1] for g in guarded], unknowns)
+    time_symbol = time if time is not None else sympy.Symbol('t')
+
+    if index is not None:
+        lower, upper = index_range(_sized(_index_bounds(m.bounds, index),
+                                          defaults), index)
+        if lower is None or upper is None:
+            raise CompileError('bounds of "{}" do not give a finite index range'
+                               .format(m.name))
+    else:
+        lower, upper = 0, 0
+
+    variables = collections.OrderedDict()
+    start = 0
+    for name in names:
+        size = upper - lower + 1 if name in indexed else 1
+        variables[name] = Variable(name, start, size, name in indexed)
+        start += size
+
+    # split equations into index ranges, initial conditions and scalar equations;
+    # a guarded equation takes precedence over a plain one on its range
+    initial_eqs = []
+    ranged = []
+    covered = []
+    for domain, eq in guarded:
+        if time is not None and isinstance(domain, sympy.Eq) \
+                and time in domain.free_symbols:
+            initial_eqs.append(eq)
+            continue
+        if index is None or index not in domain.free_symbols:
+            raise CompileError(
+                'equation "{}" on "{}" is not on an index range; discretise the '
+                'model first'.format(eq, domain))
+        a, b = index_range(domain, index, lower, upper)
+        if a <= b:
+            ranged.append((a, b, eq))
+            covered.append((a, b))
+    for eq in plain:
+        if index is None or not any(index in s.free_symbols
+                                    for s in eq.atoms(sympy.Indexed)):
+            ranged.append((None, None, eq))
+            continue
+        a = lower
+        for c0, c1 in sorted(covered):
+            if c0 > a:
+                ranged.append((a, c0 - 1, eq))
+            a = max(a, c1 + 1)
+        if a <= upper:
+            ranged.append((a, upper, eq))
+
+    prepared = [_prepare(eq, a, b, index, lower, variables, time)
+                for a, b, eq in ranged]
+
+    free = set()
+    for p in prepared:
+        free |= p['expr'].free_symbols - set(p['offsets'])
+    for eq in initial_eqs:
+        free |= eq.rhs.free_symbols
+    parameters = sorted((s for s in free
+                         if str(s) not in unknowns and s != index and s != time
+                         and not isinstance(s, sympy.Idx)), key=str)
+
+    claimed = []
+    branches = []
+    for p in sorted(prepared, key=lambda p: not p['differential']):
+        branches.append(_branch(p, lower, variables, claimed, time_symbol,
+                                parameters, cse))
+    size = sum(v.size for v in variables.values())
+    missing = size - sum(s.stop - s.start for s in claimed)
+    if missing:
+        raise CompileError('model "{}" has no equation for {} of its {} unknowns'
+                           .format(m.name, missing, size))
+    branches.sort(key=lambda b: b.rows.start)
+
+    initial = []
+    for eq in initial_eqs:
+        name = _name(eq.lhs)
+        if name not in unknowns:
+            raise CompileError('initial condition "{}" is not for an unknown'
+                               .format(eq))
+        initial.append((name, eq.rhs, _lambdify(tuple(parameters), eq.rhs, cse)))
+
+    compiled = CompiledModel(m.name, index, lower, upper, time, variables,
+                             [str(p) for p in parameters], defaults, branches,
+                             initial, (time_symbol,) + tuple(parameters), cse)
+    timings.count('compile', 'branches', len(branches))
+    timings.count('compile', 'rows', compiled.size)
+    return compiled
+
+
+def _prepare(eq, a, b, index, lower, variables, time):
+    # unknowns become placeholder symbols, whether written c, c(t) or c[i + k]
+    replace = {}
+    offsets = {}
+    for f in eq.atoms(sympy.core.function.AppliedUndef):
+        if f.func.__name__ in variables:
+            replace[f] = sympy.Symbol(f.func.__name__)
+    for s in eq.atoms(sympy.Indexed):
+        name = _name(s)
+        if name not in variables:
+            raise CompileError('"{}" is not a solution variable'.format(s))
+        v = variables[name]
+        absolute = index not in s.indices[0].free_symbols
+        k = s.indices[0] if absolute else sympy.expand(s.indices[0] - index)
+        if not k.is_Integer:
+            raise CompileError('"{}" is not at a constant offset of {}'
+                               .format(s, index))
+        k = int(k)
+        if absolute:
+            inside = lower <= k < lower + v.size
+        else:
+            inside = a is not None and a + k >= lower \
+                and b + k < lower + v.size
+        if not inside:
+            raise CompileError('equation "{}" reaches outside the bounds at {}'
+                               .format(eq, s))
+        replace[s] = _placeholder(name, k, absolute)
+        offsets[replace[s]] = (name, k, absolute)
+    eq = eq.xreplace(replace)
+    for s in eq.free_symbols:
+        if str(s) in variables and not variables[str(s)].indexed:
+            offsets[s] = (str(s), 0, True)
+
+    expr = eq.lhs - eq.rhs
+    derivatives = [d for d in expr.atoms(sympy.Derivative) if d.expr in offsets]
+    derivative = None
+    if derivatives:
+        if len(derivatives) != 1 or time is None:
+            raise CompileError('equation "{}" must have a single time derivative'
+                               .format(eq))
+        derivative = derivatives[0]
+        if eq.lhs == derivative:
+            expr = eq.rhs
+        elif eq.rhs == derivative:
+            expr = eq.lhs
+        else:
+            solved = sympy.solve(expr, derivative)
+            if len(solved) != 1:
+                raise CompileError('cannot solve "{}" for {}'.format(eq, derivative))
+            expr = solved[0]
+    return {'expr': expr, 'a': a, 'b': b, 'offsets': offsets,
+            'differential': derivative is not None, 'derivative': derivative}
+
+
+def _rows(variable, k, absolute, a, b, lower):
+    if not variable.indexed:
+        return slice(variable.start, variable.start + 1)
+    if absolute or a is None:
+        return slice(variable.start + k - lower, variable.start + k - lower + 1)
+    return slice(variable.start + a - lower + k, variable.start + b - lower + k + 1)
+
+
+def _free(rows, claimed):
+    return all(rows.stop <= s.start or rows.start >= s.stop for s in claimed)
+
+
+def _branch(p, lower, variables, claimed, time_symbol, parameters, cse=False):
+    a, b, offsets, expr = p['a'], p['b'], p['offsets'], p['expr']
+    if p['differential']:
+        name, k, absolute = offsets[p['derivative'].expr]
+        rows = _rows(variables[name], k, absolute, a, b, lower)
+    else:
+        # prefer an unknown at the equation's own index, then any other
+        if a is None:
+            names = sorted(o[0] for o in offsets.values()
+                           if not variables[o[0]].indexed)
+            names += [n for n, v in variables.items() if not v.indexed]
+        else:
+            present = sorted((o[1] != 0, o[0]) for o in offsets.values()
+                             if not o[2])
+            names = [n for _, n in present]
+            names += [n for n, v in variables.items() if v.indexed]
+        rows = None
+        for name in names:
+            r = _rows(variables[name], 0, False, a, b, lower)
+            if _free(r, claimed):
+                rows = r
+                break
+        if rows is None:
+            raise CompileError('equation "{}" has no unknown left to solve for'
+                               .format(expr))
+    if not _free(rows, claimed):
+        raise CompileError('equation "{}" overlaps another equation'.format(expr))
+    claimed.append(rows)
+
+    symbols = sorted((s for s in offsets if s in expr.free_symbols), key=str)
+    args = []
+    for s in symbols:
+        name, k, absolute = offsets[s]
+        args.append(_rows(variables[name], k, absolute, a, b, lower))
+    kernel = _lambdify(tuple(symbols) + (time_symbol,) + tuple(parameters), expr,
+                       cse)
+    return Branch(expr, a, b, rows, symbols, [offsets[s] for s in symbols],
+                  args, kernel, p['differential'],
+                  (time_symbol,) + tuple(parameters), cse)
+
+
+def _explicit_updates(cm):
+    """ Solves each branch of a discrete model for its leading unknown, so that
+        it can be filled from the unknowns at lower indices.
+    """
+    if cm.is_differential:
+        raise CompileError('model "{}" has time derivatives; it cannot be '
+                           'marched explicitly'.format(cm.name))
+    updates = []
+    targets = []
+    for b in cm.branches:
+        relative = [(s, o) for s, o in zip(b.symbols, b.offsets) if not o[2]]
+        if b.first is None or not relative \
+                or any(o[2] for o in b.offsets):
+            raise CompileError('equation "{}" cannot be marched over an index '
+                               'range'.format(b.expr))
+        leading, (name, kmax, _) = max(relative, key=lambda r: r[1][1])
+        solved = sympy.solve(b.expr, leading)
+        if len(solved) != 1:
+            raise CompileError('cannot solve "{}" explicitly for {}'
+                               .format(b.expr, leading))
+        update = solved[0]
+        deps = [(s, o) for s, o in relative if s in update.free_symbols]
+        if any(o[0] != name or o[1] >= kmax for s, o in deps):
+            raise CompileError('equation "{}" is implicit in {}'.format(b.expr, name))
+        start = cm.variables[name].start - cm.lower
+        target = start + kmax
+        lag = min([kmax - o[1] for s, o in deps], default=b.last - b.first + 1)
+        args = tuple(s for s, o in deps) + b.arguments
+        updates.append(Update(b, target, [start + o[1] for s, o in deps],
+                              _lambdify(args, update, cm.cse), lag, update, name,
+                              args, _lambdify_scalar(args, update, cm.cse)))
+        rows = slice(b.first + target, b.last + target + 1)
+        if not _free(rows, targets):
+            raise CompileError('model "{}" is not explicit: unknowns {}..{} are '
+                               'determined twice'.format(cm.name, rows.start,
+                                                         rows.stop - 1))
+        targets.append(rows)
+    if sum(s.stop - s.start for s in targets) != cm.size:
+        raise CompileError('model "{}" is not explicit'.format(cm.name))
+    updates.sort(key=lambda u: u.branch.first + u.target)
+    return updates
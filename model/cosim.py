@@ -0,0 +1,348 @@
+""" Co-simulation of the connected models of a Models collection.
+
+    A Connection((A, a), (B, b)) makes the unknown a of model A (a symbol,
+    function such as c(t), or one entry c[k] of an indexed unknown) drive
+    the parameter b of model B. The Scheduler compiles every model into a
+    component and advances them all from one synchronization point to the
+    next, holding each input constant over the interval:
+
+    - differential components are integrated by model.integrate, and the
+      others (algebraic or discrete) are solved at the synchronization
+      point by their block decomposition, or marched when explicit.
+    - the components are ordered by the dependency graph of the
+      connections. Strongly connected components of that graph (models
+      coupled both ways) form one stage together; each stage runs after the
+      stages it depends on and uses their new values (Gauss-Seidel), while
+      the models within a stage see each other's values from the previous
+      synchronization point (Jacobi). At the first point, they start from
+      the initial values of the differential models of the stage, or from
+      the values given for the coupled parameters in params.
+    - the components of a stage, and stages that do not depend on each
+      other, run concurrently on a thread or process pool; a stage is
+      submitted as soon as the stages it depends on have finished. A
+      process pool receives the components once, when its workers start,
+      and afterwards only states and input values.
+"""
+
+import heapq
+
+import numpy
+import scipy.sparse
+import scipy.sparse.csgraph
+import sympy
+
+from .compiler import CompileError
+from .compiler import compile_model
+from .flatten import flatten
+from .integrate import integrate
+from .structure import Decomposition
+
+
+def _name(s):
+    if isinstance(s, sympy.Indexed):
+        return str(s.base.label)
+    if isinstance(s, sympy.core.function.AppliedUndef):
+        return s.func.__name__
+    return str(s)
+
+
+class Component:
+    def __init__(self, m, params=None, rtol=1e-6, atol=1e-9, method='rk45'):
+        self.name = m.name
+        self.compiled = compile_model(flatten(m) if m.includes else m)
+        self.params = {} if params is None else {str(k): v for k, v in params.items()}
+        self.rtol = rtol
+        self.atol = atol
+        self.method = method
+        self.differential = self.compiled.is_differential
+        self.explicit = False
+        self.decomposition = None
+        if not self.differential:
+            try:
+                self.compiled.updates()
+                self.explicit = True
+            except CompileError:
+                self.decomposition = Decomposition(self.compiled)
+
+    def __getstate__(self):
+        # the decomposition holds lambdified Jacobian kernels; it is rebuilt
+        state = dict(self.__dict__)
+        state['decomposition'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not self.differential and not self.explicit:
+            self.decomposition = Decomposition(self.compiled)
+
+    def position(self, quantity):
+        """ The position in the state vector of unknown quantity. """
+        name = _name(quantity)
+        if name not in self.compiled.variables:
+            raise ValueError('"{}" is not an unknown of model "{}"'
+                             .format(name, self.name))
+        v = self.compiled.variables[name]
+        if isinstance(quantity, sympy.Indexed):
+            k = int(quantity.indices[0]) - self.compiled.lower
+            if not 0 <= k < v.size:
+                raise ValueError('{} is outside the range of model "{}"'
+                                 .format(quantity, self.name))
+            return v.start + k
+        if v.size != 1:
+            raise ValueError('connect one entry of "{}" of model "{}", such as '
+                             '{}[k]'.format(name, self.name, name))
+        return v.start
+
+    def start(self, t, inputs):
+        params = dict(self.params, **inputs)
+        if self.differential:
+            return self.compiled.initial_values(params)
+        return self.solve(numpy.zeros(self.compiled.size), t, params)
+
+    def advance(self, y, t0, t1, inputs):
+        params = dict(self.params, **inputs)
+        if self.differential:
+            s = integrate(self.compiled, (t0, t1), params, y0=y, method=self.method,
+                          rtol=self.rtol, atol=self.atol)
+            if not s.success:
+                raise RuntimeError('integration of model "{}" failed on [{}, {}]'
+                                   .format(self.name, t0, t1))
+            return s.y[-1]
+        return self.solve(y, t1, params)
+
+    def solve(self, y, t, params):
+        if self.explicit:
+            return self.compiled.march(params, t)
+        return self.decomposition.solve(y, params, t)[0]
+
+
+class CoSimulation:
+    def __init__(self, times, states, components):
+        self.times = times
+        self.states = states
+        self.components = components
+
+    def values(self, m, quantity):
+        """ The values of unknown quantity of model m (or of the model
+            named m) at every synchronization point.
+        """
+        c = self.components[m if isinstance(m, str) else m.name]
+        y = self.states[c.name]
+        if isinstance(quantity, sympy.Indexed):
+            return y[:, c.position(quantity)]
+        return y[:, c.compiled.slice(_name(quantity))]
+
+
+# the components of a process pool's worker, installed when it starts
+_installed = {}
+
+
+def _install(components):
+    _installed.clear()
+    _installed.update(components)
+
+
+def _advance(name, y, t0, t1, inputs):
+    return _installed[name].advance(y, t0, t1, inputs)
+
+
+def _start(name, t, inputs):
+    return _installed[name].start(t, inputs)
+
+
+class Scheduler:
+    def __init__(self, models, params=None, rtol=1e-6, atol=1e-9, method='rk45'):
+        """ Prepares the Models collection models; params maps model names
+            to the values of their parameters.
+        """
+        params = {} if params is None else params
+        self.components = {}
+        for m in models.models:
+            if m.name in self.components:
+                raise ValueError('models of a co-simulation need distinct '
+                                 'names; "{}" is repeated'.format(m.name))
+            self.components[m.name] = Component(m, params.get(m.name), rtol, atol,
+                                                method)
+
+        # inputs[target] lists (parameter, source, position in source state)
+        self.inputs = {name: [] for name in self.components}
+        for c in models.connections:
+            (origin, quantity), (to, parameter) = c.origin, c.to
+            if not isinstance(parameter, sympy.Symbol):
+                raise ValueError('a connection must end on a parameter of model '
+                                 '"{}", not on {}'.format(to.name, parameter))
+            target = self.components[to.name]
+            if str(parameter) not in target.compiled.parameters:
+                raise ValueError('"{}" is not a parameter of model "{}"'
+                                 .format(parameter, to.name))
+            position = self.components[origin.name].position(quantity)
+            self.inputs[to.name].append((str(parameter), origin.name, position))
+        self.stages = self._stages()
+
+    def _stages(self):
+        names = list(self.components)
+        number = {name: k for k, name in enumerate(names)}
+        edges = {(number[source], number[target])
+                 for target, inputs in self.inputs.items()
+                 for _, source, _ in inputs}
+        rows = [a for a, _ in edges]
+        cols = [b for _, b in edges]
+        graph = scipy.sparse.csr_matrix((numpy.ones(len(edges)), (rows, cols)),
+                                        shape=(len(names), len(names)))
+        count, labels = scipy.sparse.csgraph.connected_components(
+            graph, directed=True, connection='strong')
+        needs = [0] * count
+        users = [set() for _ in range(count)]
+        for a, b in edges:
+            if labels[a] != labels[b] and labels[b] not in users[labels[a]]:
+                users[labels[a]].add(labels[b])
+                needs[labels[b]] += 1
+        ready = [c for c in range(count) if needs[c] == 0]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            c = heapq.heappop(ready)
+            order.append(c)
+            for u in users[c]:
+                needs[u] -= 1
+                if needs[u] == 0:
+                    heapq.heappush(ready, u)
+        position = {c: k for k, c in enumerate(order)}
+        self.users = [sorted(position[u] for u in users[c]) for c in order]
+        return [[n for n in names if labels[number[n]] == c] for c in order]
+
+    def _seeds(self):
+        # the inputs a model takes from its own stage at the first
+        # synchronization point, where there are no previous values
+        seeds = {}
+        for stage in self.stages:
+            for name in stage:
+                target = self.components[name]
+                for parameter, source, position in self.inputs[name]:
+                    if source not in stage or parameter in target.params \
+                            or parameter in target.compiled.defaults:
+                        continue
+                    if source not in seeds:
+                        seeds[source] = self._initial(source)
+                    y = seeds[source]
+                    if y is None or not numpy.isfinite(y[position]):
+                        raise ValueError(
+                            'models {} are coupled in a cycle, and parameter "{}" of '
+                            'model "{}" has no value to start from; give it one in '
+                            'params'.format(', '.join('"{}"'.format(n) for n in stage),
+                                            parameter, name))
+        return {name: y for name, y in seeds.items() if y is not None}
+
+    def _initial(self, name):
+        c = self.components[name]
+        if not c.differential:
+            return None
+        # the inputs are not known yet: an initial value that depends on
+        # one comes out as nan
+        params = dict(c.params)
+        for parameter, _, _ in self.inputs[name]:
+            if parameter not in params and parameter not in c.compiled.defaults:
+                params[parameter] = numpy.nan
+        return c.compiled.initial_values(params)
+
+    def _values(self, name, current, previous, stage):
+        # sources in an earlier stage are already at the new time point
+        values = {}
+        for parameter, source, position in self.inputs[name]:
+            state = previous.get(source) if source in stage else current.get(source)
+            if state is None:
+                continue
+            values[parameter] = float(state[position])
+        return values
+
+    def run(self, times, executor='thread', workers=None):
+        """ Runs the co-simulation over the increasing synchronization points
+            times, on a pool of workers of the given executor ('thread',
+            'process', or None to run serially). Returns a CoSimulation.
+        """
+        times = numpy.asarray(times, dtype=float)
+        if times.ndim != 1 or len(times) < 1 or (numpy.diff(times) <= 0).any():
+            raise ValueError('synchronization points must be increasing')
+        if executor is None:
+            return self._run(times, None)
+        if executor == 'thread':
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(workers) as pool:
+                return self._run(times, pool)
+        if executor == 'process':
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(workers, initializer=_install,
+                                     initargs=(self.components,)) as pool:
+                return self._run(times, pool, remote=True)
+        raise ValueError('unknown executor "{}"'.format(executor))
+
+    def _submit(self, pool, remote, task, name, args):
+        if remote:
+            return pool.submit(_advance if task == 'advance' else _start, name, *args)
+        return pool.submit(getattr(self.components[name], task), *args)
+
+    def _sweep(self, pool, remote, task, arguments):
+        # runs task for every component; a stage starts as soon as the
+        # stages it depends on are done, not when the stage before it is
+        current = {}
+        if pool is None:
+            for stage in self.stages:
+                args = [arguments(name, current, stage) for name in stage]
+                for name, a in zip(stage, args):
+                    current[name] = getattr(self.components[name], task)(*a)
+            return current
+        from concurrent.futures import FIRST_COMPLETED
+        from concurrent.futures import wait
+        needs = [0] * len(self.stages)
+        for users in self.users:
+            for u in users:
+                needs[u] += 1
+        left = [len(stage) for stage in self.stages]
+        running = {}
+
+        def submit(k):
+            stage = self.stages[k]
+            args = [arguments(name, current, stage) for name in stage]
+            for name, a in zip(stage, args):
+                running[self._submit(pool, remote, task, name, a)] = (k, name)
+
+        for k in range(len(self.stages)):
+            if needs[k] == 0:
+                submit(k)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                k, name = running.pop(future)
+                current[name] = future.result()
+                left[k] -= 1
+                if left[k] == 0:
+                    for u in self.users[k]:
+                        needs[u] -= 1
+                        if needs[u] == 0:
+                            submit(u)
+        return current
+
+    def _run(self, times, pool, remote=False):
+        states = {name: [] for name in self.components}
+        seeds = self._seeds()
+        current = self._sweep(pool, remote, 'start', lambda name, current, stage: (
+            times[0], self._values(name, current, seeds, stage)))
+        for name, y in current.items():
+            states[name].append(y)
+
+        for t0, t1 in zip(times[:-1], times[1:]):
+            previous = current
+            current = self._sweep(pool, remote, 'advance', lambda name, current, stage: (
+                previous[name], t0, t1, self._values(name, current, previous, stage)))
+            for name, y in current.items():
+                states[name].append(y)
+
+        return CoSimulation(times, {name: numpy.array(s) for name, s in states.items()},
+                            self.components)
+
+
+def cosimulate(models, times, params=None, executor='thread', workers=None, **options):
+    """ Runs the connected models of Models collection models over the
+        synchronization points times; see Scheduler.
+    """
+    return Scheduler(models, params, **options).run(times, executor, workers)
@@ -0,0 +1,321 @@
+""" Method of lines discretisation of continuous models in one space variable.
+
+    discretise(m, x, N) replaces the space variable x of Model m by the N + 1
+    nodes x_k = a + k h, h = (b - a)/N, of its bounds a < x < b. Unknowns that
+    depend on x become IndexedBase unknowns c[i] and their x derivatives
+    become finite differences of second order accuracy:
+
+        interior nodes      central differences, one ArrayEquation per
+                            equation whatever the value of N
+        nodes near the ends one sided differences
+
+    Boundary conditions come from (Eq(x, a), eq) and (Eq(x, b), eq) tuples and
+    from Includes bounded by Eq(x, a) or Eq(x, b); at a node with boundary
+    conditions they replace the model equations. The submodel of an Include
+    contributes its equations at that node, with the unknowns named in the
+    mapping taken as the values of the model's unknowns there, and its other
+    unknowns and parameters added to the result. Two equations giving the
+    time derivative of the same node value, as a submodel's rate law and the
+    Include equation that sets the flux to it, become one condition that
+    equates their right hand sides. Each end node must be left with one
+    condition per unknown depending on x. Time derivatives and
+    (Eq(t, t0), eq) initial conditions are kept, so the result is the
+    semi-discrete system M dy/dt = F(t, y, p) of the compiler.
+"""
+
+import sympy
+
+from .model import ArrayEquation
+from .model import Model
+
+
+def _name(s):
+    if isinstance(s, sympy.core.function.AppliedUndef):
+        return s.func.__name__
+    return str(s)
+
+
+def _symbol_names(m, names):
+    for e in list(m.solution_variables) + list(m.parameters) + [m.bounds]:
+        if isinstance(e, sympy.Basic):
+            names |= {str(s) for s in e.free_symbols}
+    for eq in m.eqs:
+        for e in (eq if isinstance(eq, tuple) else (eq,)):
+            names |= {str(s) for s in e.free_symbols}
+            names |= {f.func.__name__
+                      for f in e.atoms(sympy.core.function.AppliedUndef)}
+    for i in m.includes:
+        _symbol_names(i.submodel, names)
+    return names
+
+
+def space_interval(bounds, x):
+    """ Returns (a, b, rest): the interval a < x < b given by bounds and its
+        relations that do not involve x.
+    """
+    relations = bounds.args if isinstance(bounds, sympy.And) else (bounds,)
+    a = b = None
+    rest = []
+    for r in relations:
+        if not isinstance(r, sympy.core.relational.Relational) \
+                or x not in r.free_symbols:
+            rest.append(r)
+            continue
+        if r.lhs != x:
+            r = r.reversed
+        if r.lhs != x or x in r.rhs.free_symbols:
+            raise ValueError('cannot use "{}" as a bound on {}'.format(r, x))
+        if isinstance(r, (sympy.Gt, sympy.Ge)):
+            a = r.rhs
+        elif isinstance(r, (sympy.Lt, sympy.Le)):
+            b = r.rhs
+        else:
+            raise ValueError('cannot use "{}" as a bound on {}'.format(r, x))
+    if a is None or b is None:
+        raise ValueError('bounds "{}" do not give an interval in {}'.format(bounds, x))
+    return a, b, rest
+
+
+def stencil(order, offsets):
+    """ Returns the finite difference weights of the order-th derivative at
+        node offset 0 from the values at the given node offsets, for unit
+        spacing.
+    """
+    weights = sympy.finite_diff_weights(order, list(offsets), 0)[order][-1]
+    return [(k, w) for k, w in zip(offsets, weights) if w != 0]
+
+
+def _offsets(order, k, N):
+    # central differences need `half` nodes on each side; near the ends the
+    # order + 2 nearest nodes give the same accuracy, one sided
+    half = (order + 1) // 2
+    width = order + 2
+    if k is not None and sympy.sympify(k).is_number and k < half:
+        return range(-k, width - k)
+    if k is not None and sympy.sympify(N - k).is_number and N - k < half:
+        return range(int(N - k) - width + 1, int(N - k) + 1)
+    return range(-half, half + 1)
+
+
+class Discretisation:
+    def __init__(self, m, x, N, index):
+        self.x = x
+        self.N = N
+        self.index = index
+        self.a, self.b, self.rest = space_interval(m.bounds, x)
+        self.h = (self.b - self.a) / N
+        self.spatial = {}
+        for s in m.solution_variables:
+            if isinstance(s, sympy.core.function.AppliedUndef) and x in s.args:
+                self.spatial[_name(s)] = sympy.IndexedBase(_name(s))
+            elif isinstance(s, sympy.Symbol) and s == x:
+                raise ValueError('{} is not a solution variable'.format(x))
+        if not self.spatial:
+            raise ValueError('model "{}" has no unknowns depending on {}'
+                             .format(m.name, x))
+        self.half = max([(d + 1) // 2 for d in self.orders(m)], default=1)
+
+    def orders(self, m):
+        for eq in m.eqs:
+            eq = eq[1] if isinstance(eq, tuple) else eq
+            for d in eq.atoms(sympy.Derivative):
+                for v, n in d.variable_count:
+                    if v == self.x:
+                        yield int(n)
+
+    def node(self, value):
+        """ The node index of x = value, which must be an end of the interval. """
+        if sympy.simplify(value - self.a) == 0:
+            return 0
+        if sympy.simplify(value - self.b) == 0:
+            return self.N
+        raise ValueError('{} = {} is not an end of the interval [{}, {}]'
+                         .format(self.x, value, self.a, self.b))
+
+    def unknown(self, name):
+        return self.spatial[name][self.index]
+
+    def difference(self, name, order, k):
+        # k is the fixed node of a boundary equation, or None in the interior
+        i = self.index
+        return sum(w * self.spatial[name][i + o]
+                   for o, w in stencil(order, _offsets(order, k, self.N))) \
+            / self.h ** order
+
+    def rewrite(self, expr, k=None, mapping=None):
+        """ Replaces the spatial unknowns of expr (named through mapping, for
+            a submodel) by their node values and x derivatives by differences.
+        """
+        mapping = mapping or {n: n for n in self.spatial}
+        names = {f: t for f, t in mapping.items() if t in self.spatial}
+
+        def spatial_name(e):
+            if isinstance(e, (sympy.Symbol, sympy.core.function.AppliedUndef)) \
+                    and _name(e) in names:
+                return names[_name(e)]
+            return None
+
+        def derivative(d):
+            name = spatial_name(d.expr)
+            space = [n for v, n in d.variable_count if v == self.x]
+            if not space:
+                return d
+            if name is None:
+                if any(spatial_name(s) for s in d.expr.atoms(
+                        sympy.Symbol, sympy.core.function.AppliedUndef)):
+                    raise ValueError('cannot discretise "{}"; only derivatives '
+                                     'of unknowns are supported'.format(d))
+                return d.doit()
+            if len(d.variable_count) != 1:
+                raise ValueError('cannot discretise the mixed derivative "{}"'
+                                 .format(d))
+            # kept apart until the unknowns are replaced, which would
+            # otherwise replace the labels of the differences too
+            p = sympy.Dummy()
+            differences[p] = self.difference(name, int(space[0]), k)
+            return p
+
+        differences = {}
+        expr = expr.replace(lambda e: isinstance(e, sympy.Derivative), derivative)
+        replace = {}
+        for e in expr.atoms(sympy.Symbol, sympy.core.function.AppliedUndef):
+            if spatial_name(e) is not None:
+                replace[e] = self.unknown(spatial_name(e))
+        expr = expr.xreplace(replace).xreplace(differences)
+        if self.x in expr.free_symbols:
+            raise ValueError('cannot discretise "{}", which depends on {} '
+                             'explicitly'.format(expr, self.x))
+        return expr
+
+    def at(self, k):
+        return sympy.Eq(self.index, k)
+
+    def is_spatial(self, eq):
+        return any(isinstance(e, sympy.Indexed) and e.base in self.spatial.values()
+                   for e in eq.atoms(sympy.Indexed))
+
+
+def _rate(d, eq):
+    # the node value whose time derivative eq gives, or None
+    lhs = eq.lhs
+    if isinstance(lhs, sympy.Derivative) and isinstance(lhs.expr, sympy.Indexed) \
+            and lhs.expr.base in d.spatial.values():
+        return lhs.expr
+    return None
+
+
+def _combine_rates(d, eqs):
+    """ Replaces each pair of equations for the time derivative of the same
+        node value by one equating their right hand sides.
+    """
+    rates = {}
+    out = []
+    for eq in eqs:
+        u = _rate(d, eq)
+        if u is None:
+            out.append(eq)
+        else:
+            rates.setdefault(u, []).append(eq)
+    for u, group in rates.items():
+        if len(group) == 2:
+            # in a canonical order, so the sign of the residual does not
+            # depend on the iteration order of the model's equations
+            first, second = sorted((eq.rhs for eq in group),
+                                   key=sympy.default_sort_key)
+            out.append(sympy.Eq(first, second))
+        else:
+            out.extend(group)
+    return out
+
+
+def _free_index(m, preferred='i'):
+    names = _symbol_names(m, set())
+    for name in [preferred, 'j', 'k', 'n']:
+        if name not in names:
+            return sympy.Symbol(name, integer=True)
+    raise ValueError('no free name for the node index of "{}"'.format(m.name))
+
+
+def discretise(m, x, N, index=None, name=None):
+    """ Returns a Model with the x dependence of Model m discretised on N + 1
+        nodes; see the module documentation. index is the name of the node
+        index (by default the first of i, j, k and n not used by the model).
+    """
+    if isinstance(N, int) and N < 2:
+        raise ValueError('N must be at least 2')
+    index = _free_index(m) if index is None else sympy.Symbol(index, integer=True)
+    d = Discretisation(m, x, N, index)
+
+    interior = []
+    boundary = {}
+    eqs = set()
+    for eq in m.eqs:
+        if not isinstance(eq, tuple):
+            interior.append(eq)
+        elif x in eq[0].free_symbols:
+            if not isinstance(eq[0], sympy.Eq):
+                raise ValueError('cannot use "{}" as a boundary'.format(eq[0]))
+            k = d.node(sympy.solve(eq[0], x)[0])
+            boundary.setdefault(k, []).append((eq[1], None))
+        else:
+            # initial conditions, and anything else not in x
+            eqs.add((eq[0], d.rewrite(eq[1])))
+
+    parameters = list(m.parameters)
+    solution_variables = {d.unknown(n) for n in d.spatial}
+    for s in m.solution_variables:
+        if _name(s) not in d.spatial:
+            solution_variables.add(s)
+    for include in m.includes:
+        if include.submodel.includes:
+            raise ValueError('include "{}" has includes of its own; flatten the '
+                             'model first'.format(include.submodel.name))
+        k = d.node(sympy.solve(include.bounds, x)[0])
+        mapping = dict(include.mapping)
+        for s in include.submodel.solution_variables:
+            if mapping.get(_name(s)) not in d.spatial:
+                solution_variables.add(s)
+        for p in include.submodel.parameters:
+            if p not in parameters:
+                parameters.append(p)
+        for eq in include.submodel.eqs:
+            if isinstance(eq, tuple):
+                eqs.add((eq[0], d.rewrite(eq[1], mapping=mapping)))
+            else:
+                boundary.setdefault(k, []).append((eq, mapping))
+        for eq in include.eqs:
+            boundary.setdefault(k, []).append((eq, None))
+
+    # the model equations hold on the nodes without boundary conditions: in
+    # one ArrayEquation over the interior, and one sided near the ends
+    nodes = [k for k in range(d.half)] + [N - k for k in range(d.half)]
+    for eq in interior:
+        if not d.is_spatial(d.rewrite(eq)):
+            eqs.add(d.rewrite(eq))
+            continue
+        eqs.add(ArrayEquation(index, d.half, N - d.half, d.rewrite(eq)))
+        for k in sorted(set(nodes), key=str):
+            if k not in boundary:
+                eqs.add((d.at(k), d.rewrite(eq, k)))
+    for k, conditions in boundary.items():
+        spatial = []
+        for eq, mapping in conditions:
+            eq = d.rewrite(eq, k, mapping)
+            if d.is_spatial(eq):
+                spatial.append(eq)
+            else:
+                eqs.add(eq)
+        spatial = _combine_rates(d, spatial)
+        if len(spatial) != len(d.spatial):
+            raise ValueError('{} = {} has {} conditions for the {} unknowns {}'
+                             .format(x, d.a if k == 0 else d.b, len(spatial),
+                                     len(d.spatial), sorted(d.spatial)))
+        eqs |= {(d.at(k), eq) for eq in spatial}
+
+    out = Model()
+    out.name = name or '{} discretised'.format(m.name)
+    out.solution_variables = solution_variables
+    out.parameters = parameters
+    out.bounds = sympy.And(index >= 0, index <= N, *d.rest)
+    out.eqs = eqs
+    return out
@@ -0,0 +1,259 @@
+""" Builds Content MathML ElementTree nodes directly from sympy expressions.
+
+    The output matches sympy.printing.mathml followed by ET.fromstring, except
+    that integer symbols carry type="integer", but it skips the intermediate
+    DOM, string and parse. Converted subexpressions are
+    memoized, so a node shared across an expression DAG (or across the
+    equations of a model) is converted once; cached elements are shared
+    between parents internally and callers get a private, unshared copy.
+"""
+
+import collections
+import xml.etree.ElementTree as ET
+
+import sympy
+from mpmath.libmp import repr_dps, to_str as mlib_to_str
+from sympy.core.function import AppliedUndef, UndefinedFunction
+from sympy.printing.conventions import requires_partial, split_super_sub
+from sympy.printing.mathml import MathMLContentPrinter
+from sympy.printing.pretty.pretty_symbology import greek_unicode
+
+
+def sympy_to_mathml_printer(s):
+    """ The reference path: print with sympy, then parse the string. """
+    return ET.fromstring(sympy.printing.mathml(s))
+
+
+_EMPTY = {
+    'ImaginaryUnit': 'imaginaryi',
+    'EulerGamma': 'eulergamma',
+    'Exp1': 'exponentiale',
+    'Pi': 'pi',
+    'Infinity': 'infinity',
+    'NaN': 'notanumber',
+    'EmptySet': 'emptyset',
+    'BooleanTrue': 'true',
+    'BooleanFalse': 'false',
+}
+
+
+def _apply(tag, *children):
+    x = ET.Element('apply')
+    ET.SubElement(x, tag)
+    x.extend(children)
+    return x
+
+
+def _unshare(e):
+    # copy.deepcopy would keep a shared child shared in the copy
+    x = ET.Element(e.tag, e.attrib)
+    x.text = e.text
+    x.extend(_unshare(c) for c in e)
+    return x
+
+
+def _text(tag, text):
+    x = ET.Element(tag)
+    x.text = text
+    return x
+
+
+class ContentMathMLEmitter:
+    def __init__(self, maxsize=65536):
+        self.printer = MathMLContentPrinter()
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._dispatch = {}
+
+    def __call__(self, expr):
+        return _unshare(self.emit(expr))
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.cache), 'maxsize': self.maxsize}
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def emit(self, expr):
+        key = (type(expr), expr)
+        try:
+            e = self.cache[key]
+        except TypeError:
+            return self._emit(expr)
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+            return e
+        self.misses += 1
+        e = self._emit(expr)
+        self.cache[key] = e
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return e
+
+    def _method(self, cls):
+        # resolve the printing method exactly as sympy's Printer._print does
+        try:
+            return self._dispatch[cls]
+        except KeyError:
+            pass
+        classes = cls.__mro__
+        if AppliedUndef in classes:
+            classes = classes[classes.index(AppliedUndef):]
+        if UndefinedFunction in classes:
+            classes = classes[classes.index(UndefinedFunction):]
+        if sympy.Function in classes:
+            i = classes.index(sympy.Function)
+            classes = tuple(c for c in classes[:i]
+                            if c.__name__ == classes[0].__name__
+                            or c.__name__.endswith('Base')) + classes[i:]
+        method = None
+        for c in classes:
+            name = '_print_' + c.__name__
+            if hasattr(self.printer, name):
+                method = getattr(self, name, None) or self._fallback
+                break
+        if method is None:
+            method = self._fallback
+        if hasattr(cls, self.printer.printmethod):
+            method = self._fallback
+        self._dispatch[cls] = method
+        return method
+
+    def _emit(self, expr):
+        if expr.__class__.__name__ in _EMPTY:
+            return ET.Element(_EMPTY[expr.__class__.__name__])
+        return self._method(type(expr))(expr)
+
+    def _fallback(self, expr):
+        return sympy_to_mathml_printer(expr)
+
+    def tag(self, expr):
+        return self.printer.mathml_tag(expr)
+
+    def _print_Mul(self, expr):
+        if expr.could_extract_minus_sign():
+            return _apply('minus', self.emit(-expr))
+        numer, denom = sympy.fraction(expr)
+        if denom is not sympy.S.One:
+            return _apply('divide', self.emit(numer), self.emit(denom))
+        coeff, terms = expr.as_coeff_mul()
+        if coeff is sympy.S.One and len(terms) == 1:
+            return self.emit(terms[0])
+        terms = sympy.Mul._from_args(terms).as_ordered_factors()
+        x = _apply('times')
+        if coeff != 1:
+            x.append(self.emit(coeff))
+        for term in terms:
+            x.append(self.emit(term))
+        return x
+
+    def _print_Add(self, expr):
+        args = expr.as_ordered_terms()
+        last = self.emit(args[0])
+        plus = []
+        for arg in args[1:]:
+            if arg.could_extract_minus_sign():
+                last = _apply('minus', last, self.emit(-arg))
+                if arg == args[-1]:
+                    plus.append(last)
+            else:
+                plus.append(last)
+                last = self.emit(arg)
+                if arg == args[-1]:
+                    plus.append(last)
+        if len(plus) == 1:
+            return last
+        return _apply('plus', *plus)
+
+    def _print_Rational(self, e):
+        if e.q == 1:
+            return _text('cn', str(e.p))
+        return _apply('divide', _text('cn', str(e.p)), _text('cn', str(e.q)))
+
+    def _print_Symbol(self, sym):
+        name, supers, subs = split_super_sub(sym.name)
+        if supers or subs:
+            # sympy writes mml: presentation markup here, which does not
+            # parse without a namespace declaration; keep the plain name
+            x = _text(self.tag(sym), sym.name)
+        else:
+            x = _text(self.tag(sym), greek_unicode.get(name, name))
+        # unlike sympy, keep integer symbols (indices) integer on re-import
+        if sym.is_integer and x.tag == 'ci':
+            x.set('type', 'integer')
+        return x
+
+    _print_MatrixSymbol = _print_Symbol
+    _print_RandomSymbol = _print_Symbol
+
+    def _print_Pow(self, e):
+        if e.exp.is_Rational and e.exp.p == 1:
+            x = _apply('root')
+            if e.exp.q != 2:
+                degree = ET.SubElement(x, 'degree')
+                degree.append(_text('cn', str(e.exp.q)))
+            x.append(self.emit(e.base))
+            return x
+        return _apply(self.tag(e), self.emit(e.base), self.emit(e.exp))
+
+    def _print_Number(self, e):
+        return _text(self.tag(e), str(e))
+
+    def _print_Float(self, e):
+        return _text(self.tag(e), mlib_to_str(e._mpf_, repr_dps(e._prec)))
+
+    def _print_Derivative(self, e):
+        diff = self.tag(e)
+        if requires_partial(e.expr):
+            diff = 'partialdiff'
+        x = _apply(diff)
+        bvar = ET.SubElement(x, 'bvar')
+        for sym, times in reversed(e.variable_count):
+            bvar.append(self.emit(sym))
+            if times > 1:
+                degree = ET.SubElement(bvar, 'degree')
+                degree.append(self.emit(sympy.sympify(times)))
+        x.append(self.emit(e.expr))
+        return x
+
+    def _print_Function(self, e):
+        return _apply(self.tag(e), *[self.emit(a) for a in e.args])
+
+    def _print_Basic(self, e):
+        x = ET.Element(self.tag(e))
+        x.extend(self.emit(a) for a in e.args)
+        return x
+
+    def _print_AssocOp(self, e):
+        return _apply(self.tag(e), *[self.emit(a) for a in e.args])
+
+    _print_Implies = _print_AssocOp
+    _print_Not = _print_AssocOp
+    _print_Xor = _print_AssocOp
+
+    def _print_Relational(self, e):
+        return _apply(self.tag(e), self.emit(e.lhs), self.emit(e.rhs))
+
+    def _print_int(self, p):
+        return _text(self.tag(p), str(p))
+
+    def _print_list(self, seq):
+        x = ET.Element('list')
+        x.extend(self.emit(item) for item in seq)
+        return x
+
+
+emitter = ContentMathMLEmitter()
+
+
+def emit_mathml(s):
+    """ Returns a new Content MathML element for sympy expression s. """
+    return emitter(s)
@@ -0,0 +1,120 @@
+""" Flattening of Include hierarchies into one system of equations.
+
+    flatten(m) returns a Model without includes. The equations of each
+    included submodel, and the additional equations of the Include, hold on
+    the Include's bounds, so they become (bounds, eq) tuples. The submodel's
+    unknowns named in Include.mapping are identified with the model's; its
+    other unknowns are renamed with the name of the submodel as prefix
+    (numbered when the same submodel is included more than once), and its
+    parameters are shared by name.
+
+    Each submodel is flattened once, however many times and at whatever
+    depth it is included; every Include then only renames the cached result.
+"""
+
+import sympy
+
+from .model import ArrayEquation
+from .model import Model
+
+
+def _name(s):
+    if isinstance(s, sympy.Indexed):
+        return str(s.base.label)
+    if isinstance(s, sympy.core.function.AppliedUndef):
+        return s.func.__name__
+    return str(s)
+
+
+def rename(e, names):
+    """ Renames the symbols, functions and IndexedBase labels of e. """
+    if isinstance(e, ArrayEquation):
+        return ArrayEquation(e.index, rename(e.lower, names),
+                             rename(e.upper, names), rename(e.stencil, names))
+    if isinstance(e, tuple):
+        return tuple(rename(i, names) for i in e)
+    if not isinstance(e, sympy.Basic) or not names:
+        return e
+    replace = {}
+    for s in e.atoms(sympy.Symbol):
+        if s.name in names:
+            replace[s] = sympy.Symbol(names[s.name], **s.assumptions0)
+    for f in e.atoms(sympy.core.function.AppliedUndef):
+        if f.func.__name__ in names:
+            replace[f] = sympy.Function(names[f.func.__name__])(*f.args)
+    return e.xreplace(replace)
+
+
+def _guard(bounds, eq):
+    if bounds is None or bounds == {} or bounds is sympy.true:
+        return eq
+    if isinstance(eq, tuple):
+        return (sympy.And(bounds, eq[0]), eq[1])
+    return (bounds, eq)
+
+
+def _include_order(include):
+    return (include.submodel.name, str(include.bounds), sorted(map(str, include.eqs)))
+
+
+class Flattener:
+    def __init__(self):
+        self.flattened = {}
+        self.visits = 0
+
+    def __call__(self, m):
+        """ Returns Model m without includes; see the module documentation. """
+        # renaming keeps the structure of expressions; re-evaluating every
+        # rebuilt node, relations especially, would dominate the cost
+        with sympy.evaluate(False):
+            return self._flatten(m)
+
+    def _flatten(self, m):
+        if m in self.flattened:
+            return self.flattened[m]
+        self.visits += 1
+        out = Model()
+        out.name = m.name
+        out.bounds = m.bounds
+        out.solution_variables = set(m.solution_variables)
+        out.parameters = list(m.parameters)
+        out.eqs = set(m.eqs)
+        out.includes = set()
+
+        taken = {_name(s) for s in m.solution_variables}
+        instances = {}
+        for include in sorted(m.includes, key=_include_order):
+            sub = self._flatten(include.submodel)
+            n = instances.get(sub.name, 0)
+            instances[sub.name] = n + 1
+            prefix = sub.name if n == 0 else '{}{}'.format(sub.name, n)
+            names = dict(include.mapping)
+            for s in sub.solution_variables:
+                name = _name(s)
+                if name in include.mapping:
+                    names[name] = include.mapping[name]
+                else:
+                    names[name] = '{}_{}'.format(prefix, name)
+                    if names[name] in taken:
+                        raise ValueError('renaming "{}" of "{}" to "{}" clashes '
+                                         'with another unknown'
+                                         .format(name, sub.name, names[name]))
+                    taken.add(names[name])
+            for s in sub.solution_variables:
+                if _name(s) not in include.mapping:
+                    out.solution_variables.add(rename(s, names))
+            for p in sub.parameters:
+                if p not in out.parameters:
+                    out.parameters.append(p)
+            for eq in sub.eqs:
+                out.eqs.add(_guard(include.bounds, rename(eq, names)))
+            for eq in include.eqs:
+                out.eqs.add(_guard(include.bounds, eq))
+
+        self.flattened[m] = out
+        return out
+
+
+def flatten(m):
+    """ Returns Model m with its Include hierarchy flattened. """
+    return Flattener()(m)
@@ -0,0 +1,113 @@
+""" Export of compiled models for the sympy-free runtime.
+
+    freeze(m, path) writes a directory holding
+
+        kernels.py  generated NumPy code, one function per branch, initial
+                    condition and (for explicit discrete models) update
+        model.json  the layout of the state vector, the parameters and the
+                    rows and argument slices of each kernel
+
+    which runtime.load(path) evaluates with only NumPy imported.
+"""
+
+import json
+import os
+
+import sympy
+from sympy.printing.numpy import NumPyPrinter
+from sympy.printing.pycode import PythonCodePrinter
+
+from ._io import atomic_write
+from .cache import fingerprint
+from .compiler import CompiledModel
+from .compiler import CompileError
+from .compiler import compile_model
+
+FORMAT = 1
+
+
+def _function(name, args, expr, printer, cse=False):
+    # positional argument names keep any symbol name a valid identifier
+    names = ['a{}'.format(k) for k in range(len(args))]
+    expr = sympy.sympify(expr).xreplace(
+        {s: sympy.Symbol(n) for s, n in zip(args, names)})
+    lines = ['def {}({}):'.format(name, ', '.join(names))]
+    if cse:
+        replacements, (expr,) = sympy.cse(
+            expr, symbols=sympy.numbered_symbols('x'), order='none')
+        for s, e in replacements:
+            lines.append('    {} = {}'.format(s, printer.doprint(e)))
+    lines.append('    return {}'.format(printer.doprint(expr)))
+    return '\n'.join(lines) + '\n'
+
+
+def _slice(s):
+    return [s.start, s.stop]
+
+
+def freeze_source(compiled):
+    """ Returns the (kernels.py source, model.json metadata) of CompiledModel
+        compiled.
+    """
+    numpy_printer = NumPyPrinter({'fully_qualified_modules': True})
+    math_printer = PythonCodePrinter({'fully_qualified_modules': True})
+    functions = []
+    branches = []
+    for k, b in enumerate(compiled.branches):
+        name = 'branch_{}'.format(k)
+        functions.append(_function(name, tuple(b.symbols) + b.arguments, b.expr,
+                                   numpy_printer, compiled.cse))
+        branches.append({'kernel': name, 'rows': _slice(b.rows),
+                         'args': [_slice(s) for s in b.args],
+                         'differential': b.differential})
+    initial = []
+    for k, (variable, expr, _) in enumerate(compiled.initial):
+        name = 'initial_{}'.format(k)
+        functions.append(_function(name, compiled.arguments[1:], expr,
+                                   numpy_printer, compiled.cse))
+        initial.append({'kernel': name, 'variable': variable})
+    try:
+        updates = []
+        for k, u in enumerate(compiled.updates()):
+            name = 'update_{}'.format(k)
+            functions.append(_function(name, u.arguments, u.expr, numpy_printer,
+                                       compiled.cse))
+            functions.append(_function(name + '_scalar', u.arguments, u.expr,
+                                       math_printer, compiled.cse))
+            updates.append({'kernel': name, 'scalar_kernel': name + '_scalar',
+                            'first': u.branch.first, 'last': u.branch.last,
+                            'target': u.target, 'positions': u.positions,
+                            'lag': u.lag})
+    except CompileError:
+        updates = None
+
+    source = '""" Generated by model.freeze from model {!r}; do not edit. """\n\n' \
+             'import math\nimport numpy\n\n\n'.format(compiled.name) \
+        + '\n\n'.join(functions)
+    metadata = {
+        'format': FORMAT,
+        'name': compiled.name,
+        'lower': compiled.lower,
+        'upper': compiled.upper,
+        'size': compiled.size,
+        'variables': [[v.name, v.start, v.size, v.indexed]
+                      for v in compiled.variables.values()],
+        'parameters': list(compiled.parameters),
+        'defaults': compiled.defaults,
+        'branches': branches,
+        'initial': initial,
+        'updates': updates,
+    }
+    return source, metadata
+
+
+def freeze(m, path):
+    """ Writes Model or CompiledModel m to directory path for runtime.load. """
+    compiled = m if isinstance(m, CompiledModel) else compile_model(m)
+    source, metadata = freeze_source(compiled)
+    metadata['fingerprint'] = None if m is compiled else fingerprint(m)
+    os.makedirs(path, exist_ok=True)
+    atomic_write(os.path.join(path, 'kernels.py'), source)
+    atomic_write(os.path.join(path, 'model.json'),
+                 json.dumps(metadata, indent=2, sort_keys=True))
+    return path
@@ -0,0 +1,278 @@
+""" Adaptive integration of ensembles of ODE models.
+
+    integrate(m, t_span, params) solves dy/dt = F(t, y, p) for a compiled
+    model whose rows are all differential, for a whole ensemble at once:
+    parameters given as arrays, and initial values given with leading batch
+    axes, make one member per element of the broadcast batch shape, as in
+    CompiledModel.residual. The members share one (members, size) state
+    array and every stage is one call of the kernels, but each member has
+    its own time, step size and error control, so a member that needs small
+    steps does not hold back the others. Members that have reached the end
+    of the interval, or failed, are dropped from the working set.
+
+    Two embedded methods are provided:
+
+        'rk45'        Dormand-Prince 5(4), explicit, for non-stiff models
+        'rosenbrock'  the Rosenbrock 2(3) W-method of Shampine and Reichelt
+                      (as in MATLAB's ode23s), linearly implicit with a
+                      finite difference Jacobian per member, for stiff models
+
+    Both have a continuous extension, which gives the solution at the times
+    t_eval without shortening the steps to land on them.
+"""
+
+import numpy
+
+from .compiler import CompiledModel
+from .compiler import CompileError
+from .compiler import compile_model
+from .timing import timed
+from .timing import timings
+
+SUCCESS = 0
+TOO_MANY_STEPS = 1
+STEP_TOO_SMALL = 2
+
+_eps = numpy.finfo(float).eps
+
+
+class Solution:
+    def __init__(self, compiled, method, t, y, status, steps, rejected, evaluations):
+        self.compiled = compiled
+        self.method = method
+        self.t = t
+        self.y = y
+        self.status = status
+        self.steps = steps
+        self.rejected = rejected
+        self.evaluations = evaluations
+
+    def __str__(self):
+        return 'Solution of "{}" by {}: {} members, {} failed, {} steps ' \
+            '({} rejected), {} evaluations'.format(
+                self.compiled.name, self.method, self.status.size,
+                int(numpy.count_nonzero(self.status)), int(self.steps.sum()),
+                int(self.rejected.sum()), self.evaluations)
+
+    @property
+    def success(self):
+        return not self.status.any()
+
+    def values(self, name):
+        """ The solution for unknown name, with axes (batch..., t, index). """
+        return self.y[..., self.compiled.slice(name)]
+
+
+class DormandPrince:
+    name = 'rk45'
+    order = 4
+    C = numpy.array([0, 1/5, 3/10, 4/5, 8/9, 1])
+    A = [[],
+         [1/5],
+         [3/40, 9/40],
+         [44/45, -56/15, 32/9],
+         [19372/6561, -25360/2187, 64448/6561, -212/729],
+         [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656]]
+    B = numpy.array([35/384, 0, 500/1113, 125/192, -2187/6784, 11/84])
+    E = numpy.array([-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40])
+    # coefficients of the continuous extension, by stage and power of x
+    P = numpy.array([
+        [1, -8048581381/2820520608, 8663915743/2820520608, -12715105075/11282082432],
+        [0, 0, 0, 0],
+        [0, 131558114200/32700410799, -68118460800/10900136933, 87487479700/32700410799],
+        [0, -1754552775/470086768, 14199869525/1410260304, -10690763975/1880347072],
+        [0, 127303824393/49829197408, -318862633887/49829197408, 701980252875/199316789632],
+        [0, -282668133/205662961, 2019193451/616988883, -1453857185/822651844],
+        [0, 40617522/29380423, -110615467/29380423, 69997945/29380423]])
+
+    def step(self, f, t, y, h, f0):
+        K = numpy.empty((7,) + y.shape)
+        K[0] = f0
+        for s in range(1, 6):
+            dy = numpy.tensordot(self.A[s], K[:s], 1)
+            K[s] = f(t + self.C[s] * h, y + h * dy)
+        y_new = y + h * numpy.tensordot(self.B, K[:6], 1)
+        K[6] = f(t + h, y_new)
+        error = h * numpy.tensordot(self.E, K, 1)
+        return y_new, K[6], error, K
+
+    def interpolate(self, y, h, K, x):
+        Q = numpy.tensordot(self.P.T, K, 1)
+        return y + h * x * (Q[0] + x * (Q[1] + x * (Q[2] + x * Q[3])))
+
+
+class Rosenbrock:
+    name = 'rosenbrock'
+    order = 2
+    d = 1 / (2 + numpy.sqrt(2))
+    e32 = 6 + numpy.sqrt(2)
+
+    def jacobian(self, f, t, y, f0):
+        J = numpy.empty(y.shape + y.shape[-1:])
+        for j in range(y.shape[-1]):
+            delta = numpy.sqrt(_eps) * numpy.maximum(numpy.abs(y[:, j]), 1e-5)
+            z = y.copy()
+            z[:, j] += delta
+            J[:, :, j] = (f(t, z) - f0) / delta[:, numpy.newaxis]
+        return J
+
+    def step(self, f, t, y, h, f0):
+        delta = numpy.sqrt(_eps) * numpy.maximum(numpy.abs(t), 1e-5)
+        dfdt = (f(t + delta, y) - f0) / delta
+        J = self.jacobian(f, t, y, f0)
+        W = numpy.eye(y.shape[-1]) - (h * self.d)[:, :, numpy.newaxis] * J
+        # one inverse per member serves all three stages
+        Winv = numpy.linalg.inv(W)
+
+        def solve(r):
+            return numpy.einsum('bij,bj->bi', Winv, r)
+
+        k1 = solve(f0 + h * self.d * dfdt)
+        f1 = f(t + h / 2, y + h / 2 * k1)
+        k2 = solve(f1 - k1) + k1
+        y_new = y + h * k2
+        f2 = f(t + h, y_new)
+        k3 = solve(f2 - self.e32 * (k2 - f1) - 2 * (k1 - f0) + h * self.d * dfdt)
+        error = h / 6 * (k1 - 2 * k2 + k3)
+        return y_new, f2, error, numpy.stack([k1, k2])
+
+    def interpolate(self, y, h, K, x):
+        return y + h * (x * (1 - x) * K[0] + x * (x - 2 * self.d) * K[1]) / (1 - 2 * self.d)
+
+
+methods = {
+    'rk45': DormandPrince,
+    'rosenbrock': Rosenbrock,
+}
+
+
+def _rms(v):
+    return numpy.sqrt(numpy.mean(v * v, axis=-1))
+
+
+def _first_step(f, t, y, f0, order, rtol, atol):
+    # the starting step size heuristic of Hairer, Norsett and Wanner
+    scale = atol + rtol * numpy.abs(y)
+    d0 = _rms(y / scale)
+    d1 = _rms(f0 / scale)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        h0 = numpy.where((d0 < 1e-5) | (d1 < 1e-5), 1e-6, 0.01 * d0 / d1)
+        h = h0[:, numpy.newaxis]
+        f1 = f(t[:, numpy.newaxis] + h, y + h * f0)
+        d2 = _rms((f1 - f0) / scale) / h0
+        dmax = numpy.maximum(d1, d2)
+        h1 = numpy.where(dmax <= 1e-15, numpy.maximum(1e-6, h0 * 1e-3),
+                         (0.01 / dmax) ** (1 / (order + 1)))
+    return numpy.minimum(100 * h0, h1)
+
+
+@timed('solve')
+def integrate(m, t_span, params=None, y0=None, t_eval=None, method='rk45',
+              rtol=1e-6, atol=1e-9, first_step=None, max_step=numpy.inf,
+              max_steps=100000, safety=0.9, min_factor=0.2, max_factor=10.0):
+    """ Integrates Model or CompiledModel m over t_span = (t0, t1) for the
+        ensemble given by params and y0 (by default the model's initial
+        values), returning a Solution whose y has the axes
+        (batch..., len(t_eval), size). t_eval defaults to (t0, t1).
+    """
+    compiled = m if isinstance(m, CompiledModel) else compile_model(m)
+    if not (compiled.mass == 1).all():
+        raise CompileError('model "{}" has algebraic rows; integrate needs every '
+                           'row to be an equation for a time derivative'
+                           .format(compiled.name))
+    if method not in methods:
+        raise ValueError('unknown method "{}"; use one of {}'
+                         .format(method, ', '.join(sorted(methods))))
+    scheme = methods[method]()
+    t0, t1 = float(t_span[0]), float(t_span[1])
+    if not t1 > t0:
+        raise ValueError('t_span must be increasing, got {}'.format(t_span))
+    t_eval = numpy.array([t0, t1] if t_eval is None else t_eval, dtype=float)
+    if t_eval.ndim != 1 or (numpy.diff(t_eval) < 0).any() \
+            or (t_eval < t0).any() or (t_eval > t1).any():
+        raise ValueError('t_eval must be sorted and lie within t_span')
+
+    n = compiled.size
+    p = compiled.parameter_values(params)
+    if y0 is None:
+        y0 = compiled.initial_values(params)
+    y0 = numpy.asarray(y0, dtype=float)
+    shape = numpy.broadcast_shapes(compiled.batch_shape(p), y0.shape[:-1])
+    members = int(numpy.prod(shape, dtype=int))
+    y = numpy.broadcast_to(y0, shape + (n,)).reshape(members, n).copy()
+    p = [v if not v.ndim else numpy.broadcast_to(v, shape + v.shape[-1:])
+         .reshape((members,) + v.shape[-1:]) for v in p]
+
+    out = numpy.full((members, len(t_eval), n), numpy.nan)
+    start = int(numpy.searchsorted(t_eval, t0, side='right'))
+    out[:, :start] = y[:, numpy.newaxis]
+    status = numpy.full(members, SUCCESS)
+    steps = numpy.zeros(members, dtype=int)
+    rejected = numpy.zeros(members, dtype=int)
+    evaluations = [0]
+
+    # the working set: the members still running, compacted as they finish
+    ids = numpy.arange(members)
+    pa = p
+
+    def f(t, y):
+        evaluations[0] += 1
+        return compiled.evaluate(y, pa, t)
+
+    ta = numpy.full(members, t0)
+    fa = f(ta[:, numpy.newaxis], y)
+    ya = y
+    if first_step is None:
+        ha = _first_step(f, ta, ya, fa, scheme.order, rtol, atol)
+    else:
+        ha = numpy.full(members, float(first_step))
+    ha = numpy.minimum(numpy.minimum(ha, max_step), t1 - t0)
+    next_eval = numpy.full(members, start)
+    exponent = -1 / (scheme.order + 1)
+
+    while len(ids):
+        last = ha >= t1 - ta
+        h = ha[:, numpy.newaxis]
+        y_new, f_new, error, K = scheme.step(f, ta[:, numpy.newaxis], ya, h, fa)
+        scale = atol + rtol * numpy.maximum(numpy.abs(ya), numpy.abs(y_new))
+        err = _rms(error / scale)
+        accept = err <= 1
+        with numpy.errstate(divide='ignore'):
+            factor = numpy.where(err == 0, max_factor, safety * err ** exponent)
+        factor = numpy.clip(factor, min_factor, numpy.where(accept, max_factor, 1.0))
+        t_new = numpy.where(last, t1, ta + ha)
+        steps[ids] += 1
+        rejected[ids] += ~accept
+
+        # dense output at the t_eval points inside each accepted step
+        while True:
+            k = numpy.minimum(next_eval, len(t_eval) - 1)
+            pending = numpy.flatnonzero(accept & (next_eval < len(t_eval))
+                                        & (t_eval[k] <= t_new))
+            if not len(pending):
+                break
+            k = next_eval[pending]
+            x = ((t_eval[k] - ta[pending]) / ha[pending])[:, numpy.newaxis]
+            out[ids[pending], k] = scheme.interpolate(
+                ya[pending], h[pending], K[:, pending], x)
+            next_eval[pending] += 1
+
+        ya = numpy.where(accept[:, numpy.newaxis], y_new, ya)
+        fa = numpy.where(accept[:, numpy.newaxis], f_new, fa)
+        ta = numpy.where(accept, t_new, ta)
+        ha = numpy.minimum(ha * factor, max_step)
+        status[ids[steps[ids] >= max_steps]] = TOO_MANY_STEPS
+        status[ids[ha < 10 * _eps * numpy.abs(ta)]] = STEP_TOO_SMALL
+        ha = numpy.minimum(ha, t1 - ta)
+
+        running = (ta < t1) & (status[ids] == SUCCESS)
+        if not running.all():
+            ids, ya, fa, ta, ha, next_eval = (
+                a[running] for a in (ids, ya, fa, ta, ha, next_eval))
+            pa = [v[running] if v.ndim else v for v in pa]
+
+    timings.count('solve', 'steps', int(steps.sum()))
+    timings.count('solve', 'evaluations', evaluations[0])
+    return Solution(compiled, scheme.name, t_eval,
+                    out.reshape(shape + (len(t_eval), n)), status.reshape(shape),
+                    steps.reshape(shape), rejected.reshape(shape), evaluations[0])
@@ -0,0 +1,171 @@
+""" Sparse Jacobian of a CompiledModel.
+
+    Each branch of a compiled model is differentiated symbolically once per
+    unknown it references. Because a branch applies the same stencil to a
+    contiguous range of rows, every (branch, reference) pair contributes one
+    diagonal band of the Jacobian: its position is fixed when the pattern is
+    built and only the values need refilling on each Newton iteration.
+    The linear solves of newton reuse the pattern too: the values are
+    gathered straight into CSC order, with the columns in the fill-reducing
+    order SuperLU chose for the first factorization, so later iterations
+    neither convert the matrix nor reorder it.
+"""
+
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+import sympy
+
+from .compiler import CompileError
+from .compiler import _lambdify
+from .timing import timed
+from .timing import timings
+
+
+class Band:
+    def __init__(self, branch, arg, kernel, rows, cols):
+        self.branch = branch
+        self.arg = arg
+        self.kernel = kernel
+        self.rows = rows
+        self.cols = cols
+        self.positions = None
+
+
+def bands(compiled):
+    """ The Bands of the Jacobian of compiled, one for each unknown that
+        each branch references, with their kernels but no matrix.
+    """
+    out = []
+    for b in compiled.branches:
+        arguments = tuple(b.symbols) + b.arguments
+        for j, s in enumerate(b.symbols):
+            d = sympy.diff(b.expr, s)
+            if d == 0:
+                continue
+            n = b.rows.stop - b.rows.start
+            rows = numpy.arange(b.rows.start, b.rows.stop)
+            col = b.args[j]
+            if col.stop - col.start == n:
+                cols = numpy.arange(col.start, col.stop)
+            else:
+                cols = numpy.full(n, col.start)
+            out.append(Band(b, j, _lambdify(arguments, d), rows, cols))
+    return out
+
+
+class SparseJacobian:
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self.bands = bands(compiled)
+        self._build_pattern()
+
+    def _build_pattern(self):
+        n = self.compiled.size
+        rows = numpy.concatenate([b.rows for b in self.bands] or [[]]).astype(int)
+        cols = numpy.concatenate([b.cols for b in self.bands] or [[]]).astype(int)
+        order = numpy.lexsort((cols, rows))
+        rows = rows[order]
+        cols = cols[order]
+        # merge duplicate (row, col) entries into one stored element
+        unique = numpy.ones(len(rows), dtype=bool)
+        unique[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        slot = numpy.cumsum(unique) - 1
+        self.nnz = int(unique.sum())
+        self.duplicates = self.nnz != len(rows)
+        positions = numpy.empty(len(rows), dtype=int)
+        positions[order] = slot
+        start = 0
+        for b in self.bands:
+            b.positions = positions[start:start + len(b.rows)]
+            start += len(b.rows)
+        indptr = numpy.zeros(n + 1, dtype=int)
+        numpy.cumsum(numpy.bincount(rows[unique], minlength=n), out=indptr[1:])
+        self.matrix = scipy.sparse.csr_matrix(
+            (numpy.zeros(self.nnz), cols[unique], indptr), shape=(n, n))
+        # the CSR position of each element of the CSC form of the pattern
+        where = scipy.sparse.csr_matrix(
+            (numpy.arange(1, self.nnz + 1, dtype=float), cols[unique], indptr),
+            shape=(n, n)).tocsc()
+        self._csc = (where.data.astype(int) - 1, where.indices, where.indptr)
+        self._permuted = None
+
+    @property
+    def pattern(self):
+        p = self.matrix.copy()
+        p.data[:] = 1.0
+        return p
+
+    def evaluate(self, y, params=None, t=0.0):
+        """ Refills the values of the CSR matrix in place for state y. """
+        y = numpy.asarray(y, dtype=float)
+        if y.ndim != 1:
+            raise CompileError('the sparse Jacobian takes a single state vector')
+        p = self.compiled.parameter_values(params)
+        data = self.matrix.data
+        if self.duplicates:
+            data[:] = 0.0
+        for band in self.bands:
+            b = band.branch
+            v = band.kernel(*[y[s] for s in b.args], t, *p)
+            v = numpy.broadcast_to(v, band.rows.shape)
+            # positions are distinct within a band, so duplicates only add up
+            # across bands
+            if self.duplicates:
+                data[band.positions] += v
+            else:
+                data[band.positions] = v
+        return self.matrix
+
+
+    def _permute(self, perm_c):
+        # the CSC form of the pattern with its columns in the order perm_c
+        gather, indices, indptr = self._csc
+        counts = numpy.diff(indptr)[perm_c]
+        new_indptr = numpy.zeros(len(counts) + 1, dtype=int)
+        numpy.cumsum(counts, out=new_indptr[1:])
+        # the CSC positions of the columns, one after the other
+        positions = numpy.arange(self.nnz) - numpy.repeat(new_indptr[:-1] - indptr[perm_c],
+                                                         counts)
+        self._permuted = (perm_c, gather[positions], indices[positions], new_indptr)
+
+    def solve(self, f):
+        """ Solves J x = f for the Jacobian J last evaluated. """
+        n = self.compiled.size
+        if self._permuted is None:
+            gather, indices, indptr = self._csc
+            A = scipy.sparse.csc_matrix((self.matrix.data[gather], indices, indptr),
+                                        shape=(n, n))
+            lu = scipy.sparse.linalg.splu(A, permc_spec='COLAMD')
+            self._permute(lu.perm_c)
+            return lu.solve(f)
+        perm_c, gather, indices, indptr = self._permuted
+        A = scipy.sparse.csc_matrix((self.matrix.data[gather], indices, indptr),
+                                    shape=(n, n))
+        x = numpy.empty(n)
+        x[perm_c] = scipy.sparse.linalg.splu(A, permc_spec='NATURAL').solve(f)
+        return x
+
+
+def sparse_jacobian(compiled):
+    return SparseJacobian(compiled)
+
+
+@timed('solve')
+def newton(compiled, y0, params=None, t=0.0, tol=1e-10, maxiter=50,
+           jacobian=None):
+    """ Solves F(y) = 0 for a discrete compiled model by Newton's method,
+        refilling one sparse Jacobian in place on every iteration.
+    """
+    if jacobian is None:
+        jacobian = SparseJacobian(compiled)
+    y = numpy.array(y0, dtype=float)
+    for iteration in range(maxiter):
+        f = compiled.residual(y, params, t)
+        if numpy.max(numpy.abs(f), initial=0.0) < tol:
+            timings.count('solve', 'newton_iterations', iteration)
+            return y, iteration
+        jacobian.evaluate(y, params, t)
+        y -= jacobian.solve(f)
+    raise RuntimeError('Newton iteration did not converge in {} iterations'
+                       .format(maxiter))
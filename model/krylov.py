@@ -0,0 +1,386 @@
+""" Jacobian-free Newton-Krylov solution of compiled models.
+
+    NewtonKrylov solves the nonlinear system
+
+        G(y) = F(t, y, p) - shift * M (y - base) = 0
+
+    of a compiled model without forming its Jacobian. With shift = 0 this is
+    the steady state F(y) = 0 of a discrete model such as pde_model_disc;
+    with shift = 1/h and base the previous state it is one backward Euler
+    step of M dy/dt = F, as taken by implicit_euler. Each Newton step
+    solves J dy = -G by restarted GMRES, which needs only products J v:
+
+        'symbolic'  each branch is differentiated once in the direction of
+                    a vector of new symbols, so that J v is one kernel call
+                    per branch, like the residual itself
+        'fd'        the finite difference (F(y + e v) - F(y)) / e, one
+                    residual evaluation per product
+
+    GMRES is right preconditioned, so its residual is that of the Newton
+    system itself. A preconditioner is a Preconditioner subclass that is set
+    up once per Newton iteration and then applied to every Krylov vector;
+    Jacobi and Tridiagonal (and Banded in general) evaluate only the
+    Jacobian bands of the stencil that lie within their bandwidth. The
+    tolerance of each linear solve follows Eisenstat and Walker, loose far
+    from the solution and tight close to it, and steps that do not reduce
+    |G| are shortened by backtracking.
+
+    Every solve returns Statistics: Newton and Krylov iterations, residual
+    evaluations, products, preconditioner setups and solves, and the time
+    spent in each.
+"""
+
+import time
+
+import numpy
+import scipy.linalg
+import sympy
+
+from .compiler import CompiledModel
+from .compiler import CompileError
+from .compiler import _lambdify
+from .compiler import compile_model
+from .jacobian import bands
+from .timing import timed
+from .timing import timings
+
+_eps = numpy.finfo(float).eps
+
+
+class Statistics:
+    def __init__(self):
+        self.iterations = 0
+        self.linear_iterations = 0
+        self.residuals = 0
+        self.products = 0
+        self.setups = 0
+        self.preconditioner_solves = 0
+        self.backtracks = 0
+        self.norms = []
+        self.seconds = {'residual': 0.0, 'product': 0.0, 'preconditioner': 0.0,
+                        'total': 0.0}
+
+    def __str__(self):
+        return '{} Newton iterations, {} Krylov iterations, {} residuals, ' \
+            '{} products, {} preconditioner setups and {} solves, {} backtracks ' \
+            'in {:.6f}s (residual {:.6f}s, product {:.6f}s, preconditioner {:.6f}s)' \
+            .format(self.iterations, self.linear_iterations, self.residuals,
+                    self.products, self.setups, self.preconditioner_solves,
+                    self.backtracks, self.seconds['total'], self.seconds['residual'],
+                    self.seconds['product'], self.seconds['preconditioner'])
+
+    def add(self, other):
+        """ Accumulates the counts and times of other, e.g. over time steps. """
+        for name in ('iterations', 'linear_iterations', 'residuals', 'products',
+                     'setups', 'preconditioner_solves', 'backtracks'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.norms.extend(other.norms)
+        for name, seconds in other.seconds.items():
+            self.seconds[name] += seconds
+
+    def as_dict(self):
+        return {'iterations': self.iterations,
+                'linear_iterations': self.linear_iterations,
+                'residuals': self.residuals, 'products': self.products,
+                'setups': self.setups,
+                'preconditioner_solves': self.preconditioner_solves,
+                'backtracks': self.backtracks, 'norms': list(self.norms),
+                'seconds': dict(self.seconds)}
+
+
+class Preconditioner:
+    """ The identity. Subclasses approximate the inverse of the Newton
+        matrix J - shift * diag(mass) at the state given to setup.
+    """
+
+    def __init__(self, compiled):
+        self.compiled = compiled
+
+    def setup(self, y, p, t, shift):
+        pass
+
+    def solve(self, r):
+        return r
+
+
+class Banded(Preconditioner):
+    """ The entries of the Newton matrix within lower diagonals below and
+        upper above the main one, factored as a band matrix.
+    """
+
+    def __init__(self, compiled, lower, upper):
+        Preconditioner.__init__(self, compiled)
+        self.lower = lower
+        self.upper = upper
+        n = compiled.size
+        self.entries = []
+        for band in bands(compiled):
+            offset = band.cols - band.rows
+            keep = (offset >= -lower) & (offset <= upper)
+            if keep.any():
+                # the position of each kept entry in the flat (l + u + 1, n)
+                # band storage of scipy.linalg.solve_banded
+                position = (upper - offset[keep]) * n + band.cols[keep]
+                self.entries.append((band, keep, position))
+        self.matrix = numpy.zeros((lower + upper + 1, n))
+
+    def setup(self, y, p, t, shift):
+        ab = self.matrix
+        ab[:] = 0.0
+        flat = ab.reshape(-1)
+        for band, keep, position in self.entries:
+            b = band.branch
+            v = band.kernel(*[y[s] for s in b.args], t, *p)
+            v = numpy.broadcast_to(v, band.rows.shape)[keep]
+            numpy.add.at(flat, position, v)
+        diagonal = ab[self.upper]
+        diagonal -= shift * self.compiled.mass
+        # rows without a diagonal entry pass through unscaled
+        diagonal[diagonal == 0.0] = 1.0
+
+    def solve(self, r):
+        return scipy.linalg.solve_banded((self.lower, self.upper), self.matrix, r,
+                                         check_finite=False)
+
+
+class Jacobi(Banded):
+    def __init__(self, compiled):
+        Banded.__init__(self, compiled, 0, 0)
+
+    def solve(self, r):
+        return r / self.matrix[0]
+
+
+class Tridiagonal(Banded):
+    def __init__(self, compiled):
+        Banded.__init__(self, compiled, 1, 1)
+
+
+preconditioners = {
+    'none': Preconditioner,
+    'jacobi': Jacobi,
+    'tridiagonal': Tridiagonal,
+}
+
+
+def gmres(product, b, precondition, tol, restart, maxiter):
+    """ Solves A x = b, with A given by product(v) = A v, to |b - A x| <= tol
+        by GMRES(restart), right preconditioned by precondition(v).
+        Returns x and the number of iterations taken.
+    """
+    n = len(b)
+    x = numpy.zeros(n)
+    r = b
+    beta = numpy.linalg.norm(r)
+    iterations = 0
+    m = max(1, min(restart, n))
+    while beta > tol and iterations < maxiter:
+        V = numpy.empty((m + 1, n))
+        H = numpy.zeros((m + 1, m))
+        cs = numpy.zeros(m)
+        sn = numpy.zeros(m)
+        g = numpy.zeros(m + 1)
+        g[0] = beta
+        V[0] = r / beta
+        k = 0
+        while k < m and iterations < maxiter:
+            w = product(precondition(V[k]))
+            # modified Gram-Schmidt
+            for i in range(k + 1):
+                H[i, k] = numpy.dot(w, V[i])
+                w -= H[i, k] * V[i]
+            H[k + 1, k] = numpy.linalg.norm(w)
+            breakdown = H[k + 1, k] <= 1e-14 * numpy.abs(H[:k + 1, k]).max(initial=0.0)
+            if not breakdown:
+                V[k + 1] = w / H[k + 1, k]
+            # reduce the Hessenberg column to triangular by Givens rotations
+            for i in range(k):
+                H[i, k], H[i + 1, k] = (cs[i] * H[i, k] + sn[i] * H[i + 1, k],
+                                        -sn[i] * H[i, k] + cs[i] * H[i + 1, k])
+            d = numpy.hypot(H[k, k], H[k + 1, k])
+            cs[k], sn[k] = (H[k, k] / d, H[k + 1, k] / d) if d else (1.0, 0.0)
+            H[k, k] = d
+            H[k + 1, k] = 0.0
+            g[k + 1] = -sn[k] * g[k]
+            g[k] = cs[k] * g[k]
+            k += 1
+            iterations += 1
+            if abs(g[k]) <= tol or breakdown:
+                break
+        z = scipy.linalg.solve_triangular(H[:k, :k], g[:k], check_finite=False)
+        x = x + precondition(V[:k].T @ z)
+        r = b - product(x)
+        beta = numpy.linalg.norm(r)
+        if breakdown:
+            break
+    return x, iterations
+
+
+class NewtonKrylov:
+    def __init__(self, compiled, jvp='symbolic', preconditioner=None, restart=30):
+        if jvp not in ('symbolic', 'fd'):
+            raise ValueError('unknown Jacobian-vector product "{}"; use symbolic or fd'
+                             .format(jvp))
+        self.compiled = compiled
+        self.jvp = jvp
+        self.restart = restart
+        if preconditioner is None:
+            preconditioner = 'none'
+        if isinstance(preconditioner, str):
+            if preconditioner not in preconditioners:
+                raise ValueError('unknown preconditioner "{}"; use one of {}'.format(
+                    preconditioner, ', '.join(sorted(preconditioners))))
+            preconditioner = preconditioners[preconditioner](compiled)
+        self.preconditioner = preconditioner
+        self.directional = None
+        if jvp == 'symbolic':
+            self.directional = []
+            for b in compiled.branches:
+                directions = [sympy.Dummy('d' + str(s)) for s in b.symbols]
+                d = sum((sympy.diff(b.expr, s) * v for s, v in zip(b.symbols, directions)),
+                        sympy.Integer(0))
+                if d != 0:
+                    self.directional.append((b, _lambdify(
+                        tuple(b.symbols) + tuple(directions) + b.arguments, d)))
+
+    def _product(self, y, v, t, p, f0):
+        # J_F v, where f0 = F(y)
+        if self.directional is None:
+            norm = numpy.linalg.norm(v)
+            if norm == 0.0:
+                return numpy.zeros_like(v)
+            e = numpy.sqrt(_eps * (1.0 + numpy.linalg.norm(y))) / norm
+            return (self.compiled.evaluate(y + e * v, p, t) - f0) / e
+        out = numpy.zeros(self.compiled.size)
+        for b, kernel in self.directional:
+            out[b.rows] = kernel(*[y[s] for s in b.args], *[v[s] for s in b.args], t, *p)
+        return out
+
+    @timed('solve')
+    def solve(self, y0, params=None, t=0.0, tol=1e-10, maxiter=50, shift=0.0,
+              base=None, eta_max=0.9, max_linear=None):
+        """ Solves G(y) = 0 from y0 until max |G| < tol, returning the
+            solution and its Statistics.
+        """
+        compiled = self.compiled
+        stats = Statistics()
+        start = time.perf_counter()
+        y = numpy.array(y0, dtype=float)
+        if y.ndim != 1:
+            raise CompileError('Newton-Krylov solves take a single state vector')
+        p = compiled.parameter_values(params)
+        if compiled.batch_shape(p):
+            raise CompileError('Newton-Krylov solves take scalar parameter values')
+        mass = shift * compiled.mass
+        base = y.copy() if base is None else numpy.asarray(base, dtype=float)
+        if max_linear is None:
+            max_linear = 10 * self.restart
+
+        def residual(y):
+            begin = time.perf_counter()
+            f = compiled.evaluate(y, p, t)
+            stats.residuals += 1
+            stats.seconds['residual'] += time.perf_counter() - begin
+            return f, f - mass * (y - base)
+
+        f, g = residual(y)
+        norm = numpy.linalg.norm(g)
+        eta = eta_max
+        for iteration in range(maxiter + 1):
+            stats.norms.append(float(norm))
+            if numpy.max(numpy.abs(g), initial=0.0) < tol:
+                break
+            if iteration == maxiter:
+                raise RuntimeError('Newton-Krylov iteration did not converge in {} '
+                                   'iterations'.format(maxiter))
+            begin = time.perf_counter()
+            self.preconditioner.setup(y, p, t, shift)
+            stats.setups += 1
+            stats.seconds['preconditioner'] += time.perf_counter() - begin
+
+            def product(v, y=y, f=f):
+                begin = time.perf_counter()
+                out = self._product(y, v, t, p, f) - mass * v
+                stats.products += 1
+                stats.seconds['product'] += time.perf_counter() - begin
+                return out
+
+            def precondition(v):
+                begin = time.perf_counter()
+                out = self.preconditioner.solve(v)
+                stats.preconditioner_solves += 1
+                stats.seconds['preconditioner'] += time.perf_counter() - begin
+                return out
+
+            dy, linear = gmres(product, -g, precondition, eta * norm, self.restart,
+                               max_linear)
+            stats.linear_iterations += linear
+
+            # backtrack until |G| decreases sufficiently
+            step = 1.0
+            while True:
+                f_new, g_new = residual(y + step * dy)
+                norm_new = numpy.linalg.norm(g_new)
+                if norm_new <= (1.0 - 1e-4 * step) * norm:
+                    break
+                if step < 1e-4:
+                    raise RuntimeError('Newton-Krylov step {} does not reduce the '
+                                       'residual; the linear solves may be too '
+                                       'inexact'.format(iteration))
+                step *= 0.5
+                stats.backtracks += 1
+            y += step * dy
+            f, g = f_new, g_new
+            # Eisenstat-Walker choice 2, safeguarded against dropping too fast
+            eta_new = 0.9 * (norm_new / norm) ** 2
+            if 0.9 * eta * eta > 0.1:
+                eta_new = max(eta_new, 0.9 * eta * eta)
+            eta = min(eta_max, max(eta_new, 0.5 * tol / max(norm_new, tol)))
+            norm = norm_new
+        stats.iterations = iteration
+        stats.seconds['total'] = time.perf_counter() - start
+        timings.count('solve', 'newton_iterations', stats.iterations)
+        timings.count('solve', 'krylov_iterations', stats.linear_iterations)
+        return y, stats
+
+
+def _compiled(m):
+    return m if isinstance(m, CompiledModel) else compile_model(m)
+
+
+def newton_krylov(m, y0=None, params=None, t=0.0, tol=1e-10, maxiter=50,
+                  jvp='symbolic', preconditioner=None, restart=30):
+    """ Solves F(y) = 0 for Model or CompiledModel m from y0 (by default its
+        initial values) by Jacobian-free Newton-Krylov, returning the
+        solution and its Statistics.
+    """
+    compiled = _compiled(m)
+    if y0 is None:
+        y0 = compiled.initial_values(params)
+    solver = NewtonKrylov(compiled, jvp, preconditioner, restart)
+    return solver.solve(y0, params, t, tol, maxiter)
+
+
+def implicit_euler(m, times, params=None, y0=None, tol=1e-10, maxiter=50,
+                   jvp='symbolic', preconditioner=None, restart=30):
+    """ Integrates M dy/dt = F(t, y, p) for Model or CompiledModel m by
+        backward Euler steps between the given times, each solved by
+        Newton-Krylov. Returns the states, with axes (len(times), size), and
+        the Statistics of all the steps together.
+    """
+    compiled = _compiled(m)
+    times = numpy.asarray(times, dtype=float)
+    if times.ndim != 1 or (numpy.diff(times) <= 0).any():
+        raise ValueError('times must be strictly increasing')
+    if y0 is None:
+        y0 = compiled.initial_values(params)
+    solver = NewtonKrylov(compiled, jvp, preconditioner, restart)
+    out = numpy.empty((len(times), compiled.size))
+    out[0] = y0
+    stats = Statistics()
+    for k in range(1, len(times)):
+        y, s = solver.solve(out[k - 1], params, times[k], tol, maxiter,
+                            shift=1.0 / (times[k] - times[k - 1]), base=out[k - 1])
+        out[k] = y
+        stats.add(s)
+    return out, stats
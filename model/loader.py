@@ -0,0 +1,273 @@
+""" Lazy loader from a MathML collection file back to Model objects.
+
+    Opening a file only scans it, memory-mapped, for the byte ranges of the
+    <model> elements directly inside each <collection>. A model is parsed
+    with lxml and mml2sympy the first time it is asked for; its includes
+    refer to other models of the same collection by name and are loaded,
+    once, along with it.
+"""
+
+import mmap
+import re
+
+from lxml import etree
+
+from derivative.ContentMathML import mml2sympy_worker
+from derivative.ContentMathML import strip_namespaces
+
+from .model import ArrayEquation
+from .model import Connection
+from .model import Include
+from .model import Model
+from .model import Models
+from .timing import timed
+
+_TAGS = re.compile(
+    rb'<(/?)(collection|model|connection)\b((?:[^>"\']|"[^"]*"|\'[^\']*\')*)>')
+_NAME = re.compile(rb'\bname\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+
+class CollectionFormatError(ValueError):
+    pass
+
+
+class IndexEntry:
+    def __init__(self, name, collection, start, end):
+        self.name = name
+        self.collection = collection
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return 'IndexEntry({!r}, collection={}, bytes={}..{})'.format(
+            self.name, self.collection, self.start, self.end)
+
+
+def _unescape(name):
+    return etree.fromstring(b'<a name="' + name + b'"/>').get('name')
+
+
+def index_collection(buffer):
+    """ Returns the top level models of each <collection> in buffer, as a
+        list of lists of IndexEntry, and the byte ranges of <connection>s.
+        Raises CollectionFormatError if the <model> tags do not nest.
+    """
+    collections = []
+    connections = []
+    depth = 0
+    connection = None
+    stack = []
+    for match in _TAGS.finditer(buffer):
+        closing, tag, attrs = match.group(1), match.group(2), match.group(3)
+        self_closing = attrs.endswith(b'/')
+        if tag == b'collection':
+            if not closing:
+                collections.append([])
+            continue
+        if tag == b'connection':
+            if closing:
+                connections.append((connection, match.end()))
+                connection = None
+            elif not self_closing:
+                connection = match.start()
+            continue
+        if connection is not None:
+            continue
+        if closing:
+            if not stack:
+                raise CollectionFormatError(
+                    '</model> at byte {} closes no <model>'
+                    .format(match.start()))
+            depth -= 1
+            start, name = stack.pop()
+            if depth == 0:
+                collections[-1].append(
+                    IndexEntry(name, len(collections) - 1, start, match.end()))
+        elif not self_closing:
+            if not collections:
+                raise CollectionFormatError(
+                    '<model> at byte {} is outside any <collection>'
+                    .format(match.start()))
+            n = _NAME.search(attrs)
+            name = _unescape(n.group(1) if n.group(1) is not None else n.group(2))
+            stack.append((match.start(), name))
+            depth += 1
+    if stack:
+        start, name = stack[-1]
+        raise CollectionFormatError(
+            '<model name="{}"> at byte {} is not closed'.format(name, start))
+    return collections, connections
+
+
+@timed('mml2sympy')
+def _parse(element):
+    return mml2sympy_worker(element)
+
+
+def _expressions(element):
+    return [_parse(child) for child in element.iterchildren(etree.Element)]
+
+
+def _equations(element):
+    eqs = set()
+    for e in _expressions(element):
+        if isinstance(e, tuple) and len(e) == 4:
+            e = ArrayEquation(*e)
+        eqs.add(e)
+    return eqs
+
+
+def _bounds(element):
+    children = list(element.iterchildren(etree.Element))
+    if not children:
+        return None
+    return _parse(children[0])
+
+
+def _mapping(element):
+    mapping = {}
+    for m in element.iterchildren('map'):
+        f, t = m.iterchildren('cs')
+        mapping[f.text or ''] = t.text or ''
+    return mapping
+
+
+class CollectionLoader:
+    """ Maps model names to Models, parsing each on first access.
+
+        loader = CollectionLoader('library.xml')
+        loader.names()          # from the index only
+        m = loader['domain']    # parses 'domain' and the models it includes
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            self._buffer = b''
+        self.collections, self._connections = index_collection(self._buffer)
+        self.index = {}
+        for entries in self.collections:
+            for entry in entries:
+                self.index.setdefault(entry.name, entry)
+        self._models = {}
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __getitem__(self, name):
+        return self.model(name)
+
+    def names(self):
+        return list(self.index)
+
+    def loaded(self):
+        return [key[1] for key in self._models]
+
+    def model(self, name, collection=None):
+        """ Returns the Model called name, from the first collection that
+            defines it unless collection (an index) is given.
+        """
+        if collection is None:
+            entry = self.index[name]
+        else:
+            matches = [e for e in self.collections[collection] if e.name == name]
+            if not matches:
+                raise KeyError(name)
+            entry = matches[0]
+        key = (entry.collection, entry.name)
+        if key not in self._models:
+            self._models[key] = self._materialize(entry)
+        return self._models[key]
+
+    def main_models(self):
+        """ The last model of each collection, as written by model_to_mathml. """
+        return [self.model(entries[-1].name, i)
+                for i, entries in enumerate(self.collections) if entries]
+
+    def models(self):
+        """ Rebuilds the Models written by models_to_mathml. """
+        out = Models()
+        main = self.main_models()
+        out.models = main
+        by_name = {m.name: m for m in main}
+        connections = []
+        for start, end in self._connections:
+            element = strip_namespaces(etree.fromstring(self._buffer[start:end]))
+            ends = []
+            for m in element.iterchildren('model'):
+                ends.append((by_name[m.get('name')], _bounds(m)))
+            connections.append(Connection(*ends))
+        out.connections = connections
+        return out
+
+    def contents(self):
+        """ What was written: the Models of models_to_mathml when the file
+            has connections or several collections, else the Model of
+            model_to_mathml.
+        """
+        if self._connections or len(self.collections) > 1:
+            return self.models()
+        main = self.main_models()
+        if not main:
+            raise CollectionFormatError('{} holds no models'.format(self.path))
+        return main[0]
+
+    def _element(self, entry):
+        return strip_namespaces(etree.fromstring(self._buffer[entry.start:entry.end]))
+
+    def _materialize(self, entry):
+        element = self._element(entry)
+        m = Model()
+        m.name = element.get('name')
+        for child in element.iterchildren(etree.Element):
+            if child.tag == 'solution_variables':
+                m.solution_variables = set(_expressions(child))
+            elif child.tag == 'domainofapplication':
+                m.bounds = _bounds(child)
+            elif child.tag == 'parameters':
+                m.parameters = _expressions(child)
+            elif child.tag == 'equations':
+                m.eqs = _equations(child)
+            elif child.tag == 'includes':
+                m.includes = {self._include(i, entry.collection)
+                              for i in child.iterchildren('model')}
+        return m
+
+    def _include(self, element, collection):
+        submodel = self.model(element.get('name'), collection)
+        bounds = None
+        eqs = set()
+        mapping = {}
+        for child in element.iterchildren(etree.Element):
+            if child.tag == 'mapping':
+                mapping = _mapping(child)
+            elif child.tag == 'domainofapplication':
+                bounds = _bounds(child)
+            elif child.tag == 'equations':
+                eqs = _equations(child)
+        return Include(submodel, bounds, eqs, mapping)
+
+
+def load_collection(path):
+    return CollectionLoader(path)
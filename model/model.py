@@ -2,9 +2,17 @@ import sympy
 import xml.etree.ElementTree as ET
 import numbers
 import collections
+import copy
 
+from .emitter import emit_mathml
+from .timing import timed
+from .tracking import Tracked
+
+
+class Model(Tracked):
+    fields = ('name', 'solution_variables', 'bounds', 'parameters', 'eqs',
+              'includes')
 
-class Model:
     def __init__(self):
         self.name = ''
         self.solution_variables = {}
@@ -60,7 +68,9 @@ class Models:
         return out
 
 
-class Include:
+class Include(Tracked):
+    fields = ('submodel', 'bounds', 'eqs', 'mapping')
+
     def __init__(self, submodel, bounds, eqs, mapping):
         self.submodel = submodel
         self.bounds = bounds
@@ -85,6 +95,37 @@ class Include:
         return out
 
 
+class ArrayEquation(tuple):
+    """ A stencil equation that holds at every value of index from lower to
+        upper inclusive, e.g. ArrayEquation(i, 1, N - 1, Eq(c[i+1] - 2*c[i] +
+        c[i-1], 0)). Its size does not depend on the length of the range, and
+        lower and upper may be symbolic. As a tuple it is the guarded
+        (domain, equation) pair, so it can be used wherever those are.
+    """
+
+    def __new__(cls, index, lower, upper, stencil):
+        lower = sympy.sympify(lower)
+        upper = sympy.sympify(upper)
+        self = tuple.__new__(cls, (sympy.And(index >= lower, index <= upper),
+                                   stencil))
+        self.index = index
+        self.lower = lower
+        self.upper = upper
+        self.stencil = stencil
+        return self
+
+    def __getnewargs__(self):
+        return (self.index, self.lower, self.upper, self.stencil)
+
+    def __repr__(self):
+        return 'ArrayEquation({}, {}, {}, {})'.format(
+            self.index, self.lower, self.upper, self.stencil)
+
+    def __str__(self):
+        return '{} for {} <= {} <= {}'.format(
+            self.stencil, self.lower, self.index, self.upper)
+
+
 class Connection:
     def __init__(self, origin, to):
         self.origin = origin
@@ -109,9 +150,9 @@ def symbol_to_mathml(s):
     return root
 
 
+@timed('sympy_to_mathml')
 def sympy_to_mathml(s):
-    mathml_str = sympy.printing.mathml(s)
-    return ET.fromstring(mathml_str)
+    return emit_mathml(s)
 
 
 def number_or_equation(s):
@@ -143,64 +184,181 @@ def mapping_to_mathml(maps):
         t = ET.Element('cs')
         t.text = v
         m.append(t)
-    root.append(m)
+        root.append(m)
     return root
 
 
-def include_to_mathml(include):
+def _include_key(include, keys):
+    # an include element depends on the include, the name of its submodel
+    # and, recursively, on the includes of the submodel
+    try:
+        return keys[include]
+    except KeyError:
+        pass
+    submodel = include.submodel
+    key = (include.stamp(), submodel.stamp('name'), _includes_key(submodel, keys))
+    keys[include] = key
+    return key
+
+
+def _includes_key(m, keys):
+    return (m.stamp('includes'),) + tuple(_include_key(i, keys) for i in m.includes)
+
+
+def serialization_key(m, keys=None):
+    """ A value that changes whenever the <model> element of m would. keys
+        memoizes the keys of includes over one serialization.
+    """
+    return (m.stamp(), _includes_key(m, {} if keys is None else keys))
+
+
+def _cached(owner, name, key, build):
+    cached = owner.__dict__.get(name)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    value = build()
+    object.__setattr__(owner, name, (key, value))
+    return value
+
+
+def include_to_mathml(include, nested=None):
+    """ The element of include, a copy of the one cached on it. The cache is
+        rebuilt only once include, the name of its submodel or the
+        submodel's includes change. nested memoizes the cache keys over one
+        serialization.
+    """
+    if nested is None:
+        nested = {}
+    return copy.deepcopy(_cached_include(include, nested))
+
+
+def _cached_include(include, nested):
+    return _cached(include, '_cache_mathml', _include_key(include, nested),
+                   lambda: _include_to_mathml(include, nested))
+
+
+def _include_to_mathml(include, nested):
     submodel = include.submodel
-    eqs = include.eqs
     root = ET.Element("model", name=submodel.name)
     for i in submodel.includes:
-        root.append(include_to_mathml(i))
+        root.append(_cached_include(i, nested))
 
     root.append(mapping_to_mathml(include.mapping))
-    root.append(bounds_to_mathml(include.bounds))
+    if include.bounds is not None:
+        root.append(bounds_to_mathml(include.bounds))
     root.append(equations_to_mathml(include.eqs))
+    include.mark_clean()
 
     return root
 
 
+def array_equation_to_mathml(eq):
+    node = ET.Element('apply')
+    node.append(ET.Element('eq'))
+    bvar = ET.Element('bvar')
+    bvar.append(sympy_to_mathml(eq.index))
+    node.append(bvar)
+    lowlimit = ET.Element('lowlimit')
+    lowlimit.append(sympy_to_mathml(eq.lower))
+    node.append(lowlimit)
+    uplimit = ET.Element('uplimit')
+    uplimit.append(sympy_to_mathml(eq.upper))
+    node.append(uplimit)
+    node.append(sympy_to_mathml(eq.stencil.args[0]))
+    node.append(sympy_to_mathml(eq.stencil.args[1]))
+    return node
+
+
+def equation_to_mathml(eq):
+    if isinstance(eq, ArrayEquation):
+        return array_equation_to_mathml(eq)
+    elif isinstance(eq, tuple):
+        node = ET.Element('apply')
+        node.append(ET.Element('eq'))
+        domain = ET.Element('domainofapplication')
+        domain.append(sympy_to_mathml(eq[0]))
+        node.append(domain)
+        lhs = sympy_to_mathml(eq[1].args[0])
+        rhs = sympy_to_mathml(eq[1].args[1])
+        node.append(lhs)
+        node.append(rhs)
+        return node
+    else:
+        return sympy_to_mathml(eq)
+
+
+@timed('equations_to_mathml')
 def equations_to_mathml(eqs):
     root = ET.Element("equations")
     for eq in eqs:
-        if isinstance(eq, tuple):
-            node = ET.Element('apply')
-            node.append(ET.Element('eq'))
-            domain = ET.Element('domainofapplication')
-            domain.append(sympy_to_mathml(eq[0]))
-            node.append(domain)
-            lhs = sympy_to_mathml(eq[1].args[0])
-            rhs = sympy_to_mathml(eq[1].args[1])
-            node.append(lhs)
-            node.append(rhs)
-            root.append(node)
-        else:
-            root.append(sympy_to_mathml(eq))
+        root.append(equation_to_mathml(eq))
     return root
 
 
-def includes_to_mathml(includes):
+def includes_to_mathml(includes, nested=None):
+    if nested is None:
+        nested = {}
+    return copy.deepcopy(_includes_section(includes, nested))
+
+
+def _includes_section(includes, nested):
     root = ET.Element("includes")
     for i in includes:
-        root.append(include_to_mathml(i))
+        root.append(_cached_include(i, nested))
     return root
 
 
-def submodel_to_mathml(m):
-    root = ET.Element("model", name=m.name)
+@timed('equations_to_mathml')
+def _equations_section(m):
+    # elements are kept per equation, so that editing one equation of a
+    # large model converts only that one
+    cache = m.__dict__.get('_cache_equations', {})
+    elements = {}
+    root = ET.Element("equations")
+    for eq in m.eqs:
+        key = (type(eq), eq)
+        e = cache.get(key)
+        if e is None:
+            e = equation_to_mathml(eq)
+        elements[key] = e
+        root.append(e)
+    object.__setattr__(m, '_cache_equations', elements)
+    return root
+
 
+def submodel_to_mathml(m, nested=None):
+    """ The <model> element of m, a copy of the one cached on m. It and each
+        of its sections are rebuilt only when they change (see
+        model.tracking).
+    """
+    if nested is None:
+        nested = {}
+    return copy.deepcopy(_cached(m, '_cache_mathml', serialization_key(m, nested),
+                                 lambda: _submodel_to_mathml(m, nested)))
 
-    root.append(solution_variables_to_mathml(m.solution_variables))
 
-    root.append(bounds_to_mathml(m.bounds))
+def _submodel_to_mathml(m, nested):
+    root = ET.Element("model", name=m.name)
+
+    root.append(_cached(m, '_cache_solution_variables', m.stamp('solution_variables'),
+                        lambda: solution_variables_to_mathml(m.solution_variables)))
 
-    root.append(parameters_to_mathml(m.parameters))
+    # a model without bounds, such as a system of algebraic equations, has
+    # no <domainofapplication>
+    if m.bounds is not None:
+        root.append(_cached(m, '_cache_bounds', m.stamp('bounds'),
+                            lambda: bounds_to_mathml(m.bounds)))
 
-    root.append(equations_to_mathml(m.eqs))
+    root.append(_cached(m, '_cache_parameters', m.stamp('parameters'),
+                        lambda: parameters_to_mathml(m.parameters)))
 
-    root.append(includes_to_mathml(m.includes))
+    root.append(_cached(m, '_cache_eqs', m.stamp('eqs'),
+                        lambda: _equations_section(m)))
 
+    root.append(_cached(m, '_cache_includes', _includes_key(m, nested),
+                        lambda: _includes_section(m.includes, nested)))
+
+    m.mark_clean()
     return root
 
 
@@ -212,8 +370,11 @@ def parameters_to_mathml(params):
 
 
 def collect_models(m, models, parameters):
-    for (m, _, _) in m.includes:
-        collect_models(m, models, parameters)
+    # a submodel included in several places is collected once
+    if m in models:
+        return
+    for i in m.includes:
+        collect_models(i.submodel, models, parameters)
 
     # collect all the models
     models[m] = None
@@ -232,6 +393,7 @@ def collect_models(m, models, parameters):
         parameters[peq] = None
 
 
+@timed('model_to_mathml')
 def model_to_mathml(d):
     root = ET.Element("collection")
     # collect internal models
@@ -241,11 +403,12 @@ def model_to_mathml(d):
         collect_models(i.submodel, models, parameters)
 
     # serialise internal models
+    nested = {}
     for m in models.keys():
-        root.append(submodel_to_mathml(m))
+        root.append(submodel_to_mathml(m, nested))
 
     # serialise this models
-    root.append(submodel_to_mathml(d))
+    root.append(submodel_to_mathml(d, nested))
 
     return root
 
@@ -260,6 +423,7 @@ def connection_to_mathml(m):
     return root
 
 
+@timed('model_to_mathml')
 def models_to_mathml(model):
     root = ET.Element("models")
 
@@ -0,0 +1,171 @@
+""" Parallel residual assembly over shards of the state in shared memory.
+
+    Every branch of a compiled stencil model, such as the i == 0, interior
+    and i == N equations of pde_model_disc, fills a contiguous range of
+    rows. ParallelResidual splits the rows into contiguous shards, cuts each
+    branch into the pieces that fall within each shard (as the block solves
+    of model.structure do), and assembles the shards in a process pool:
+
+    - the state and the residual live in multiprocessing.shared_memory, so
+      neither is pickled: evaluate copies y into the shared state and the
+      assembled residual out of the shared one. Writing to `state` and
+      reading `out` directly avoids both copies; the two arrays are valid
+      until close.
+    - a shard writes only its own rows of the residual, but its stencil
+      reads a halo of the state beyond them, the rows of its neighbours
+      within the reach of the stencil. All shards are dispatched after the
+      state is written and it is not written again until they finish, so
+      the workers read their halo straight from the shared state instead
+      of exchanging copies of it.
+    - each worker receives the compiled model and the shard layout once,
+      when it starts; each evaluation then sends only the shard number,
+      the time and the parameter values.
+
+    With workers = 1 the shards are assembled in this process, through the
+    same pieces. The pool only pays for itself on grids of millions of rows;
+    below that, CompiledModel.evaluate is faster.
+
+        with model.parallel_residual(model.compile_model(m), workers=8) as r:
+            f = r.residual(y, params)
+"""
+
+import os
+
+import numpy
+from multiprocessing import shared_memory
+
+from .compiler import CompileError
+from .structure import Piece
+
+
+class Shard:
+    def __init__(self, rows, pieces):
+        self.rows = rows
+        self.pieces = pieces
+        # the range of the state read by the pieces, own rows included
+        reads = [(s.start, s.stop) for piece in pieces for s in piece.args]
+        self.halo = slice(min([rows.start] + [lo for lo, _ in reads]),
+                          max([rows.stop] + [hi for _, hi in reads]))
+
+    def __repr__(self):
+        return 'Shard(rows={}:{}, halo={}:{})'.format(
+            self.rows.start, self.rows.stop, self.halo.start, self.halo.stop)
+
+    def assemble(self, y, out, t, p):
+        for piece in self.pieces:
+            out[piece.lo:piece.hi] = piece.branch.kernel(
+                *[y[s] for s in piece.args], t, *p)
+
+
+def shards(compiled, n):
+    """ Splits the rows of compiled into n contiguous Shards of equal size. """
+    bounds = numpy.linspace(0, compiled.size, n + 1).round().astype(int)
+    out = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo == hi:
+            continue
+        pieces = []
+        for b in compiled.branches:
+            a = max(lo, b.rows.start)
+            z = min(hi, b.rows.stop)
+            if a < z:
+                pieces.append(Piece(b, a, z, []))
+        out.append(Shard(slice(int(lo), int(hi)), pieces))
+    return out
+
+
+def _attach(name, size):
+    # the workers share the resource tracker of the process that created
+    # the block, which unlinks it once, in close
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, numpy.ndarray(size, dtype=float, buffer=memory.buf)
+
+
+_installed = {}
+
+
+def _install(compiled, layout, state, residual):
+    _installed.clear()
+    memory, y = _attach(state, compiled.size)
+    memory_out, out = _attach(residual, compiled.size)
+    _installed.update(memory=(memory, memory_out), y=y, out=out,
+                      shards=layout)
+
+
+def _assemble(k, t, p):
+    _installed['shards'][k].assemble(_installed['y'], _installed['out'], t, p)
+    return k
+
+
+class ParallelResidual:
+    def __init__(self, compiled, workers=None, n_shards=None):
+        self.compiled = compiled
+        self.workers = workers or os.cpu_count()
+        self.shards = shards(compiled, n_shards or self.workers)
+        n = max(compiled.size, 1)
+        self._memory = [shared_memory.SharedMemory(create=True, size=8 * n)
+                        for _ in range(2)]
+        self.state = numpy.ndarray(compiled.size, dtype=float,
+                                   buffer=self._memory[0].buf)
+        self.out = numpy.ndarray(compiled.size, dtype=float,
+                                 buffer=self._memory[1].buf)
+        self.pool = None
+        if self.workers > 1 and len(self.shards) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            self.pool = ProcessPoolExecutor(
+                self.workers, initializer=_install,
+                initargs=(compiled, self.shards, self._memory[0].name,
+                          self._memory[1].name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        if self._memory:
+            self.state = self.out = None
+            for memory in self._memory:
+                memory.close()
+                memory.unlink()
+            self._memory = []
+
+    def residual(self, y=None, params=None, t=0.0, out=None):
+        """ Evaluates F(t, y, p) for a single state y, shard by shard; with
+            y None, the state is taken to be in `state` already.
+        """
+        return self.evaluate(y, self.compiled.parameter_values(params), t, out)
+
+    def evaluate(self, y, p, t=0.0, out=None):
+        """ residual() for parameter values p already converted by
+            CompiledModel.parameter_values.
+        """
+        if self.compiled.batch_shape(p):
+            raise CompileError('parallel residuals take scalar parameter values')
+        if y is not None:
+            y = numpy.asarray(y, dtype=float)
+            if y.shape != self.state.shape:
+                raise CompileError('parallel residuals take a single state vector '
+                                   'of size {}'.format(self.compiled.size))
+            self.state[:] = y
+        if self.pool is None:
+            for shard in self.shards:
+                shard.assemble(self.state, self.out, t, p)
+        else:
+            futures = [self.pool.submit(_assemble, k, t, p)
+                       for k in range(len(self.shards))]
+            for future in futures:
+                future.result()
+        if out is None:
+            return self.out.copy()
+        out[:] = self.out
+        return out
+
+
+def parallel_residual(compiled, workers=None, n_shards=None):
+    return ParallelResidual(compiled, workers, n_shards)
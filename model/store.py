@@ -0,0 +1,363 @@
+""" Chunked, memory-mapped storage of solutions too long to hold in memory.
+
+    A solution store is a directory holding
+
+        times.f8       the axis values (time, or the index of a marched
+                       discrete model), one float64 per row
+        values.f8      the solution, one row of row_shape float64s per axis
+                       value
+        metadata.json  the row count and shape, the layout of the state
+                       vector, the axis name, the fingerprint of the Model
+                       and the parameter values it was solved with
+
+    A SolutionWriter grows both files one chunk of rows at a time and
+    writes into a memory map of the current chunk only, so the resident
+    memory stays at one chunk whatever the length of the run. Every
+    flush_interval stored rows, the maps are flushed and metadata.json is
+    replaced atomically, so a reader opened during a run sees only complete
+    rows. With decimate = k only every k-th row given to append is stored.
+
+    march_to_store and integrate_to_store stream the solution of an
+    explicit discrete model (such as ode_model_disc) or of an ODE model
+    into a store as the solver advances. open_solution returns a
+    SolutionReader that memory maps the files and slices axis windows
+    without reading the rest:
+
+        model.march_to_store(model_library.ode_model_disc(1e-6, 10**8), 'run',
+                             {'r': 1, 'K': 1, 'cinit': 0.1}, decimate=100)
+        with model.open_solution('run') as s:
+            t, c = s.window(0.5e8, 0.6e8)
+"""
+
+import copy
+import json
+import os
+
+import numpy
+
+from runtime.evaluation import apply_updates
+
+from ._io import atomic_write
+from .cache import fingerprint
+from .compiler import CompiledModel
+from .compiler import CompileError
+from .compiler import compile_model
+from .integrate import integrate
+from .timing import timed
+
+FORMAT = 1
+
+
+class StoreError(ValueError):
+    pass
+
+
+def _layout(compiled):
+    return {name: [v.start, v.size] for name, v in compiled.variables.items()}
+
+
+def _parameters(compiled, p):
+    return {name: v.tolist() for name, v in zip(compiled.parameters, p)}
+
+
+class SolutionWriter:
+    def __init__(self, path, row_shape, axis='t', name=None, variables=None,
+                 fingerprint=None, parameters=None, chunk_rows=65536,
+                 flush_interval=None, decimate=1):
+        if chunk_rows < 1 or decimate < 1:
+            raise StoreError('chunk_rows and decimate must be positive')
+        self.path = path
+        self.row_shape = tuple(int(n) for n in row_shape)
+        self.row_size = int(numpy.prod(self.row_shape, dtype=int))
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval or chunk_rows
+        self.decimate = decimate
+        self.metadata = {
+            'format': FORMAT,
+            'name': name,
+            'axis': axis,
+            'row_shape': list(self.row_shape),
+            'variables': variables,
+            'fingerprint': fingerprint,
+            'parameters': parameters,
+            'decimate': decimate,
+            'rows': 0,
+            'complete': False,
+        }
+        self.rows = 0
+        self.seen = 0
+        self.unflushed = 0
+        self.last = -numpy.inf
+        self.chunk = None
+        os.makedirs(path, exist_ok=True)
+        self._times = open(os.path.join(path, 'times.f8'), 'w+b')
+        self._values = open(os.path.join(path, 'values.f8'), 'w+b')
+        self._write_metadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        if kind is None:
+            self.close()
+        else:
+            self.close(complete=False)
+        return False
+
+    def _write_metadata(self):
+        self.metadata['rows'] = self.rows
+        atomic_write(os.path.join(self.path, 'metadata.json'),
+                     json.dumps(self.metadata, indent=2, sort_keys=True))
+
+    def _map(self, k):
+        # grows the files to hold chunk k and maps it
+        rows = (k + 1) * self.chunk_rows
+        self._times.truncate(rows * 8)
+        self._values.truncate(rows * self.row_size * 8)
+        times = numpy.memmap(self._times, dtype=float, mode='r+',
+                             offset=k * self.chunk_rows * 8, shape=(self.chunk_rows,))
+        values = numpy.memmap(self._values, dtype=float, mode='r+',
+                              offset=k * self.chunk_rows * self.row_size * 8,
+                              shape=(self.chunk_rows,) + self.row_shape)
+        self.chunk = (k, times, values)
+
+    def append(self, t, values):
+        """ Appends the rows values, with axis values t; a single row may be
+            given as a scalar t and values of shape row_shape.
+        """
+        t = numpy.asarray(t, dtype=float)
+        values = numpy.asarray(values, dtype=float)
+        if t.ndim == 0:
+            t = t[numpy.newaxis]
+            values = values[numpy.newaxis]
+        if values.shape != t.shape + self.row_shape:
+            raise StoreError('rows of shape {} do not match the store rows of shape {}'
+                             .format(values.shape[1:], self.row_shape))
+        if len(t) and (t[0] < self.last or (numpy.diff(t) < 0).any()):
+            raise StoreError('axis values must not decrease')
+        if len(t):
+            self.last = t[-1]
+        keep = (self.seen + numpy.arange(len(t))) % self.decimate == 0
+        self.seen += len(t)
+        if not keep.all():
+            t = t[keep]
+            values = values[keep]
+        while len(t):
+            k, offset = divmod(self.rows, self.chunk_rows)
+            if self.chunk is None or self.chunk[0] != k:
+                self.flush()
+                self._map(k)
+            n = min(len(t), self.chunk_rows - offset)
+            _, times, chunk = self.chunk
+            times[offset:offset + n] = t[:n]
+            chunk[offset:offset + n] = values[:n]
+            t = t[n:]
+            values = values[n:]
+            self.rows += n
+            self.unflushed += n
+            if self.unflushed >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        if self.chunk is not None:
+            self.chunk[1].flush()
+            self.chunk[2].flush()
+            if self.chunk[0] != self.rows // self.chunk_rows:
+                # the chunk is full; unmap it
+                self.chunk = None
+        if self.unflushed:
+            self._write_metadata()
+            self.unflushed = 0
+
+    def close(self, **metadata):
+        """ Flushes, trims the files to the stored rows and marks the store
+            complete, adding any further metadata given.
+        """
+        if self._times is None:
+            return
+        self.flush()
+        self.chunk = None
+        self._times.truncate(self.rows * 8)
+        self._values.truncate(self.rows * self.row_size * 8)
+        self._times.close()
+        self._values.close()
+        self._times = self._values = None
+        self.metadata['complete'] = True
+        self.metadata.update(metadata)
+        self._write_metadata()
+
+
+class SolutionReader:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        if self.metadata.get('format') != FORMAT:
+            raise StoreError('{} is not a solution store of format {}'
+                             .format(path, FORMAT))
+        self.rows = self.metadata['rows']
+        self.row_shape = tuple(self.metadata['row_shape'])
+        self.times = self._map('times.f8', ())
+        self.values = self._map('values.f8', self.row_shape)
+
+    def _map(self, filename, shape):
+        if not self.rows:
+            return numpy.empty((0,) + shape)
+        return numpy.memmap(os.path.join(self.path, filename), dtype=float, mode='r',
+                            shape=(self.rows,) + shape)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        self.times = self.values = None
+
+    @property
+    def fingerprint(self):
+        return self.metadata['fingerprint']
+
+    @property
+    def parameters(self):
+        return self.metadata['parameters']
+
+    def rows_between(self, t0=None, t1=None):
+        """ The slice of the rows with t0 <= t <= t1, found by bisection. """
+        start = 0 if t0 is None else int(numpy.searchsorted(self.times, t0, side='left'))
+        stop = self.rows if t1 is None else int(
+            numpy.searchsorted(self.times, t1, side='right'))
+        return slice(start, stop)
+
+    def window(self, t0=None, t1=None):
+        """ The (times, values) of the rows with t0 <= t <= t1, as views of
+            the memory maps; nothing is read until they are used.
+        """
+        rows = self.rows_between(t0, t1)
+        return self.times[rows], self.values[rows]
+
+    def variable(self, name, t0=None, t1=None):
+        """ The values of unknown name in the rows with t0 <= t <= t1. """
+        variables = self.metadata['variables']
+        if not variables or name not in variables:
+            raise StoreError('the store has no unknown "{}"'.format(name))
+        start, size = variables[name]
+        return self.values[self.rows_between(t0, t1)][..., start:start + size]
+
+
+def open_solution(path):
+    return SolutionReader(path)
+
+
+def _compiled(m):
+    if isinstance(m, CompiledModel):
+        return m, None
+    return compile_model(m), fingerprint(m)
+
+
+@timed('solve')
+def march_to_store(m, path, params=None, t=0.0, chunk_rows=65536, flush_interval=None,
+                   decimate=1):
+    """ Marches explicit discrete Model or CompiledModel m, whose unknowns
+        are all indexed over the model index, chunk_rows indices at a time
+        and stores one row per index with one column per unknown. Only a
+        window of the state around the current chunk is held in memory.
+        Returns a SolutionReader of the store.
+    """
+    compiled, fp = _compiled(m)
+    lower, upper = compiled.lower, compiled.upper
+    if lower is None:
+        raise CompileError('model "{}" has no index to march over'.format(compiled.name))
+    names = sorted(compiled.variables, key=lambda n: compiled.variables[n].start)
+    if any(not compiled.variables[n].indexed
+           or compiled.variables[n].size != upper - lower + 1 for n in names):
+        raise CompileError('model "{}" has unknowns not indexed over {}..{}; '
+                           'march it with CompiledModel.march'
+                           .format(compiled.name, lower, upper))
+    updates = compiled.updates()
+    p = compiled.parameter_values(params)
+    batch = compiled.batch_shape(p)
+
+    # the offset of every index read or written from the equation index
+    reads = []
+    writes = []
+    for u in updates:
+        shift = compiled.variables[u.variable].start - lower
+        writes.append(u.target - shift)
+        reads.extend(k - shift for k in u.positions)
+    lo = min(reads + writes)
+    hi = max(writes)
+    lead = min(writes)
+    carry = hi - lo
+    width = chunk_rows + carry
+    window = numpy.zeros(batch + (len(names), width))
+    flat = window.reshape(batch + (len(names) * width,))
+
+    variables = {n: [k, 1] for k, n in enumerate(names)}
+    with SolutionWriter(path, batch + (len(names),), str(compiled.index), compiled.name,
+                        variables, fp, _parameters(compiled, p), chunk_rows,
+                        flush_interval, decimate) as writer:
+        emitted = lower
+        for start in range(lower, upper + 1, chunk_rows):
+            stop = min(start + chunk_rows, upper + 1)
+            base = start + lo
+            # the same updates, with positions in the window for this chunk
+            shifted = []
+            for u in updates:
+                delta = names.index(u.variable) * width - base \
+                    - (compiled.variables[u.variable].start - lower)
+                s = copy.copy(u)
+                s.target = u.target + delta
+                s.positions = [k + delta for k in u.positions]
+                shifted.append(s)
+            apply_updates(flat, shifted, start, stop, p, t)
+            done = upper + 1 if stop == upper + 1 else min(stop + lead, upper + 1)
+            if done > emitted:
+                rows = numpy.moveaxis(window[..., emitted - base:done - base], -1, 0)
+                writer.append(numpy.arange(emitted, done, dtype=float), rows)
+                emitted = done
+            window[..., :carry] = window[..., stop - start:stop - start + carry]
+            window[..., carry:] = 0.0
+    return SolutionReader(path)
+
+
+def integrate_to_store(m, path, t_eval, params=None, y0=None, chunk_rows=65536,
+                       flush_interval=None, decimate=1, **options):
+    """ Integrates ODE Model or CompiledModel m with model.integrate,
+        chunk_rows points of t_eval at a time, each chunk starting from the
+        end of the one before, and stores the solution at every point with
+        the axes (t, batch..., size). Returns a SolutionReader of the store;
+        if a member fails, the run stops there and the store's metadata
+        holds the integrator status of every member.
+    """
+    compiled, fp = _compiled(m)
+    t_eval = numpy.asarray(t_eval, dtype=float)
+    if t_eval.ndim != 1 or len(t_eval) < 2:
+        raise ValueError('t_eval must hold at least two times')
+    if chunk_rows < 2:
+        raise StoreError('chunk_rows must be at least 2')
+    p = compiled.parameter_values(params)
+    y = compiled.initial_values(params) if y0 is None else numpy.asarray(y0, dtype=float)
+    batch = numpy.broadcast_shapes(compiled.batch_shape(p), y.shape[:-1])
+    status = numpy.zeros(batch, dtype=int)
+    with SolutionWriter(path, batch + (compiled.size,), str(compiled.time), compiled.name,
+                        _layout(compiled), fp, _parameters(compiled, p), chunk_rows,
+                        flush_interval, decimate) as writer:
+        writer.append(t_eval[0], numpy.broadcast_to(y, batch + (compiled.size,)))
+        # consecutive pieces share their end points
+        for start in range(0, len(t_eval) - 1, chunk_rows - 1):
+            piece = t_eval[start:start + chunk_rows]
+            solution = integrate(compiled, (piece[0], piece[-1]), params, y,
+                                 t_eval=piece, **options)
+            writer.append(piece[1:], numpy.moveaxis(solution.y[..., 1:, :], -2, 0))
+            status = solution.status
+            if not solution.success:
+                break
+            y = solution.y[..., -1, :]
+        writer.close(status=status.tolist())
+    return SolutionReader(path)
@@ -0,0 +1,365 @@
+""" Structural analysis of compiled equation systems.
+
+    decompose(m) works on the sparsity pattern of the Jacobian of a compiled
+    model, the incidence of its equations (rows) on its unknowns (columns):
+
+    - a maximum matching pairs each algebraic row with an algebraic column;
+      a differential row is paired with the time derivative of its own
+      column, so the differential columns count as known. Rows or columns
+      left unmatched make the system structurally singular.
+    - the strongly connected components of the graph of the matched rows
+      give the block lower triangular form: a sequence of blocks, each
+      depending only on itself and on the blocks before it, that can be
+      solved one at a time instead of all at once.
+    - for differential models whose algebraic rows do not match, Pantelides'
+      algorithm finds the equations that must be differentiated, and so the
+      structural DAE index.
+
+    Decomposition.solve then solves the algebraic rows block by block with
+    Newton's method, restricting each kernel call to the rows of the block.
+"""
+
+import heapq
+
+import numpy
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.sparse.linalg
+
+from .compiler import CompiledModel
+from .compiler import CompileError
+from .compiler import compile_model
+from .flatten import flatten
+from .jacobian import SparseJacobian
+from .timing import timed
+from .timing import timings
+
+
+class Block:
+    def __init__(self, rows, columns):
+        self.rows = rows
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return 'Block(rows={}, columns={})'.format(self.rows.tolist(),
+                                                    self.columns.tolist())
+
+
+class Piece:
+    """ The rows lo..hi - 1 of one branch, with its argument slices cut to
+        match, and the Jacobian bands of the branch over the same rows.
+    """
+
+    def __init__(self, branch, lo, hi, bands):
+        self.branch = branch
+        self.lo = lo
+        self.hi = hi
+        offset = lo - branch.rows.start
+        n = branch.rows.stop - branch.rows.start
+        self.args = [slice(s.start + offset, s.start + offset + hi - lo)
+                     if s.stop - s.start == n else s for s in branch.args]
+        self.bands = [(band, band.cols[offset:offset + hi - lo]) for band in bands]
+
+
+def _runs(rows):
+    # the contiguous runs [lo, hi) of sorted rows
+    breaks = numpy.flatnonzero(numpy.diff(rows) != 1) + 1
+    return [(int(r[0]), int(r[-1]) + 1) for r in numpy.split(rows, breaks) if len(r)]
+
+
+def _augment(i, eqs, h, assign, colored_e, colored_v):
+    # searches for an augmenting path from equation i over the highest
+    # derivatives of the variables, without recursion
+    def highest(e):
+        return [j for j, o in eqs[e].items() if o == h[j]]
+
+    def free(e):
+        return next((j for j in highest(e) if j not in assign), None)
+
+    colored_e.add(i)
+    j = free(i)
+    if j is not None:
+        assign[j] = i
+        return True
+    stack = [(i, iter(highest(i)))]
+    path = []
+    while stack:
+        e, candidates = stack[-1]
+        for j in candidates:
+            if j in colored_v:
+                continue
+            colored_v.add(j)
+            k = assign[j]
+            colored_e.add(k)
+            path.append((e, j))
+            f = free(k)
+            if f is not None:
+                assign[f] = k
+                for e, j in reversed(path):
+                    assign[j] = e
+                return True
+            stack.append((k, iter(highest(k))))
+            break
+        else:
+            stack.pop()
+            if path:
+                path.pop()
+    return False
+
+
+def pantelides(eqs, h):
+    """ Pantelides' algorithm. eqs holds, for each equation, a dict of the
+        variables it references and the highest order of their time
+        derivatives in it; h is the highest order of each variable. Returns
+        the number of times each of the original equations is
+        differentiated and the new
+        highest orders, or None if the system is structurally singular.
+    """
+    eqs = list(eqs)
+    h = list(h)
+    count = [0] * len(eqs)
+    origin = list(range(len(eqs)))
+    assign = {}
+    limit = len(h) + 1
+    for k in range(len(eqs)):
+        while True:
+            colored_e = set()
+            colored_v = set()
+            if _augment(k, eqs, h, assign, colored_e, colored_v):
+                break
+            if count[k] >= limit or not eqs[k]:
+                return None
+            for j in colored_v:
+                h[j] += 1
+            derived = {}
+            for e in colored_e:
+                derived[e] = len(eqs)
+                eqs.append({j: o + 1 for j, o in eqs[e].items()})
+                count.append(count[e] + 1)
+                origin.append(origin[e])
+            for j in colored_v:
+                assign[j] = derived[assign[j]]
+            k = derived[k]
+    differentiations = [0] * len(h)
+    for e in assign.values():
+        differentiations[origin[e]] = max(differentiations[origin[e]], count[e])
+    return differentiations, h
+
+
+class Decomposition:
+    def __init__(self, compiled, jacobian=None):
+        self.compiled = compiled
+        self.jacobian = SparseJacobian(compiled) if jacobian is None else jacobian
+        self.incidence = self.jacobian.pattern.tocsr()
+        n = compiled.size
+        differential = compiled.mass != 0
+        self.algebraic = numpy.flatnonzero(~differential)
+
+        # the algebraic rows are matched to the algebraic columns; the
+        # differential rows to their derivatives
+        A = self.incidence[self.algebraic][:, self.algebraic]
+        self.matching = numpy.where(differential, numpy.arange(n), -1)
+        matched = scipy.sparse.csgraph.maximum_bipartite_matching(
+            A.tocsr(), perm_type='column') if len(self.algebraic) else numpy.zeros(0, int)
+        rows = matched >= 0
+        self.matching[self.algebraic[rows]] = self.algebraic[matched[rows]]
+        used = numpy.zeros(n, dtype=bool)
+        used[self.matching[self.matching >= 0]] = True
+        self.unmatched_rows = numpy.flatnonzero(self.matching < 0)
+        self.unmatched_columns = numpy.flatnonzero(~used)
+
+        if not len(self.unmatched_rows) and not len(self.unmatched_columns):
+            self.index = 1 if len(self.algebraic) else 0
+            self.blocks = self._blocks()
+            self.differentiations = numpy.zeros(n, dtype=int)
+        else:
+            self.blocks = []
+            self.index = None
+            self.differentiations = None
+            if differential.any():
+                self._pantelides(differential)
+
+    def __str__(self):
+        out = 'Decomposition of "{}": {} equations, '.format(
+            self.compiled.name, self.compiled.size)
+        if self.singular:
+            return out + 'structurally singular ({} rows and {} columns unmatched)' \
+                .format(len(self.unmatched_rows), len(self.unmatched_columns))
+        if self.blocks:
+            out = out + '{} blocks (largest {})'.format(
+                len(self.blocks), max(len(b) for b in self.blocks))
+        else:
+            out = out + 'no algebraic blocks'
+        if self.index is not None:
+            out = out + ', index {}'.format(self.index)
+        return out
+
+    @property
+    def singular(self):
+        """ True if no differentiation of the equations makes the system
+            solvable for its unknowns.
+        """
+        return self.differentiations is None
+
+    def _pantelides(self, differential):
+        eqs = []
+        for r in range(self.compiled.size):
+            row = self.incidence.indices[self.incidence.indptr[r]:self.incidence.indptr[r + 1]]
+            orders = dict.fromkeys(row.tolist(), 0)
+            if differential[r]:
+                orders[r] = 1
+            eqs.append(orders)
+        result = pantelides(eqs, differential.astype(int).tolist())
+        if result is None:
+            return
+        count, h = result
+        self.differentiations = numpy.array(count)
+        self.index = int(max(count, default=0)) + (1 if min(h, default=1) == 0 else 0)
+
+    def _blocks(self):
+        # row r depends on row s when r references the column matched to s
+        rows = self.algebraic
+        if not len(rows):
+            return []
+        position = numpy.full(self.compiled.size, -1)
+        position[self.matching[rows]] = numpy.arange(len(rows))
+        A = self.incidence[rows].tocoo()
+        keep = position[A.col] >= 0
+        graph = scipy.sparse.csr_matrix(
+            (numpy.ones(keep.sum()), (A.row[keep], position[A.col[keep]])),
+            shape=(len(rows), len(rows)))
+        count, labels = scipy.sparse.csgraph.connected_components(
+            graph, directed=True, connection='strong')
+
+        # order the components so that each comes after those it uses
+        g = graph.tocoo()
+        cross = labels[g.row] != labels[g.col]
+        edges = set(zip(labels[g.row[cross]].tolist(), labels[g.col[cross]].tolist()))
+        needs = [0] * count
+        users = [[] for _ in range(count)]
+        for a, b in edges:
+            needs[a] += 1
+            users[b].append(a)
+        ready = [c for c in range(count) if needs[c] == 0]
+        order = []
+        while ready:
+            c = heapq.heappop(ready)
+            order.append(c)
+            for a in users[c]:
+                needs[a] -= 1
+                if needs[a] == 0:
+                    heapq.heappush(ready, a)
+
+        members = [[] for _ in range(count)]
+        for k, c in enumerate(labels.tolist()):
+            members[c].append(k)
+        blocks = []
+        for c in order:
+            r = rows[members[c]]
+            blocks.append(Block(r, self.matching[r]))
+        return blocks
+
+    def describe(self, block):
+        """ The names of the equations' unknowns in block, e.g. ['c[3]']. """
+        names = []
+        for column in block.columns:
+            for v in self.compiled.variables.values():
+                if v.start <= column < v.start + v.size:
+                    if v.indexed:
+                        names.append('{}[{}]'.format(
+                            v.name, self.compiled.lower + column - v.start))
+                    else:
+                        names.append(v.name)
+        return names
+
+    def _pieces(self, block, bands):
+        pieces = []
+        for b in self.compiled.branches:
+            rows = block.rows[(block.rows >= b.rows.start) & (block.rows < b.rows.stop)]
+            for lo, hi in _runs(numpy.sort(rows)):
+                pieces.append(Piece(b, lo, hi, bands.get(id(b), [])))
+        return pieces
+
+    @timed('solve')
+    def solve(self, y0, params=None, t=0.0, tol=1e-10, maxiter=50):
+        """ Solves the algebraic rows for the algebraic columns, block by
+            block, with the differential columns of y0 held fixed (for
+            differential models, this gives consistent initial values).
+            Returns the solution and the number of Newton iterations taken
+            by the hardest block.
+        """
+        if self.singular or self.index > 1:
+            raise CompileError('model "{}" is not structurally solvable block '
+                               'by block'.format(self.compiled.name))
+        y = numpy.array(y0, dtype=float)
+        if y.ndim != 1:
+            raise CompileError('block solves take a single state vector')
+        p = self.compiled.parameter_values(params)
+        bands = {}
+        for band in self.jacobian.bands:
+            bands.setdefault(id(band.branch), []).append(band)
+        # the position of each row and column within its block
+        local = numpy.full(self.compiled.size, -1)
+        columns = numpy.full(self.compiled.size, -1)
+        owner = numpy.full(self.compiled.size, -1)
+        for k, block in enumerate(self.blocks):
+            local[block.rows] = numpy.arange(len(block))
+            columns[block.columns] = numpy.arange(len(block))
+            owner[block.columns] = k
+
+        iterations = 0
+        for k, block in enumerate(self.blocks):
+            pieces = self._pieces(block, bands)
+            for iteration in range(maxiter + 1):
+                f = numpy.empty(len(block))
+                for piece in pieces:
+                    f[local[piece.lo:piece.hi]] = piece.branch.kernel(
+                        *[y[s] for s in piece.args], t, *p)
+                if numpy.max(numpy.abs(f), initial=0.0) < tol:
+                    break
+                if iteration == maxiter:
+                    raise RuntimeError('Newton iteration did not converge in {} '
+                                       'iterations for the block of {}'.format(
+                                           maxiter, ', '.join(self.describe(block))))
+                y[block.columns] -= self._newton_step(
+                    len(block), pieces, local, columns, owner == k, y, t, p, f)
+            iterations = max(iterations, iteration)
+            timings.count('solve', 'newton_iterations', iteration)
+        return y, iterations
+
+    def _newton_step(self, n, pieces, local, columns, in_block, y, t, p, f):
+        # columns of other blocks are known, or not referenced at all
+        rows = []
+        cols = []
+        values = []
+        for piece in pieces:
+            r = local[piece.lo:piece.hi]
+            for band, band_cols in piece.bands:
+                keep = in_block[band_cols]
+                if not keep.any():
+                    continue
+                v = band.kernel(*[y[s] for s in piece.args], t, *p)
+                rows.append(r[keep])
+                cols.append(columns[band_cols[keep]])
+                values.append(numpy.broadcast_to(v, r.shape)[keep])
+        rows = numpy.concatenate(rows)
+        cols = numpy.concatenate(cols)
+        values = numpy.concatenate(values)
+        if n <= 64:
+            J = numpy.zeros((n, n))
+            numpy.add.at(J, (rows, cols), values)
+            return numpy.linalg.solve(J, f)
+        J = scipy.sparse.csc_matrix((values, (rows, cols)), shape=(n, n))
+        return scipy.sparse.linalg.spsolve(J, f)
+
+
+def decompose(m):
+    """ Returns the Decomposition of Model or CompiledModel m; a Model is
+        flattened and compiled first.
+    """
+    if not isinstance(m, CompiledModel):
+        m = compile_model(flatten(m) if m.includes else m)
+    return Decomposition(m)
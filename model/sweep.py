@@ -0,0 +1,111 @@
+""" Batched parameter sweeps over compiled models.
+
+    A sweep evaluates a CompiledModel for every row of a parameter table in
+    one broadcast call per chunk: each swept parameter becomes a (batch, 1)
+    column, so the kernels run over the whole chunk at once. Chunks can be
+    spread over a process pool; the results come back as one structured
+    array holding the parameter values and a `result` field per row.
+"""
+
+import itertools
+
+import numpy
+
+from .compiler import CompiledModel
+from .compiler import compile_model
+
+
+def parameter_grid(**axes):
+    """ The cartesian product of the given parameter axes as a structured
+        array, e.g. parameter_grid(krate=numpy.logspace(-1, 2, 100), w=[1, 2]).
+    """
+    names = list(axes)
+    values = [numpy.asarray(axes[n], dtype=float).ravel() for n in names]
+    table = numpy.empty(int(numpy.prod([len(v) for v in values])),
+                        dtype=[(n, float) for n in names])
+    if not names:
+        return table
+    mesh = numpy.meshgrid(*values, indexing='ij')
+    for n, v in zip(names, mesh):
+        table[n] = v.ravel()
+    return table
+
+
+def _as_table(table):
+    if isinstance(table, numpy.ndarray) and table.dtype.names:
+        return table
+    columns = {str(k): numpy.asarray(v, dtype=float).ravel() for k, v in table.items()}
+    lengths = {len(v) for v in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError('parameter columns have different lengths {}'
+                         .format(sorted(lengths)))
+    out = numpy.empty(lengths.pop() if lengths else 0,
+                      dtype=[(n, float) for n in columns])
+    for n, v in columns.items():
+        out[n] = v
+    return out
+
+
+def evaluate_residual(compiled, params, y=None, t=0.0):
+    if y is None:
+        y = compiled.initial_values(params)
+    return compiled.residual(y, params, t)
+
+
+def evaluate_march(compiled, params, y=None, t=0.0):
+    return compiled.march(params, t)
+
+
+methods = {
+    'residual': evaluate_residual,
+    'march': evaluate_march,
+}
+
+
+def _evaluate_chunk(compiled, method, chunk, params, y, t, options):
+    values = dict(params)
+    for name in chunk.dtype.names:
+        values[name] = chunk[name]
+    result = methods[method](compiled, values, y, t, **options)
+    return numpy.broadcast_to(result, (len(chunk),) + result.shape[-1:])
+
+
+def sweep(m, table, params=None, y=None, t=0.0, method='residual',
+          chunksize=65536, processes=1, **options):
+    """ Evaluates Model or CompiledModel m for every row of table.
+
+        table is a structured array (see parameter_grid) or a mapping of
+        parameter names to equal length columns; params gives fixed values
+        for the other parameters. method names an entry of `methods`:
+        'residual' evaluates F(t, y, p) at y (by default the initial values),
+        'march' solves a discrete model by forward substitution. Chunks of
+        chunksize rows run in a process pool when processes is not 1.
+    """
+    compiled = m if isinstance(m, CompiledModel) else compile_model(m)
+    table = _as_table(table)
+    params = {} if params is None else {str(k): v for k, v in params.items()}
+    chunks = [table[i:i + chunksize] for i in range(0, len(table), chunksize)]
+
+    if processes == 1 or len(chunks) <= 1:
+        results = (_evaluate_chunk(compiled, method, c, params, y, t, options)
+                   for c in chunks)
+        return _collect(table, results, compiled.size)
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(processes) as executor:
+        results = executor.map(_evaluate_chunk, itertools.repeat(compiled),
+                               itertools.repeat(method), chunks,
+                               itertools.repeat(params), itertools.repeat(y),
+                               itertools.repeat(t), itertools.repeat(options))
+        return _collect(table, results, compiled.size)
+
+
+def _collect(table, results, size):
+    out = numpy.empty(len(table), dtype=table.dtype.descr + [('result', float, (size,))])
+    for name in table.dtype.names:
+        out[name] = table[name]
+    start = 0
+    for r in results:
+        out['result'][start:start + len(r)] = r
+        start += len(r)
+    return out
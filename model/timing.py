@@ -0,0 +1,157 @@
+""" Stage timing for the model pipeline.
+
+    The stages of the pipeline (construct, model_to_mathml, sympy_to_mathml,
+    equations_to_mathml, serialize, mml2sympy, compile, solve) are measured
+    into the process-wide `timings` while it is enabled:
+
+        model.timings.enable()
+        model.write_mathml(m, stream)
+        print(model.timings)
+        model.timings.dump('timings.json')
+
+    Each stage keeps its call count, its cumulative wall time and named
+    counters (such as the branches compiled or the Newton iterations taken).
+    Times are inclusive: sympy_to_mathml is also part of the
+    equations_to_mathml and serialize time of the call it was made from. A
+    stage re-entered from within itself is counted but timed once. When
+    timing is disabled, which is the default, a timed function costs one
+    extra call and attribute check.
+"""
+
+import functools
+import json
+import threading
+import time
+
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.counters = {}
+
+    def as_dict(self):
+        return {'calls': self.calls, 'seconds': self.seconds,
+                'counters': dict(self.counters)}
+
+
+class Measurement:
+    """ Context manager timing one call of a stage. """
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        active = self.timings._active()
+        self.outer = self.name not in active
+        if self.outer:
+            active.add(self.name)
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start if self.outer else 0.0
+        if self.outer:
+            self.timings._active().discard(self.name)
+        with self.timings._lock:
+            stage = self.timings.stage(self.name)
+            stage.calls += 1
+            stage.seconds += elapsed
+        return False
+
+
+class _Disabled:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_disabled = _Disabled()
+
+
+class Timings:
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _active(self):
+        active = getattr(self._local, 'active', None)
+        if active is None:
+            active = self._local.active = set()
+        return active
+
+    def __str__(self):
+        out = '{:<22}{:>10}{:>12}  counters\n'.format('stage', 'calls', 'seconds')
+        for s in sorted(self.stages.values(), key=lambda s: -s.seconds):
+            counters = ', '.join('{}={}'.format(k, v) for k, v in sorted(s.counters.items()))
+            out = out + '{:<22}{:>10}{:>12.6f}  {}\n'.format(s.name, s.calls, s.seconds,
+                                                            counters)
+        return out
+
+    def enable(self, reset=True):
+        if reset:
+            self.reset()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    def measure(self, name):
+        """ A context manager timing the enclosed code as one call of stage
+            name, e.g. with timings.measure('construct'): ...
+        """
+        if not self.enabled:
+            return _disabled
+        return Measurement(self, name)
+
+    def count(self, name, counter, n=1):
+        """ Adds n to counter of stage name. """
+        if not self.enabled:
+            return
+        with self._lock:
+            counters = self.stage(name).counters
+            counters[counter] = counters.get(counter, 0) + n
+
+    def as_dict(self):
+        with self._lock:
+            return {name: s.as_dict() for name, s in self.stages.items()}
+
+    def dump(self, target):
+        """ Writes the stages as JSON to target, a file name or stream. """
+        data = {'stages': self.as_dict()}
+        if hasattr(target, 'write'):
+            json.dump(data, target, indent=2, sort_keys=True)
+            return
+        with open(target, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+
+timings = Timings()
+
+
+def timed(name):
+    """ Decorates a function to be timed as a call of stage name. """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not timings.enabled:
+                return function(*args, **kwargs)
+            with Measurement(timings, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,141 @@
+""" Change tracking for Model and Include.
+
+    Assigning a tracked field, or mutating the set, list or dict stored in
+    one (m.eqs.add(eq), m.parameters.append(p), include.mapping[k] = v),
+    stamps that field with a new value of a process-wide clock. For this an
+    assigned plain set, list or dict is copied into a tracked one, so later
+    changes to the original no longer reach the object: edit the field
+    (m.eqs.add(eq)) rather than the container it was assigned from. A
+    tracked container assigned to fields of several objects stamps every
+    one of them; it refers to them weakly, so it does not keep them alive.
+    Serializers compare the stamps with the ones their cached output was
+    built from, so only the parts of a model that changed are rebuilt.
+"""
+
+import itertools
+import weakref
+
+_clock = itertools.count(1)
+
+
+def tick():
+    return next(_clock)
+
+
+def _notify(method):
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        for ref, field in getattr(self, '_owners', ()):
+            owner = ref()
+            if owner is not None:
+                owner.changed(field)
+        return result
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class _TrackedContainer:
+    def __getstate__(self):
+        # owners are weak references, which cannot be pickled; unpickled
+        # objects track their fields again
+        return {k: v for k, v in self.__dict__.items() if k != '_owners'}
+
+
+class TrackedSet(_TrackedContainer, set):
+    pass
+
+
+class TrackedList(_TrackedContainer, list):
+    pass
+
+
+class TrackedDict(_TrackedContainer, dict):
+    pass
+
+
+for _cls, _base, _methods in (
+        (TrackedSet, set, ('add', 'clear', 'discard', 'pop', 'remove', 'update',
+                           'difference_update', 'intersection_update',
+                           'symmetric_difference_update', '__ior__', '__iand__',
+                           '__isub__', '__ixor__')),
+        (TrackedList, list, ('append', 'clear', 'extend', 'insert', 'pop',
+                             'remove', 'reverse', 'sort', '__setitem__',
+                             '__delitem__', '__iadd__', '__imul__')),
+        (TrackedDict, dict, ('clear', 'pop', 'popitem', 'setdefault', 'update',
+                             '__setitem__', '__delitem__', '__ior__'))):
+    for _name in _methods:
+        setattr(_cls, _name, _notify(getattr(_base, _name)))
+
+_containers = {set: TrackedSet, list: TrackedList, dict: TrackedDict}
+
+
+def _track(value, owner, field):
+    cls = _containers.get(type(value))
+    if cls is not None:
+        value = cls(value)
+    elif not isinstance(value, (TrackedSet, TrackedList, TrackedDict)):
+        return value
+    # a container assigned to several fields, such as b.parameters =
+    # a.parameters, stamps all of them when it is mutated
+    owners = value.__dict__.setdefault('_owners', [])
+    owners[:] = [(r, f) for r, f in owners if r() is not None]
+    if not any(r() is owner and f == field for r, f in owners):
+        owners.append((weakref.ref(owner), field))
+    return value
+
+
+class Tracked:
+    """ Base of classes whose `fields` are change tracked. """
+
+    fields = ()
+
+    def __setattr__(self, name, value):
+        if name in self.fields:
+            value = _track(value, self, name)
+            object.__setattr__(self, name, value)
+            self.changed(name)
+        else:
+            object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        # serializer caches (attributes named _cache*) are not pickled
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_cache')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for field in self.fields:
+            if field in self.__dict__:
+                object.__setattr__(self, field,
+                                   _track(self.__dict__[field], self, field))
+        # stamps from another process mean nothing to this one's clock
+        for field in self.__dict__.get('_stamps', {}):
+            self.changed(field)
+
+    def clear_caches(self):
+        for k in [k for k in self.__dict__ if k.startswith('_cache')]:
+            del self.__dict__[k]
+
+    def changed(self, field):
+        """ Marks field as changed; needed only for edits that cannot be
+            seen, such as to a mutable object held inside a field.
+        """
+        if '_stamps' not in self.__dict__:
+            object.__setattr__(self, '_stamps', {})
+        self._stamps[field] = tick()
+
+    def stamp(self, field=None):
+        """ The clock value of the last change to field, or to any field. """
+        stamps = self.__dict__.get('_stamps', {})
+        if field is None:
+            return max(stamps.values(), default=0)
+        return stamps.get(field, 0)
+
+    @property
+    def dirty(self):
+        """ The fields changed since the object was last serialized. """
+        serialized = self.__dict__.get('_serialized', 0)
+        return {f for f, s in self.__dict__.get('_stamps', {}).items()
+                if s > serialized}
+
+    def mark_clean(self):
+        object.__setattr__(self, '_serialized', tick())
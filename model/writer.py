@@ -0,0 +1,169 @@
+""" Streaming Content MathML writer.
+
+    Produces the same document as model_to_mathml / models_to_mathml, but
+    writes it to a file-like object in one pass: the enclosing <collection>,
+    <model>, <equations> and <includes> tags are written directly and only
+    one equation, include or small section is held as an ElementTree at a
+    time. The text of each equation is kept on the Model or Include it
+    belongs to and reused while the equation, its depth and the indent are
+    unchanged (see model.tracking); the includes of a submodel that appears
+    in several places are written once per depth and copied.
+"""
+
+import collections
+import io
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
+
+from .model import bounds_to_mathml
+from .model import collect_models
+from .model import connection_to_mathml
+from .model import equation_to_mathml
+from .model import mapping_to_mathml
+from .model import parameters_to_mathml
+from .model import solution_variables_to_mathml
+from .timing import timed
+
+
+class MathMLWriter:
+    def __init__(self, stream, indent=None, encoding='utf-8'):
+        self.stream = stream
+        self.indent = indent
+        self.encoding = encoding
+        self.text = isinstance(stream, io.TextIOBase)
+        self.depth = 0
+        self._nested = {}
+
+    def _write(self, s):
+        if self.text:
+            self.stream.write(s)
+        else:
+            self.stream.write(s.encode(self.encoding))
+
+    def _newline(self):
+        if self.indent is not None:
+            self._write('\n')
+
+    def _pad(self):
+        if self.indent is not None:
+            self._write(self.indent * self.depth)
+
+    def start(self, tag, **attrib):
+        self._pad()
+        attrs = ''.join(' {}={}'.format(k, quoteattr(v)) for k, v in attrib.items())
+        self._write('<{}{}>'.format(tag, attrs))
+        self._newline()
+        self.depth += 1
+
+    def end(self, tag):
+        self.depth -= 1
+        self._pad()
+        self._write('</{}>'.format(tag))
+        self._newline()
+
+    def _text(self, e):
+        # e as a line of the document at the current depth
+        if self.indent is None:
+            return ET.tostring(e, encoding='unicode')
+        ET.indent(e, space=self.indent, level=self.depth)
+        e.tail = None
+        return self.indent * self.depth + ET.tostring(e, encoding='unicode') + '\n'
+
+    def element(self, e):
+        self._write(self._text(e))
+
+    @timed('equations_to_mathml')
+    def equations(self, owner, eqs):
+        if not eqs:
+            self.element(ET.Element('equations'))
+            return
+        self.start('equations')
+        layout = (self.depth, self.indent)
+        cached = owner.__dict__.get('_cache_equation_text')
+        if cached is None or cached[0] != layout:
+            cached = (layout, {})
+        texts = {}
+        for eq in eqs:
+            key = (type(eq), eq)
+            text = cached[1].get(key)
+            if text is None:
+                text = self._text(equation_to_mathml(eq))
+            texts[key] = text
+            self._write(text)
+        # only the equations still in eqs are kept
+        object.__setattr__(owner, '_cache_equation_text', (layout, texts))
+        self.end('equations')
+
+    def include(self, include):
+        submodel = include.submodel
+        self.start('model', name=submodel.name)
+        # the includes of a submodel are written once per depth, and copied
+        # wherever else the submodel appears
+        key = (submodel, self.depth)
+        if key not in self._nested:
+            self._nested[key] = self._capture(
+                lambda: [self.include(i) for i in submodel.includes])
+        self._write(self._nested[key])
+        self.element(mapping_to_mathml(include.mapping))
+        if include.bounds is not None:
+            self.element(bounds_to_mathml(include.bounds))
+        self.equations(include, include.eqs)
+        self.end('model')
+
+    def _capture(self, write):
+        # runs write() and returns what it wrote, as text
+        stream, text = self.stream, self.text
+        self.stream, self.text = io.StringIO(), True
+        try:
+            write()
+            return self.stream.getvalue()
+        finally:
+            self.stream, self.text = stream, text
+
+    def submodel(self, m):
+        self.start('model', name=m.name)
+        self.element(solution_variables_to_mathml(m.solution_variables))
+        if m.bounds is not None:
+            self.element(bounds_to_mathml(m.bounds))
+        self.element(parameters_to_mathml(m.parameters))
+        self.equations(m, m.eqs)
+        if not m.includes:
+            self.element(ET.Element('includes'))
+        else:
+            self.start('includes')
+            for i in m.includes:
+                self.include(i)
+            self.end('includes')
+        self.end('model')
+        m.mark_clean()
+
+    def model(self, d):
+        self._nested = {}
+        self.start('collection')
+        models = collections.OrderedDict()
+        parameters = collections.OrderedDict()
+        for i in d.includes:
+            collect_models(i.submodel, models, parameters)
+        for m in models.keys():
+            self.submodel(m)
+        self.submodel(d)
+        self.end('collection')
+
+    def models(self, model):
+        self.start('models')
+        for i in model.models:
+            self.model(i)
+        for i in model.connections:
+            self.element(connection_to_mathml(i))
+        self.end('models')
+
+
+@timed('serialize')
+def write_mathml(d, stream, indent=None):
+    """ Streams the MathML collection for Model d to stream. """
+    MathMLWriter(stream, indent).model(d)
+
+
+@timed('serialize')
+def write_models_mathml(model, stream, indent=None):
+    MathMLWriter(stream, indent).models(model)
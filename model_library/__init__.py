@@ -3,3 +3,4 @@ from .ode import ode_model
 from .ode import ode_model_disc
 from .pde import pde_model
 from .pde import pde_model_disc
+from .simultaneous_eq import simultaneous_model
@@ -0,0 +1,208 @@
+""" Batch conversion of model_library models to MathML files.
+
+    A target names a model_library constructor and its arguments, such as
+    ode_model or pde_model_disc(100, 0.1). convert(targets, directory)
+    writes one MathML collection per target, named after it
+    (pde_model_disc(100, 0.1) becomes pde_model_disc_100_0.1.xml):
+
+    - with jobs > 1 the targets are converted in a process pool.
+    - each file is written to a temporary name in the output directory and
+      renamed into place, so an interrupted run never leaves a partial file.
+    - like make, a target whose file is newer than every source file of the
+      model and model_library packages is up to date and skipped, unless
+      force is given.
+    - a target that fails is reported and the others are still converted;
+      main exits with status 1 if any failed.
+
+        python -m model_library.convert -o build 'pde_model_disc(100, 0.1)' ode_model
+        python -m model_library.convert -o build --jobs 8 --targets variants.txt
+"""
+
+import argparse
+import ast
+import glob
+import os
+import re
+import sys
+import time
+
+import model
+import model_library
+from model._io import atomic_open
+
+
+class Target:
+    def __init__(self, text):
+        text = text.strip()
+        match = re.fullmatch(r'(\w+)\s*(?:\((.*)\))?', text, re.S)
+        if match is None:
+            raise ValueError('cannot read target "{}"; write it as '
+                             'constructor or constructor(arguments)'.format(text))
+        self.constructor = match.group(1)
+        if self.constructor.startswith('_') \
+                or not callable(getattr(model_library, self.constructor, None)):
+            raise ValueError('"{}" is not a model_library constructor'
+                             .format(self.constructor))
+        arguments = match.group(2) or ''
+        try:
+            self.args = ast.literal_eval('({},)'.format(arguments)) if arguments.strip() else ()
+        except (ValueError, SyntaxError):
+            raise ValueError('arguments of target "{}" must be literals'.format(text))
+
+    def __str__(self):
+        if not self.args:
+            return self.constructor
+        return '{}({})'.format(self.constructor, ', '.join(map(repr, self.args)))
+
+    @property
+    def filename(self):
+        parts = [self.constructor] + [re.sub(r'[^\w.+-]', '', str(a)) for a in self.args]
+        return '_'.join(parts) + '.xml'
+
+    def make(self):
+        return getattr(model_library, self.constructor)(*self.args)
+
+
+def sources():
+    """ The source files every conversion depends on. """
+    files = []
+    for package in (model, model_library):
+        files.extend(glob.glob(os.path.join(os.path.dirname(package.__file__), '*.py')))
+    return files
+
+
+def up_to_date(path, newest):
+    try:
+        return os.path.getmtime(path) >= newest
+    except OSError:
+        return False
+
+
+def _write(target, path, indent):
+    m = target.make()
+    with atomic_open(path) as f:
+        model.write_mathml(m, f, indent=indent)
+
+
+def _convert(text, path, indent):
+    start = time.perf_counter()
+    _write(Target(text), path, indent)
+    return time.perf_counter() - start
+
+
+def convert(targets, directory, jobs=1, force=False, indent=None, log=None):
+    """ Converts targets (strings or Targets) to MathML files in directory,
+        returning a list of (target, path, status), where status is
+        'written', 'up to date' or 'failed'; failures are logged as
+        target: error.
+    """
+    targets = [t if isinstance(t, Target) else Target(t) for t in targets]
+    os.makedirs(directory, exist_ok=True)
+    newest = max((os.path.getmtime(f) for f in sources()), default=0.0)
+
+    results = []
+    pending = []
+    paths = {}
+    for t in targets:
+        path = os.path.join(directory, t.filename)
+        if paths.setdefault(path, str(t)) != str(t):
+            raise ValueError('targets "{}" and "{}" both write {}'
+                             .format(paths[path], t, path))
+        if not force and up_to_date(path, newest):
+            results.append((t, path, 'up to date'))
+        else:
+            pending.append((t, path))
+
+    def report(t, path, seconds):
+        results.append((t, path, 'written'))
+        if log is not None:
+            print('{:8.3f}s  {} -> {}'.format(seconds, t, path), file=log)
+
+    def fail(t, path, error):
+        results.append((t, path, 'failed'))
+        if log is not None:
+            print('{}: {}'.format(t, error), file=log)
+
+    if jobs == 1 or len(pending) <= 1:
+        for t, path in pending:
+            try:
+                seconds = _convert(str(t), path, indent)
+            except Exception as e:
+                fail(t, path, e)
+            else:
+                report(t, path, seconds)
+        return results
+
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import as_completed
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = {executor.submit(_convert, str(t), path, indent): (t, path)
+                   for t, path in pending}
+        for future in as_completed(futures):
+            t, path = futures[future]
+            try:
+                seconds = future.result()
+            except Exception as e:
+                fail(t, path, e)
+            else:
+                report(t, path, seconds)
+    return results
+
+
+def build_parser(description='Converts model_library models to MathML files.'):
+    """ The argument parser of main, which main.py extends. """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('targets', nargs='*',
+                        help="constructors with their arguments, e.g. 'pde_model_disc(100, 0.1)'")
+    parser.add_argument('--targets', dest='target_file', metavar='FILE',
+                        help='read further targets from FILE, one per line')
+    parser.add_argument('-o', '--output', default='.', metavar='DIR',
+                        help='directory to write the files to')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of conversions to run in parallel (0 for one per core)')
+    parser.add_argument('--force', action='store_true',
+                        help='convert targets even when their file is up to date')
+    parser.add_argument('--indent', default=None,
+                        help='indent the MathML with this string')
+    return parser
+
+
+def read_targets(parser, args):
+    """ The Targets given on the command line and in the --targets file. """
+    texts = list(args.targets)
+    if args.target_file:
+        with open(args.target_file) as f:
+            texts.extend(line for line in f if line.strip() and not line.lstrip().startswith('#'))
+    try:
+        return [Target(t) for t in texts]
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def run(targets, args):
+    """ Converts targets as the parsed args say and reports a summary,
+        returning the exit status.
+    """
+    start = time.perf_counter()
+    results = convert(targets, args.output, args.jobs or os.cpu_count(), args.force,
+                      args.indent, log=sys.stderr)
+    counts = {status: 0 for status in ('written', 'up to date', 'failed')}
+    for _, _, status in results:
+        counts[status] += 1
+    print('{} written, {} up to date, {} failed in {:.3f}s'.format(
+        counts['written'], counts['up to date'], counts['failed'],
+        time.perf_counter() - start), file=sys.stderr)
+    return 1 if counts['failed'] else 0
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    targets = read_targets(parser, args)
+    if not targets:
+        parser.error('no targets given')
+    return run(targets, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
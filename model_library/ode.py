@@ -42,7 +42,8 @@ def ode_model_disc(dt, N):
     m.solution_variables = {c[n]}
     m.bounds = sympy.And(n >= 0, n <= N)
     m.eqs = {
-        sympy.Eq((c[n] - c[n-1])/dt, r * c[n-1] * (1 - c[n-1]/K)),
+        model.ArrayEquation(n, 1, N, sympy.Eq((c[n] - c[n-1])/dt,
+                                              r * c[n-1] * (1 - c[n-1]/K))),
         (sympy.Eq(n, 0), sympy.Eq(c[n], c0)),
     }
 
@@ -45,7 +45,7 @@ def pde_model_disc(N, dx):
     m.solution_variables = {c[i]}
     m.bounds = sympy.And(i >= 0, i <= N)
     m.eqs = {
-        (sympy.And(i > 0, i < N), sympy.Eq((c[i+1] - 2*c[i] - c[i-1])/(dx**2), 0)),
+        model.ArrayEquation(i, 1, N - 1, sympy.Eq((c[i+1] - 2*c[i] + c[i-1])/(dx**2), 0)),
         (sympy.Eq(i, 0), sympy.Eq(c[i], cl)),
         (sympy.Eq(i, N), sympy.Eq((c[i] - c[i-1])/dx, 0))
     }
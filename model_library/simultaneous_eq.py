@@ -1,3 +1,7 @@
+import model
+import sympy
+
+
 def simultaneous_model():
 
     a = sympy.Symbol('a')
@@ -8,7 +12,7 @@ def simultaneous_model():
     m.solution_variables = {a, b}
     m.independent_variables = {}
     m.eqs = {
-        sympy.Eq(a + b, 1)
+        sympy.Eq(a + b, 1),
         sympy.Eq(2*a + b, 2)
     }
 
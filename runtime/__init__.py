@@ -0,0 +1,3 @@
+from .frozen import load
+from .frozen import FrozenModel
+from .frozen import FrozenModelError
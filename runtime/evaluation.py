@@ -0,0 +1,73 @@
+""" NumPy-only evaluation of compiled kernels.
+
+    The residual, step and march of model.CompiledModel and of FrozenModel
+    both run through these functions; they need only the kernels and the
+    row and argument slices of the branches and updates, and import
+    neither sympy nor lxml.
+"""
+
+import numpy
+
+
+def parameter_values(names, defaults, params=None, error=ValueError):
+    """ The values of parameters names, from params or else defaults, as
+        arrays; a 1-d array of values becomes a (batch, 1) column.
+    """
+    values = dict(defaults)
+    if params is not None:
+        values.update({str(k): v for k, v in params.items()})
+    out = []
+    for name in names:
+        if name not in values:
+            raise error('no value given for parameter "{}"'.format(name))
+        v = numpy.asarray(values[name], dtype=float)
+        if v.ndim == 1:
+            v = v[:, numpy.newaxis]
+        out.append(v)
+    return out
+
+
+def batch_shape(p):
+    return numpy.broadcast_shapes(*[v.shape[:-1] for v in p if v.ndim])
+
+
+def evaluate(branches, size, y, p, t=0.0, out=None):
+    """ Fills out with F(t, y, p), one kernel call per branch; leading
+        dimensions of y are batch axes.
+    """
+    if out is None:
+        out = numpy.empty(batch_shape(p + [y[..., :1]]) + (size,))
+    for b in branches:
+        out[..., b.rows] = b.kernel(*[y[..., s] for s in b.args], t, *p)
+    return out
+
+
+def apply_updates(y, updates, start, stop, p, t):
+    """ Fills the unknowns at indices start..stop - 1 of y in place by the
+        explicit updates; y may carry leading batch axes.
+    """
+    for u in updates:
+        first = max(start, u.first)
+        last = min(stop, u.last + 1)
+        if u.lag == 1 and y.ndim == 1 and not any(v.ndim for v in p):
+            # a scalar recurrence: stay in Python floats, not 1-element arrays
+            march_scalar(y, u, first, last, t, [float(v) for v in p])
+            continue
+        for i in range(first, last, u.lag):
+            j = min(i + u.lag, last)
+            y[..., i + u.target:j + u.target] = u.kernel(
+                *[y[..., i + k:j + k] for k in u.positions], t, *p)
+    return y
+
+
+def march_scalar(y, u, first, last, t, p):
+    if first >= last:
+        return
+    lo = first + min(u.positions, default=u.target)
+    window = y[lo:last + u.target].tolist()
+    kernel = u.scalar_kernel
+    positions = [k - lo for k in u.positions]
+    target = u.target - lo
+    for i in range(first, last):
+        window[i + target] = kernel(*[window[i + k] for k in positions], t, *p)
+    y[lo:last + u.target] = window
@@ -0,0 +1,159 @@
+""" Evaluation of models frozen by model.freeze, with NumPy only.
+
+    FrozenModel has the evaluation interface of model.CompiledModel
+    (parameter_values, residual, initial_values, step, march) over the
+    generated kernels.py and the model.json layout, and imports neither
+    sympy nor lxml, so that short-lived processes start quickly.
+"""
+
+import importlib.util
+import itertools
+import json
+import os
+
+import numpy
+
+from .evaluation import apply_updates
+from .evaluation import batch_shape
+from .evaluation import evaluate
+from .evaluation import parameter_values
+
+FORMAT = 1
+
+_modules = itertools.count()
+
+
+class FrozenModelError(ValueError):
+    pass
+
+
+class Variable:
+    def __init__(self, name, start, size, indexed):
+        self.name = name
+        self.start = start
+        self.size = size
+        self.indexed = indexed
+
+    def __repr__(self):
+        return 'Variable({!r}, start={}, size={})'.format(
+            self.name, self.start, self.size)
+
+
+class Branch:
+    def __init__(self, kernel, rows, args, differential):
+        self.kernel = kernel
+        self.rows = rows
+        self.args = args
+        self.differential = differential
+
+
+class Update:
+    def __init__(self, kernel, scalar_kernel, first, last, target, positions, lag):
+        self.kernel = kernel
+        self.scalar_kernel = scalar_kernel
+        self.first = first
+        self.last = last
+        self.target = target
+        self.positions = positions
+        self.lag = lag
+
+
+def _load_kernels(path):
+    spec = importlib.util.spec_from_file_location(
+        'runtime._kernels{}'.format(next(_modules)), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FrozenModel:
+    def __init__(self, path):
+        with open(os.path.join(path, 'model.json')) as f:
+            metadata = json.load(f)
+        if metadata.get('format') != FORMAT:
+            raise FrozenModelError('{} has unknown format {}'.format(
+                path, metadata.get('format')))
+        kernels = _load_kernels(os.path.join(path, 'kernels.py'))
+        self.path = path
+        self.name = metadata['name']
+        self.fingerprint = metadata.get('fingerprint')
+        self.lower = metadata['lower']
+        self.upper = metadata['upper']
+        self.size = metadata['size']
+        self.variables = {name: Variable(name, start, size, indexed)
+                          for name, start, size, indexed in metadata['variables']}
+        self.parameters = metadata['parameters']
+        self.defaults = metadata['defaults']
+        self.branches = [Branch(getattr(kernels, b['kernel']), slice(*b['rows']),
+                                [slice(*s) for s in b['args']], b['differential'])
+                         for b in metadata['branches']]
+        self.initial = [(i['variable'], getattr(kernels, i['kernel']))
+                        for i in metadata['initial']]
+        self._updates = None
+        if metadata['updates'] is not None:
+            self._updates = [Update(getattr(kernels, u['kernel']),
+                                    getattr(kernels, u['scalar_kernel']),
+                                    u['first'], u['last'], u['target'],
+                                    u['positions'], u['lag'])
+                             for u in metadata['updates']]
+        self.mass = numpy.zeros(self.size)
+        for b in self.branches:
+            if b.differential:
+                self.mass[b.rows] = 1.0
+
+    def __str__(self):
+        out = 'Frozen model "{}":\n'.format(self.name)
+        out = out + 'size: {}\n'.format(self.size)
+        out = out + 'parameters: {}\n'.format(', '.join(self.parameters))
+        return out
+
+    @property
+    def is_differential(self):
+        return bool(self.mass.any())
+
+    def parameter_values(self, params=None):
+        return parameter_values(self.parameters, self.defaults, params,
+                                FrozenModelError)
+
+    def batch_shape(self, p):
+        return batch_shape(p)
+
+    def slice(self, name):
+        v = self.variables[name]
+        return slice(v.start, v.start + v.size)
+
+    def residual(self, y, params=None, t=0.0, out=None):
+        """ Evaluates F(t, y, p); leading dimensions of y are batch axes. """
+        y = numpy.asarray(y, dtype=float)
+        return evaluate(self.branches, self.size, y, self.parameter_values(params),
+                        t, out)
+
+    def initial_values(self, params=None, y0=None):
+        p = self.parameter_values(params)
+        if y0 is None:
+            y0 = numpy.zeros(self.batch_shape(p) + (self.size,))
+        for name, kernel in self.initial:
+            y0[..., self.slice(name)] = kernel(*p)
+        return y0
+
+    def step(self, y, start, stop, params=None, t=0.0):
+        """ Fills the unknowns at indices start..stop - 1 of y in place from
+            the ones before them; y may carry leading batch axes.
+        """
+        if self._updates is None:
+            raise FrozenModelError('model "{}" cannot be marched explicitly'
+                                   .format(self.name))
+        return apply_updates(y, self._updates, start, stop,
+                             self.parameter_values(params), t)
+
+    def march(self, params=None, t=0.0, out=None):
+        """ Solves a lower-triangular discrete model by forward substitution. """
+        if out is None:
+            p = self.parameter_values(params)
+            out = numpy.zeros(self.batch_shape(p) + (self.size,))
+        return self.step(out, self.lower, self.upper + 1, params, t)
+
+
+def load(path):
+    """ Loads the model written by model.freeze to directory path. """
+    return FrozenModel(path)
@@ -0,0 +1,89 @@
+import io
+import os
+import stat
+
+import pytest
+import sympy
+
+import model
+import model_library
+
+
+def test_written_file_takes_the_umask(tmp_path):
+    path = str(tmp_path / 'm.ocmlb')
+    umask = os.umask(0o022)
+    try:
+        model.write_binary(model_library.ode_model(), path)
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+
+def test_failed_write_leaves_no_temporary_file(tmp_path, monkeypatch):
+    def fail(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(os, 'replace', fail)
+    with pytest.raises(OSError):
+        model.write_binary(model_library.ode_model(), str(tmp_path / 'm.ocmlb'))
+    assert os.listdir(str(tmp_path)) == []
+
+
+LIBRARY = [
+    model_library.ode_model,
+    lambda: model_library.ode_model_disc(0.1, 10),
+    model_library.pde_model,
+    lambda: model_library.pde_model_disc(10, 0.1),
+    model_library.electrochemistry_model,
+    model_library.simultaneous_model,
+]
+
+
+def _mathml(d):
+    out = io.BytesIO()
+    model.write_mathml(d, out)
+    return out.getvalue()
+
+
+def _summary(d):
+    # the MathML of a set is written in iteration order, which differs
+    # between equal sets; fingerprints put them in a canonical order
+    models = d.models if isinstance(d, model.Models) else [d]
+    return [(m.name, model.fingerprint(m), model.binary._container_type(m.parameters))
+            for m in models]
+
+
+@pytest.mark.parametrize('make', LIBRARY)
+def test_round_trip(tmp_path, make):
+    d = make()
+    path = str(tmp_path / 'm.ocmlb')
+    model.write_binary(d, path)
+    with model.BinaryLoader(path) as loader:
+        loaded = loader.models()
+    assert _summary(loaded) == _summary(d)
+
+
+@pytest.mark.parametrize('make', LIBRARY)
+def test_mathml_round_trip(tmp_path, make):
+    source = str(tmp_path / 'm.xml')
+    with open(source, 'wb') as f:
+        f.write(_mathml(make()))
+    path = str(tmp_path / 'm.ocmlb')
+    model.binary.mathml_to_binary(source, path)
+    target = str(tmp_path / 'out.xml')
+    with open(target, 'wb') as f:
+        model.binary.binary_to_mathml(path, f)
+    with model.load_collection(source) as expected, \
+            model.load_collection(target) as loader:
+        assert _summary(loader.models()) == _summary(expected.models())
+
+
+def test_parameter_containers_round_trip(tmp_path):
+    m = model_library.simultaneous_model()
+    path = str(tmp_path / 'm.ocmlb')
+    for parameters in ({}, set(), [], {sympy.Symbol('k')}, [sympy.Symbol('k')]):
+        m.parameters = parameters
+        model.write_binary(m, path)
+        with model.BinaryLoader(path) as loader:
+            loaded = loader.models()
+        assert isinstance(loaded.parameters, type(parameters))
+        assert list(loaded.parameters) == list(parameters)
@@ -0,0 +1,45 @@
+import os
+import stat
+
+import numpy
+
+import model
+import model_library
+from model import cache
+
+
+def test_entries_are_named_by_format(tmp_path):
+    c = model.ModelCache(str(tmp_path))
+    m = model_library.ode_model_disc(0.1, 10)
+    c.compiled(m)
+    key = cache.fingerprint(m)
+    assert os.path.exists(c.path(key, 'compiled'))
+    assert '.v{}.'.format(cache.FORMAT) in c.path(key, 'compiled')
+
+
+def test_unreadable_entry_is_a_miss(tmp_path):
+    c = model.ModelCache(str(tmp_path))
+    m = model_library.ode_model_disc(0.1, 10)
+    params = {'r': 1.0, 'K': 2.0, 'cinit': 0.1}
+    expected = c.compiled(m).march(params)
+    c.put(cache.fingerprint(m), 'compiled', b'not a pickle')
+    misses = c.misses
+    numpy.testing.assert_array_equal(c.compiled(m).march(params), expected)
+    assert c.misses == misses + 1
+    # the rebuilt entry replaced the unreadable one
+    hits = c.hits
+    c.compiled(m)
+    assert c.hits == hits + 1
+
+
+def test_entries_take_the_umask(tmp_path):
+    c = model.ModelCache(str(tmp_path))
+    umask = os.umask(0o022)
+    try:
+        c.put('ab' * 32, 'xml', b'<collection/>')
+    finally:
+        os.umask(umask)
+    path = c.path('ab' * 32, 'xml')
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+    assert c.size == len(b'<collection/>')
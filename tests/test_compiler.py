@@ -0,0 +1,45 @@
+import numpy
+import pytest
+import sympy
+
+import model
+import model_library
+
+PARAMS = {'r': 1.0, 'K': 2.0, 'cinit': 0.1}
+
+
+@pytest.mark.parametrize('chunk', [1, 7, 64, 1000])
+@pytest.mark.parametrize('params', [PARAMS, dict(PARAMS, r=[0.5, 1.0, 2.0])])
+def test_chunked_step_matches_march(chunk, params):
+    compiled = model.compile_model(model_library.ode_model_disc(0.01, 200))
+    expected = compiled.march(params)
+    y = numpy.zeros_like(expected)
+    for start in range(compiled.lower, compiled.upper + 1, chunk):
+        compiled.step(y, start, min(start + chunk, compiled.upper + 1), params)
+    numpy.testing.assert_array_equal(y, expected)
+
+
+def test_residual_of_marched_solution_vanishes():
+    compiled = model.compile_model(model_library.ode_model_disc(0.01, 200))
+    y = compiled.march(PARAMS)
+    assert numpy.abs(compiled.residual(y, PARAMS)).max() < 1e-9
+
+
+@pytest.mark.parametrize('make, params', [
+    (lambda: model_library.ode_model_disc(0.01, 200), PARAMS),
+    (lambda: model.discretise(model_library.electrochemistry_model(),
+                              sympy.Symbol('x'), 10),
+     {'L': 1.0, 'krate': 1.0, 'Emid': 0.0, 'Cdl': 1.0, 'Es': -5.0, 'dE': 0.1,
+      'w': 1.0}),
+])
+def test_cse_kernels_match(make, params):
+    m = make()
+    plain = model.compile_model(m)
+    reduced = model.compile_model(m, cse=True)
+    y = numpy.random.RandomState(0).rand(plain.size)
+    for t in [0.0, 0.5]:
+        numpy.testing.assert_allclose(reduced.residual(y, params, t),
+                                      plain.residual(y, params, t), rtol=1e-12)
+    if not plain.is_differential:
+        numpy.testing.assert_allclose(reduced.march(params), plain.march(params),
+                                      rtol=1e-12)
@@ -0,0 +1,86 @@
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import model
+import model_library
+from derivative.ContentMathML import mml2sympy
+from derivative.ContentMathML import mml2sympy_iterparse
+from model.model import ArrayEquation
+from model.model import equation_to_mathml
+from model.model import sympy_to_mathml
+
+
+def _document():
+    out = io.BytesIO()
+    model.write_mathml(model_library.electrochemistry_model(), out)
+    return out.getvalue()
+
+
+@pytest.mark.parametrize('processes, chunksize, max_pending', [
+    (2, 3, None), (2, 1, 1), (None, 4, None)])
+def test_pooled_import_matches_serial(processes, chunksize, max_pending):
+    data = _document()
+    serial = list(mml2sympy_iterparse(io.BytesIO(data)))
+    pooled = list(mml2sympy_iterparse(io.BytesIO(data), processes=processes,
+                                      chunksize=chunksize, max_pending=max_pending))
+    assert len(serial) > 10
+    assert pooled == serial
+
+
+LIBRARY = [
+    model_library.ode_model,
+    lambda: model_library.ode_model_disc(0.1, 10),
+    model_library.pde_model,
+    lambda: model_library.pde_model_disc(10, 0.1),
+    model_library.electrochemistry_model,
+    model_library.simultaneous_model,
+]
+
+
+def _models(m, out):
+    out.append(m)
+    for i in m.includes:
+        _models(i.submodel, out)
+    return out
+
+
+def _parse(element):
+    return mml2sympy(ET.tostring(element))
+
+
+def _round_trip(d):
+    # asserts that every expression of d and its submodels parses back to
+    # itself, returning the forms of equation seen
+    kinds = set()
+    for m in _models(d, []):
+        expressions = list(m.solution_variables) + list(m.parameters)
+        if m.bounds is not None:
+            expressions.append(m.bounds)
+        for e in expressions:
+            assert _parse(sympy_to_mathml(e)) == e
+        for eq in m.eqs:
+            parsed = _parse(equation_to_mathml(eq))
+            if isinstance(eq, ArrayEquation):
+                kinds.add('bvar')
+                assert parsed == (eq.index, eq.lower, eq.upper, eq.stencil)
+            elif isinstance(eq, tuple):
+                kinds.add('domainofapplication')
+                assert parsed == eq
+            else:
+                kinds.add('relation')
+                assert parsed == eq
+    return kinds
+
+
+@pytest.mark.parametrize('make', LIBRARY)
+def test_library_round_trips(make):
+    assert _round_trip(make())
+
+
+def test_library_covers_every_equation_form():
+    kinds = set()
+    for make in LIBRARY:
+        kinds |= _round_trip(make())
+    assert kinds == {'bvar', 'domainofapplication', 'relation'}
@@ -0,0 +1,35 @@
+import io
+import os
+import stat
+
+import pytest
+
+from model_library import convert
+
+
+def test_written_files_take_the_umask(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        convert.convert(['ode_model'], str(tmp_path))
+    finally:
+        os.umask(umask)
+    path = tmp_path / 'ode_model.xml'
+    assert stat.S_IMODE(os.stat(str(path)).st_mode) == 0o644
+    assert os.listdir(str(tmp_path)) == ['ode_model.xml']
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_failed_target_does_not_stop_the_others(tmp_path, jobs):
+    log = io.StringIO()
+    results = convert.convert(['pde_model_disc(-1, 0.1)', 'ode_model'],
+                              str(tmp_path), jobs=jobs, log=log)
+    status = {str(t): s for t, _, s in results}
+    assert status == {'pde_model_disc(-1, 0.1)': 'failed', 'ode_model': 'written'}
+    assert 'pde_model_disc(-1, 0.1): ' in log.getvalue()
+    assert os.listdir(str(tmp_path)) == ['ode_model.xml']
+
+
+def test_main_exits_non_zero_after_a_failure(tmp_path):
+    assert convert.main(['-o', str(tmp_path), 'pde_model_disc(-1, 0.1)',
+                         'ode_model']) == 1
+    assert convert.main(['-o', str(tmp_path), 'ode_model']) == 0
@@ -0,0 +1,55 @@
+import numpy
+import pytest
+import sympy
+
+import model
+
+
+def relaxation(name, input, initial):
+    """ x' = input - x with x(0) = initial. """
+    t = sympy.Symbol('t')
+    x = sympy.Symbol(name)
+    m = model.Model()
+    m.name = name
+    m.solution_variables = {sympy.Function(name)(t)}
+    m.parameters = {sympy.Symbol(input)} | initial.free_symbols
+    m.bounds = t > 0
+    m.eqs = {
+        sympy.Eq(sympy.Derivative(x, t), sympy.Symbol(input) - x),
+        (sympy.Eq(t, 0), sympy.Eq(x, initial)),
+    }
+    return m
+
+
+def coupled(a, b):
+    t = sympy.Symbol('t')
+    models = model.Models()
+    models.models = [a, b]
+    models.connections = [
+        model.Connection((a, sympy.Function('a')(t)), (b, sympy.Symbol('q'))),
+        model.Connection((b, sympy.Function('b')(t)), (a, sympy.Symbol('p'))),
+    ]
+    return models
+
+
+def test_cycle_starts_from_initial_values():
+    models = coupled(relaxation('a', 'p', sympy.Integer(1)),
+                     relaxation('b', 'q', sympy.Integer(0)))
+    times = numpy.linspace(0.0, 5.0, 501)
+    result = model.cosimulate(models, times, executor=None)
+    a = result.values('a', sympy.Function('a')(sympy.Symbol('t')))[:, 0]
+    b = result.values('b', sympy.Function('b')(sympy.Symbol('t')))[:, 0]
+    assert (a[0], b[0]) == (1.0, 0.0)
+    # a + b is conserved and both relax to its mean
+    numpy.testing.assert_allclose(a[-1], 0.5, atol=1e-2)
+    numpy.testing.assert_allclose(b[-1], 0.5, atol=1e-2)
+
+
+def test_cycle_without_start_values_names_the_cycle():
+    a0 = sympy.Symbol('p')
+    models = coupled(relaxation('a', 'p', a0), relaxation('b', 'q', a0 * 0))
+    with pytest.raises(ValueError, match='coupled in a cycle.*"q" of model "b"'):
+        model.cosimulate(models, [0.0, 1.0], executor=None)
+    result = model.cosimulate(models, [0.0, 1.0], {'b': {'q': 2.0}},
+                              executor=None)
+    assert result.values('a', sympy.Function('a')(sympy.Symbol('t')))[0, 0] == 0.0
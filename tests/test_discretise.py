@@ -0,0 +1,47 @@
+import numpy
+import pytest
+import sympy
+
+import model
+import model_library
+
+x = sympy.Symbol('x')
+
+
+def test_pde_model_matches_pde_model_disc():
+    N = 10
+    params = {'cl': 1.0, 'L': 1.0}
+    ours = model.compile_model(model.discretise(model_library.pde_model(), x, N))
+    library = model.compile_model(model_library.pde_model_disc(N, 1.0 / N))
+    assert ours.size == library.size == N + 1
+    y = numpy.random.RandomState(0).rand(N + 1)
+    # the same central differences and Dirichlet condition; at x = L the
+    # library model uses a first order difference and discretise a second
+    # order one, which agree on the solution
+    assert numpy.allclose(ours.residual(y, params)[:N],
+                          library.residual(y, params)[:N], rtol=1e-12)
+    a, _ = model.newton(ours, numpy.zeros(N + 1), params)
+    b, _ = model.newton(library, numpy.zeros(N + 1), params)
+    assert numpy.allclose(a, b, rtol=0, atol=1e-10)
+
+
+def test_electrochemistry_model_compiles():
+    N = 10
+    m = model.discretise(model_library.electrochemistry_model(), x, N)
+    compiled = model.compile_model(m)
+    # c at the nodes and the current i; the flux condition at x = L is the
+    # rate law of the boundary submodel, so c[N] is algebraic
+    assert compiled.size == N + 2
+    assert compiled.mass.sum() == N - 1
+    params = {'L': 1.0, 'krate': 1.0, 'Emid': 0.0, 'Cdl': 1.0, 'Es': -5.0,
+              'dE': 0.1, 'w': 1.0}
+    y = compiled.initial_values(params)
+    assert numpy.isfinite(compiled.residual(y, params)).all()
+
+
+def test_too_many_boundary_conditions():
+    m = model_library.pde_model()
+    c = sympy.Symbol('c')
+    m.eqs = set(m.eqs) | {(sympy.Eq(x, 0), sympy.Eq(sympy.Derivative(c, x), 0))}
+    with pytest.raises(ValueError, match='2 conditions'):
+        model.discretise(m, x, 10)
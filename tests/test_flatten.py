@@ -0,0 +1,34 @@
+import numpy
+import sympy
+
+import model
+import model_library
+
+x = sympy.Symbol('x')
+
+
+def test_flattened_model_has_no_includes():
+    flat = model.flatten(model_library.electrochemistry_model())
+    assert not flat.includes
+    assert {str(s) for s in flat.solution_variables} == {'c(x, t)', 'rhs_i(t)'}
+
+
+def test_flattened_model_compiles_to_the_same_residual():
+    # the library's only model with includes is continuous in x, so both
+    # the nested and the flattened model are compiled after discretising
+    N = 10
+    nested = model.compile_model(
+        model.discretise(model_library.electrochemistry_model(), x, N))
+    flat = model.compile_model(
+        model.discretise(model.flatten(model_library.electrochemistry_model()),
+                         x, N))
+    assert list(flat.variables) == ['c', 'rhs_i']
+    assert [v.size for v in flat.variables.values()] \
+        == [v.size for v in nested.variables.values()]
+    numpy.testing.assert_array_equal(flat.mass, nested.mass)
+    params = {'L': 1.0, 'krate': 1.0, 'Emid': 0.0, 'Cdl': 1.0, 'Es': -5.0,
+              'dE': 0.1, 'w': 1.0}
+    y = numpy.random.RandomState(0).rand(flat.size)
+    for t in [0.0, 0.5]:
+        numpy.testing.assert_allclose(flat.residual(y, params, t),
+                                      nested.residual(y, params, t), rtol=1e-12)
@@ -0,0 +1,49 @@
+import os
+import stat
+
+import numpy
+import pytest
+
+import model
+import model_library
+import runtime
+
+
+def test_frozen_march_matches_compiled(tmp_path):
+    m = model_library.ode_model_disc(0.01, 200)
+    params = {'r': 1.0, 'K': 2.0, 'cinit': 0.1}
+    model.freeze(m, str(tmp_path))
+    frozen = runtime.load(str(tmp_path))
+    compiled = model.compile_model(m)
+    numpy.testing.assert_array_equal(frozen.march(params), compiled.march(params))
+    y = numpy.zeros(compiled.size)
+    for start in range(0, compiled.upper + 1, 9):
+        frozen.step(y, start, min(start + 9, compiled.upper + 1), params)
+    numpy.testing.assert_array_equal(y, compiled.march(params))
+
+
+def test_frozen_residual_matches_compiled(tmp_path):
+    m = model_library.pde_model_disc(50, 0.02)
+    params = {'cl': 1.0, 'L': 1.0}
+    model.freeze(m, str(tmp_path))
+    frozen = runtime.load(str(tmp_path))
+    compiled = model.compile_model(m)
+    y = numpy.random.default_rng(0).random((3, compiled.size))
+    numpy.testing.assert_array_equal(frozen.residual(y, params),
+                                     compiled.residual(y, params))
+
+
+def test_frozen_missing_parameter(tmp_path):
+    model.freeze(model_library.pde_model_disc(5, 0.2), str(tmp_path))
+    with pytest.raises(runtime.FrozenModelError):
+        runtime.load(str(tmp_path)).residual(numpy.zeros(6), {'L': 1.0})
+
+
+def test_frozen_files_take_the_umask(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        model.freeze(model_library.ode_model_disc(0.1, 10), str(tmp_path))
+    finally:
+        os.umask(umask)
+    for name in os.listdir(str(tmp_path)):
+        assert stat.S_IMODE(os.stat(str(tmp_path / name)).st_mode) == 0o644
@@ -0,0 +1,25 @@
+import numpy
+import pytest
+
+import model
+import model_library
+
+
+@pytest.mark.parametrize('method, rtol, tolerance', [
+    ('rk45', 1e-8, 1e-6),
+    ('rosenbrock', 1e-6, 1e-3),
+])
+def test_ensemble_follows_the_logistic_solution(method, rtol, tolerance):
+    r = numpy.array([0.5, 1.0, 2.0, 4.0])
+    K = numpy.array([1.0, 2.0, 3.0, 0.5])
+    cinit = 0.1
+    times = numpy.linspace(0.0, 4.0, 9)
+    solution = model.integrate(model_library.ode_model(), (0.0, 4.0),
+                               {'r': r, 'K': K, 'cinit': cinit}, t_eval=times,
+                               method=method, rtol=rtol, atol=1e-10)
+    assert solution.success
+    assert solution.y.shape == (len(r), len(times), 1)
+    exact = K[:, None] / (1 + (K[:, None] / cinit - 1)
+                          * numpy.exp(-r[:, None] * times))
+    numpy.testing.assert_allclose(solution.values('c')[..., 0], exact,
+                                  rtol=0, atol=tolerance)
@@ -0,0 +1,31 @@
+import os
+import stat
+
+import pytest
+
+from model._io import atomic_open
+from model._io import atomic_write
+
+
+def test_atomic_write_takes_the_umask(tmp_path):
+    path = str(tmp_path / 'f')
+    umask = os.umask(0o027)
+    try:
+        atomic_write(path, 'text')
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    with open(path) as f:
+        assert f.read() == 'text'
+
+
+def test_failed_write_keeps_the_old_file(tmp_path):
+    path = str(tmp_path / 'f')
+    atomic_write(path, b'old')
+    with pytest.raises(RuntimeError):
+        with atomic_open(path) as f:
+            f.write(b'new')
+            raise RuntimeError
+    assert os.listdir(str(tmp_path)) == ['f']
+    with open(path, 'rb') as f:
+        assert f.read() == b'old'
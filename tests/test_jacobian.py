@@ -0,0 +1,49 @@
+import numpy
+import pytest
+
+import model
+import model_library
+
+CASES = [
+    (lambda: model_library.ode_model_disc(0.1, 30), {'r': 1.0, 'K': 2.0, 'cinit': 0.1}),
+    (lambda: model_library.pde_model_disc(30, 1.0 / 30), {'cl': 1.0, 'L': 1.0}),
+]
+
+
+def _finite_differences(compiled, y, params, h=1e-6):
+    f = compiled.residual(y, params)
+    J = numpy.empty((compiled.size, compiled.size))
+    for j in range(compiled.size):
+        e = y.copy()
+        e[j] += h
+        J[:, j] = (compiled.residual(e, params) - f) / h
+    return J
+
+
+@pytest.mark.parametrize('make, params', CASES)
+def test_jacobian_matches_finite_differences(make, params):
+    compiled = model.compile_model(make())
+    y = numpy.random.default_rng(0).random(compiled.size) + 0.5
+    J = model.SparseJacobian(compiled).evaluate(y, params).toarray()
+    numpy.testing.assert_allclose(J, _finite_differences(compiled, y, params),
+                                  rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize('make, params', CASES)
+def test_solve_reuses_the_pattern(make, params):
+    compiled = model.compile_model(make())
+    jacobian = model.SparseJacobian(compiled)
+    rng = numpy.random.default_rng(1)
+    for _ in range(3):
+        J = jacobian.evaluate(rng.random(compiled.size) + 0.5, params)
+        f = rng.random(compiled.size)
+        numpy.testing.assert_allclose(J @ jacobian.solve(f), f, atol=1e-9)
+
+
+@pytest.mark.parametrize('make, params', CASES)
+def test_newton_converges(make, params):
+    compiled = model.compile_model(make())
+    y, iterations = model.newton(compiled, numpy.zeros(compiled.size), params,
+                                 tol=1e-8)
+    assert numpy.abs(compiled.residual(y, params)).max() < 1e-8
+    assert iterations < 10
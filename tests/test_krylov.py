@@ -0,0 +1,32 @@
+import numpy
+import pytest
+
+import model
+import model_library
+
+
+@pytest.mark.parametrize('jvp', ['symbolic', 'fd'])
+@pytest.mark.parametrize('preconditioner', ['none', 'jacobi', 'tridiagonal'])
+def test_newton_krylov_matches_newton(jvp, preconditioner):
+    n = 50
+    compiled = model.compile_model(model_library.pde_model_disc(n, 1.0 / n))
+    params = {'cl': 1.0, 'L': 1.0}
+    y0 = numpy.zeros(compiled.size)
+    # the residuals scale with 1 / dx**2, and so must an absolute tolerance
+    tol = 1e-12 * n * n
+    expected, _ = model.newton(compiled, y0, params, tol=tol)
+    # unpreconditioned, the Laplacian is too ill conditioned for restarted
+    # GMRES; a restart as long as the system makes the linear solves exact
+    y, stats = model.newton_krylov(compiled, y0, params, tol=tol, jvp=jvp,
+                                   preconditioner=preconditioner, restart=n + 1)
+    numpy.testing.assert_allclose(y, expected, atol=1e-8)
+    assert numpy.abs(compiled.residual(y, params)).max() <= tol
+    assert stats.iterations >= 1
+
+
+def test_implicit_euler_follows_the_solution():
+    params = {'r': 1.0, 'K': 2.0, 'cinit': 0.1}
+    times = numpy.linspace(0.0, 2.0, 2001)
+    y, _ = model.implicit_euler(model_library.ode_model(), times, params)
+    c = 2.0 / (1 + 19 * numpy.exp(-times))
+    numpy.testing.assert_allclose(y[:, 0], c, atol=1e-3)
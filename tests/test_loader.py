@@ -0,0 +1,47 @@
+import pytest
+
+import model
+import model_library
+
+
+LIBRARY = [
+    model_library.ode_model,
+    lambda: model_library.ode_model_disc(0.1, 10),
+    model_library.pde_model,
+    lambda: model_library.pde_model_disc(10, 0.1),
+    model_library.electrochemistry_model,
+    model_library.simultaneous_model,
+]
+
+
+def _fingerprints(d):
+    models = d.models if isinstance(d, model.Models) else [d]
+    return [(m.name, model.fingerprint(m)) for m in models]
+
+
+@pytest.mark.parametrize('make', LIBRARY)
+def test_lazy_load_keeps_the_fingerprint(tmp_path, make):
+    d = make()
+    path = str(tmp_path / 'm.xml')
+    with open(path, 'wb') as f:
+        model.write_mathml(d, f)
+    with model.load_collection(path) as loader:
+        assert loader.names()
+        assert loader.loaded() == []
+        loaded = loader.contents()
+    assert _fingerprints(loaded) == _fingerprints(d)
+
+
+@pytest.mark.parametrize('text', [
+    b'',
+    b'<collection><model name="a"><equations/>',
+    b'<collection><model name="a"/></model></collection>',
+    b'<model name="a"></model>',
+])
+def test_malformed_collection(tmp_path, text):
+    path = str(tmp_path / 'm.xml')
+    with open(path, 'wb') as f:
+        f.write(text)
+    with pytest.raises(model.CollectionFormatError):
+        with model.load_collection(path) as loader:
+            loader.contents()
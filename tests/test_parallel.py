@@ -0,0 +1,39 @@
+import numpy
+import pytest
+
+import model
+import model_library
+
+PARAMS = {'cl': 1.0, 'L': 1.0}
+
+
+@pytest.mark.parametrize('workers, n_shards', [(1, None), (1, 7), (2, None), (2, 5)])
+def test_parallel_residual_matches_serial(workers, n_shards):
+    compiled = model.compile_model(model_library.pde_model_disc(1000, 1e-3))
+    y = numpy.random.default_rng(0).random(compiled.size)
+    expected = compiled.residual(y, PARAMS)
+    with model.parallel_residual(compiled, workers, n_shards) as residual:
+        numpy.testing.assert_array_equal(residual.residual(y, PARAMS), expected)
+        # the shared state is reused by the next evaluation
+        y[::3] += 1.0
+        numpy.testing.assert_array_equal(residual.residual(y, PARAMS),
+                                         compiled.residual(y, PARAMS))
+
+
+def test_shards_cover_the_rows():
+    compiled = model.compile_model(model_library.pde_model_disc(100, 1e-2))
+    layout = model.parallel.shards(compiled, 4)
+    assert layout[0].rows.start == 0
+    assert layout[-1].rows.stop == compiled.size
+    for a, b in zip(layout[:-1], layout[1:]):
+        assert a.rows.stop == b.rows.start
+        # the stencil reads one row of each neighbour
+        assert a.halo.stop == a.rows.stop + 1
+        assert b.halo.start == b.rows.start - 1
+
+
+def test_batched_parameters_are_rejected():
+    compiled = model.compile_model(model_library.pde_model_disc(10, 0.1))
+    with model.parallel_residual(compiled, 1) as residual:
+        with pytest.raises(model.CompileError):
+            residual.residual(numpy.zeros(compiled.size), {'cl': [1.0, 2.0], 'L': 1.0})
@@ -0,0 +1,56 @@
+import os
+import stat
+
+import numpy
+import pytest
+
+import model
+import model_library
+
+PARAMS = {'r': 1.0, 'K': 2.0, 'cinit': 0.1}
+
+
+def test_metadata_takes_the_umask(tmp_path):
+    path = str(tmp_path / 'run')
+    umask = os.umask(0o022)
+    try:
+        model.march_to_store(model_library.ode_model_disc(0.1, 10), path, PARAMS)
+    finally:
+        os.umask(umask)
+    for name in os.listdir(path):
+        assert stat.S_IMODE(os.stat(os.path.join(path, name)).st_mode) == 0o644
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 7, 64, 1000])
+@pytest.mark.parametrize('decimate', [1, 3])
+def test_march_to_store_matches_march(tmp_path, chunk_rows, decimate):
+    m = model_library.ode_model_disc(0.01, 200)
+    expected = model.compile_model(m).march(PARAMS)
+    with model.march_to_store(m, str(tmp_path / 'run'), PARAMS, chunk_rows=chunk_rows,
+                              decimate=decimate) as s:
+        numpy.testing.assert_array_equal(s.times, numpy.arange(0, 201, decimate))
+        numpy.testing.assert_array_equal(s.values[:, 0], expected[::decimate])
+        assert s.metadata['complete']
+
+
+def test_march_to_store_batched_parameters(tmp_path):
+    m = model_library.ode_model_disc(0.01, 50)
+    params = dict(PARAMS, r=[0.5, 1.0, 2.0])
+    expected = model.compile_model(m).march(params)
+    with model.march_to_store(m, str(tmp_path / 'run'), params, chunk_rows=16) as s:
+        numpy.testing.assert_array_equal(numpy.moveaxis(s.values[..., 0], 0, -1),
+                                         expected)
+
+
+@pytest.mark.parametrize('chunk_rows', [2, 5, 1000])
+def test_integrate_to_store_matches_integrate(tmp_path, chunk_rows):
+    m = model_library.ode_model()
+    t_eval = numpy.linspace(0.0, 2.0, 41)
+    expected = model.integrate(m, (0.0, 2.0), PARAMS, t_eval=t_eval, rtol=1e-10,
+                               atol=1e-12)
+    with model.integrate_to_store(m, str(tmp_path / 'run'), t_eval, PARAMS,
+                                  chunk_rows=chunk_rows, rtol=1e-10, atol=1e-12) as s:
+        numpy.testing.assert_array_equal(s.times, t_eval)
+        numpy.testing.assert_allclose(s.values, expected.y, rtol=1e-8)
+        t, _ = s.window(0.5, 1.0)
+        numpy.testing.assert_array_equal(t, t_eval[(t_eval >= 0.5) & (t_eval <= 1.0)])
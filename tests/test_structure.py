@@ -0,0 +1,63 @@
+import numpy
+import pytest
+import sympy
+
+import model
+import model_library
+
+DISCRETE = [
+    (lambda: model_library.ode_model_disc(0.1, 10), {'r': 1.0, 'K': 2.0, 'cinit': 0.1}),
+    (lambda: model_library.pde_model_disc(10, 0.1), {'cl': 1.0, 'L': 1.0}),
+    (model_library.simultaneous_model, {}),
+]
+
+
+@pytest.mark.parametrize('make, params', DISCRETE)
+def test_blocks_are_lower_triangular(make, params):
+    d = model.decompose(make())
+    position = numpy.full(d.compiled.size, -1)
+    for k, block in enumerate(d.blocks):
+        position[block.columns] = k
+    assert sorted(numpy.concatenate([b.columns for b in d.blocks]).tolist()) \
+        == list(range(d.compiled.size))
+    for k, block in enumerate(d.blocks):
+        used = d.incidence[block.rows].indices
+        assert position[used].max() == k
+
+
+def test_block_order_of_the_library_models():
+    marched = model.decompose(model_library.ode_model_disc(0.1, 10))
+    assert [b.columns.tolist() for b in marched.blocks] == [[k] for k in range(11)]
+    laplace = model.decompose(model_library.pde_model_disc(10, 0.1))
+    # the Dirichlet condition first, then the coupled rest
+    assert [b.columns.tolist() for b in laplace.blocks] \
+        == [[0], list(range(1, 11))]
+
+
+def test_index_of_an_index_two_dae():
+    t = sympy.Symbol('t')
+    x = sympy.Symbol('x')
+    z = sympy.Symbol('z')
+    m = model.Model()
+    m.name = 'index two'
+    m.solution_variables = {sympy.Function('x')(t), sympy.Function('z')(t)}
+    m.bounds = t > 0
+    # the constraint does not involve z, which it only fixes through x'
+    m.eqs = {sympy.Eq(sympy.Derivative(x, t), z), sympy.Eq(x, sympy.sin(t))}
+    d = model.decompose(m)
+    assert not d.singular
+    assert d.index == 2
+    # the constraint is differentiated once, the differential row not at all
+    constraint = d.algebraic.tolist()
+    assert d.differentiations[constraint].tolist() == [1]
+    assert d.differentiations.sum() == 1
+
+
+@pytest.mark.parametrize('make, params', DISCRETE)
+def test_block_solve_matches_newton(make, params):
+    d = model.decompose(make())
+    y0 = numpy.zeros(d.compiled.size)
+    expected, _ = model.newton(d.compiled, y0, params)
+    y, _ = d.solve(y0, params)
+    numpy.testing.assert_allclose(y, expected, rtol=1e-10, atol=1e-12)
+    assert numpy.abs(d.compiled.residual(y, params)).max() < 1e-9
@@ -0,0 +1,25 @@
+import numpy
+import pytest
+
+import model
+import model_library
+
+
+def test_parameter_grid_is_the_cartesian_product():
+    grid = model.parameter_grid(r=[1.0, 2.0, 3.0], K=[0.5, 4.0])
+    assert grid.dtype.names == ('r', 'K')
+    assert sorted(zip(grid['r'], grid['K'])) == sorted(
+        (r, K) for r in [1.0, 2.0, 3.0] for K in [0.5, 4.0])
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_sweep_matches_direct_march(processes):
+    m = model_library.ode_model_disc(0.1, 10)
+    grid = model.parameter_grid(r=numpy.linspace(0.5, 2.0, 4), K=[1.0, 2.0, 3.0])
+    out = model.sweep(m, grid, params={'cinit': 0.1}, method='march',
+                      chunksize=5, processes=processes)
+    compiled = model.compile_model(m)
+    assert len(out) == len(grid)
+    for row in out:
+        expected = compiled.march({'r': row['r'], 'K': row['K'], 'cinit': 0.1})
+        assert numpy.allclose(row['result'], expected, rtol=1e-12, atol=0)
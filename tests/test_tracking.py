@@ -0,0 +1,90 @@
+import sympy
+
+import model
+import model_library
+
+
+def _names(m):
+    return {e.text for e in model.model_to_mathml(m).iter() if e.text}
+
+
+def test_shared_container_stamps_every_owner():
+    a = model_library.ode_model()
+    b = model_library.ode_model()
+    model.model_to_mathml(a)
+    a.mark_clean()
+    b.parameters = a.parameters
+    b.mark_clean()
+    a.parameters.add(sympy.Symbol('NEWPARAM'))
+    assert 'parameters' in a.dirty
+    assert 'parameters' in b.dirty
+
+
+def test_shared_container_invalidates_cached_mathml():
+    a = model_library.ode_model()
+    b = model_library.ode_model()
+    _names(a)
+    _names(b)
+    b.parameters = a.parameters
+    a.parameters.add(sympy.Symbol('NEWPARAM'))
+    assert 'NEWPARAM' in _names(a)
+    assert 'NEWPARAM' in _names(b)
+
+
+def test_assignment_copies_plain_containers():
+    m = model_library.ode_model()
+    eqs = set(m.eqs)
+    m.eqs = eqs
+    eqs.add(sympy.Eq(sympy.Symbol('z'), 1))
+    assert sympy.Eq(sympy.Symbol('z'), 1) not in m.eqs
+
+
+def test_pickled_model_keeps_tracking():
+    import pickle
+    m = pickle.loads(pickle.dumps(model_library.ode_model()))
+    _names(m)
+    m.parameters.add(sympy.Symbol('NEWPARAM'))
+    assert 'NEWPARAM' in _names(m)
+
+
+def test_changing_a_returned_tree_leaves_the_cache_alone():
+    import xml.etree.ElementTree as ET
+    m = model_library.electrochemistry_model()
+    expected = ET.tostring(model.model_to_mathml(m))
+    for tree in (model.model_to_mathml(m),
+                 model.model.submodel_to_mathml(m),
+                 model.model.include_to_mathml(next(iter(m.includes)))):
+        ET.indent(tree)
+        tree.set('name', 'changed')
+        for e in list(tree.iter()):
+            e.append(ET.Element('extra'))
+    assert ET.tostring(model.model_to_mathml(m)) == expected
+
+
+def test_containers_do_not_keep_their_owners_alive():
+    import gc
+    import weakref
+    m = model_library.ode_model()
+    parameters = m.parameters
+    ref = weakref.ref(m)
+    del m
+    gc.collect()
+    assert ref() is None
+    parameters.add(sympy.Symbol('NEWPARAM'))
+
+
+def test_copies_track_their_fields():
+    import copy
+    a = model_library.ode_model()
+    _names(a)
+    b = copy.deepcopy(a)
+    c = copy.copy(a)
+    b.mark_clean()
+    c.mark_clean()
+    b.parameters.add(sympy.Symbol('NEWPARAM'))
+    assert 'NEWPARAM' in _names(b)
+    assert 'NEWPARAM' not in _names(a)
+    # a shallow copy shares the container, and both are stamped
+    a.parameters.add(sympy.Symbol('OTHER'))
+    assert 'parameters' in c.dirty
+    assert 'OTHER' in _names(c)
@@ -0,0 +1,38 @@
+import io
+
+import sympy
+
+import model
+import model_library
+
+
+def test_model_without_bounds_has_no_domain(tmp_path):
+    m = model_library.simultaneous_model()
+    out = io.BytesIO()
+    model.write_mathml(m, out)
+    assert b'domainofapplication' not in out.getvalue()
+    element = model.model_to_mathml(m)
+    assert element.find('.//domainofapplication') is None
+
+    path = str(tmp_path / 'm.xml')
+    with open(path, 'wb') as f:
+        f.write(out.getvalue())
+    with model.load_collection(path) as loader:
+        loaded = loader['simultaneous']
+        assert loaded.bounds is None
+        assert loaded.eqs == m.eqs
+
+
+def test_streamed_output_follows_edits_without_keeping_the_document():
+    m = model_library.pde_model_disc(20, 0.05)
+    first = io.StringIO()
+    model.write_mathml(m, first, indent='  ')
+    assert '_cache_mathml_text' not in vars(m)
+    m.eqs.add(sympy.Eq(sympy.Symbol('z'), 1))
+    second = io.StringIO()
+    model.write_mathml(m, second, indent='  ')
+    assert '<ci>z</ci>' in second.getvalue()
+    assert '<ci>z</ci>' not in first.getvalue()
+    tree = io.BytesIO()
+    model.write_mathml(m, tree)
+    assert tree.getvalue().count(b'<eq />') == second.getvalue().count('<eq />')